@@ -0,0 +1,58 @@
+""" Benchmarks of building OrthodonticPhotographs and serializing them. """
+
+import pytest
+
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+from dicom4ortho._generated_codes import VIEWS
+
+pytest.importorskip('pytest_benchmark')
+
+SIZES = ('vga', 'hd', 'dslr')
+
+
+@pytest.mark.parametrize('size', SIZES)
+def bench_jpeg_passthrough(benchmark, image_bytes, size):
+    data = image_bytes(size, 'RGB', 'JPEG')
+    benchmark(OrthodonticPhotograph, input_image_bytes=data, image_type='EV01')
+
+
+@pytest.mark.parametrize('size', SIZES)
+def bench_jpeg2000(benchmark, image_bytes, size):
+    data = image_bytes(size, 'RGB', 'JPEG2000')
+    benchmark(OrthodonticPhotograph, input_image_bytes=data, image_type='EV01')
+
+
+@pytest.mark.parametrize('mode', ('RGB', 'L'))
+@pytest.mark.parametrize('size', SIZES)
+def bench_png_raw(benchmark, image_bytes, size, mode):
+    data = image_bytes(size, mode, 'PNG')
+    benchmark(OrthodonticPhotograph, input_image_bytes=data, image_type='EV01')
+
+
+def bench_copy_mwl_tags(benchmark, image_bytes, mwl):
+    photo = OrthodonticPhotograph(
+        input_image_bytes=image_bytes('vga', 'RGB', 'JPEG'), dicom_mwl=mwl)
+    # Include sorting out the MWL, not just applying it.
+    def copy_mwl_tags():
+        photo._mwl_tags = None
+        photo.copy_mwl_tags()
+    benchmark(copy_mwl_tags)
+
+
+def bench_apply_view_all_views(benchmark, image_bytes):
+    photo = OrthodonticPhotograph(input_image_bytes=image_bytes('vga', 'RGB', 'JPEG'))
+    views = list(VIEWS.values())
+
+    def apply_all_views():
+        for view in views:
+            photo._apply_view(view)
+    benchmark(apply_all_views)
+
+
+@pytest.mark.parametrize('size,image_format', [
+    ('hd', 'JPEG'), ('dslr', 'JPEG'), ('hd', 'PNG')])
+def bench_to_byte(benchmark, image_bytes, size, image_format):
+    photo = OrthodonticPhotograph(
+        input_image_bytes=image_bytes(size, 'RGB', image_format), image_type='EV01')
+    photo.prepare()
+    benchmark(photo.to_byte)
@@ -0,0 +1,37 @@
+""" Benchmarks of sending to local stand-ins of a PACS. """
+
+import pytest
+
+from dicom4ortho.dicom import dimse, wado
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph, OrthodonticSeries
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture(scope='module')
+def series(image_bytes):
+    """ A series of four hd JPEG photographs. """
+    orthodontic_series = OrthodonticSeries()
+    for image_type in ('EV01', 'EV02', 'IV01', 'IV02'):
+        photo = OrthodonticPhotograph(
+            input_image_bytes=image_bytes('hd', 'RGB', 'JPEG'),
+            image_type=image_type,
+            series_instance_uid=orthodontic_series.UID)
+        photo.prepare()
+        orthodontic_series.add(photo)
+    return orthodontic_series
+
+
+def bench_dimse_send(benchmark, series, storage_scp):
+    host, port, aet = storage_scp
+    datasets = [photo._ds for photo in series]
+    status = benchmark(
+        dimse.send, dicom_datasets=datasets,
+        pacs_dimse_hostname=host, pacs_dimse_port=port, pacs_dimse_aet=aet)
+    assert status.Status == 0
+
+
+def bench_wado_send(benchmark, series, stow_server):
+    response = benchmark(
+        wado.send, orthodontic_series=series, pacs_wado_url=stow_server)
+    assert response.status_code == 200
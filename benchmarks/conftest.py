@@ -0,0 +1,69 @@
+""" Fixtures of the benchmarks: the synthetic corpus and local stand-ins for a PACS. """
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from corpus import make_image, SIZES
+
+
+@pytest.fixture(scope='session')
+def image_bytes():
+    """ make_image() with caching, as corpus images are expensive to generate. """
+    cache = {}
+
+    def get(size='hd', mode='RGB', image_format='JPEG'):
+        key = (size, mode, image_format)
+        if key not in cache:
+            cache[key] = make_image(*SIZES[size], mode=mode, image_format=image_format)
+        return cache[key]
+    return get
+
+
+@pytest.fixture(scope='session')
+def mwl():
+    from test.sample_data_generator import make_sample_MWL
+    return make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+
+
+@pytest.fixture(scope='session')
+def storage_scp():
+    """ A pynetdicom Storage SCP accepting every VL Photographic image. Yields (host, port, aet). """
+    from pydicom.uid import AllTransferSyntaxes
+    from pynetdicom import AE, evt
+    from pynetdicom.sop_class import VLPhotographicImageStorage  # pylint: disable=E0611
+
+    ae = AE(ae_title='BENCH_SCP')
+    ae.add_supported_context(VLPhotographicImageStorage, AllTransferSyntaxes)
+    server = ae.start_server(
+        ('127.0.0.1', 0), block=False,
+        evt_handlers=[(evt.EVT_C_STORE, lambda event: 0x0000)])
+    yield '127.0.0.1', server.server_address[1], 'BENCH_SCP'
+    server.shutdown()
+
+
+class _StowHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/dicom+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope='session')
+def stow_server():
+    """ A local HTTP server accepting STOW-RS posts. Yields its URL. """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _StowHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/dicom-web/studies"
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,73 @@
+""" Synthetic image corpus for the benchmarks.
+
+Images are smooth gradients with some noise, which compress about as well
+as photographs, so encoders and decoders do realistic amounts of work. The
+corpus is deterministic: the same name always gives the same bytes.
+
+Run as a script to write the corpus to a folder, e.g. to benchmark the
+command line:
+
+    python benchmarks/corpus.py /tmp/corpus
+"""
+
+import io
+import sys
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+# name -> (width, height)
+SIZES = {
+    'vga': (640, 480),
+    'hd': (1920, 1080),
+    'dslr': (4288, 2848),  # Nikon D90
+}
+
+MODES = ('RGB', 'L')
+
+# Pillow format -> file extension
+FORMATS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'JPEG2000': '.jp2',
+}
+
+
+def make_image(width, height, mode='RGB', image_format='JPEG', seed=0) -> bytes:
+    """ Encoded bytes of a synthetic width x height image. """
+    random = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:height, 0:width]
+    planes = [
+        (x * 255 // max(width - 1, 1)),
+        (y * 255 // max(height - 1, 1)),
+        ((x + y) * 255 // max(width + height - 2, 1)),
+    ]
+    pixels = numpy.stack(planes[:len(mode)], axis=-1).astype(numpy.int16)
+    pixels += random.integers(-12, 13, size=pixels.shape, dtype=numpy.int16)
+    pixels = numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+    if mode == 'L':
+        pixels = pixels[..., 0]
+    out = io.BytesIO()
+    Image.fromarray(pixels, mode=mode).save(out, format=image_format)
+    return out.getvalue()
+
+
+def corpus(sizes=SIZES, modes=MODES, formats=FORMATS):
+    """ Yield (name, image bytes) for every combination of size, mode and format. """
+    for size_name, (width, height) in sizes.items():
+        for mode in modes:
+            for image_format, extension in formats.items():
+                name = f"{size_name}-{mode}{extension}"
+                yield name, make_image(width, height, mode, image_format)
+
+
+def write_corpus(directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, image_bytes in corpus():
+        (directory / name).write_bytes(image_bytes)
+
+
+if __name__ == '__main__':
+    write_corpus(sys.argv[1])
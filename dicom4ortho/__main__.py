@@ -7,17 +7,39 @@ import logging
 import textwrap
 import csv
 import os
-from argparse import ArgumentParser
+import glob
+import json
+import signal
+import threading
+from argparse import ArgumentParser, ArgumentTypeError
 from argparse import RawDescriptionHelpFormatter
 import importlib.resources as importlib_resources
 from prettytable import PrettyTable
+from pydicom.datadict import tag_for_keyword
 
 from dicom4ortho import logger
 import dicom4ortho.config as config
 import dicom4ortho.controller as controller
+import dicom4ortho.metrics as metrics
+from dicom4ortho.cache import ConversionCache
+from dicom4ortho.index import ArchiveIndex
+from dicom4ortho.outbox import Outbox
+from dicom4ortho.receiver import CALLING_AE_TITLE
 from dicom4ortho.utils import generate_dicom_uid
+from dicom4ortho.validation import FAST, FULL, ValidationError
+from dicom4ortho.writer import FSYNC_BATCH, FSYNC_FILE, FSYNC_POLICIES
 
 LIST_IMAGE_TYPES = 'list-image-types'
+CONVERT = 'convert'
+SERVE = 'serve'
+SUBMIT = 'submit'
+WATCH = 'watch'
+DUMP = 'dump'
+INDEX = 'index'
+OUTBOX = 'outbox'
+RECEIVE = 'receive'
+WORKLIST = 'worklist'
+COMMANDS = (CONVERT, SERVE, SUBMIT, WATCH, DUMP, INDEX, OUTBOX, RECEIVE, WORKLIST)
 
 
 class CLIError(Exception):
@@ -67,111 +89,1098 @@ def print_image_types():
     print(image_types_table)
 
 
-def main(argv=None):
-    '''Command line options.'''
-    if argv is None:
-        argv = sys.argv
-    else:
-        sys.argv.extend(argv)
+def parse_image_type_rule(rule):
+    """ Split a <pattern>=<image_type> command line rule. """
+    pattern, separator, image_type = rule.rpartition('=')
+    if not separator or not pattern or not image_type:
+        raise ArgumentTypeError(
+            f"{rule!r} is not a rule like <pattern>=<image_type>")
+    return pattern, image_type.replace('-', '')
 
-    program_version = "v%s" % config.VERSION
-    program_version_message = '%%(prog)s %s' % (program_version)
-    program_license = '''{short_description}
 
-USAGE
-'''.format(
-        short_description=config.__short_description__,
-        creation_date=config.__creation_date__)
+def parse_route(rule):
+    """ Split a <keyword>:<pattern>=<image_type> command line routing rule. """
+    rule_without_type, separator, image_type = rule.rpartition('=')
+    keyword, colon, pattern = rule_without_type.partition(':')
+    if not separator or not colon or not keyword or not pattern or not image_type:
+        raise ArgumentTypeError(
+            f"{rule!r} is not a rule like <keyword>:<pattern>=<image_type>")
+    if keyword != CALLING_AE_TITLE and tag_for_keyword(keyword) is None:
+        raise ArgumentTypeError(f"Unknown DICOM keyword '{keyword}'")
+    return keyword, pattern, image_type.replace('-', '')
+
+
+def is_batch(args):
+    """ Whether the command line asks to convert more than a single file. """
+    return (len(args.input_filenames) > 1
+            or args.output_dir is not None
+            or args.jobs > 1
+            or bool(args.image_type_rules)
+            or os.path.isdir(args.input_filenames[0])
+            or glob.escape(args.input_filenames[0]) != args.input_filenames[0])
+
+
+def add_metrics_argument(parser):
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        default=None,
+        help="Time the conversion stages and count images and bytes. \
+        'summary' prints percentiles on exit, '-' writes JSON lines to stderr, \
+        anything else is a file to append JSON lines to. Same as setting \
+        {}.".format(metrics.ENVIRONMENT_VARIABLE),
+        metavar='<summary|-|filename>',
+    )
+
+
+def add_validate_on_write_argument(parser):
+    parser.add_argument(
+        "--validate-on-write",
+        dest="validate_on_write",
+        choices=(FAST, FULL),
+        default=None,
+        help=("Validate each DICOM file before writing it. '{}' only checks "
+              "the attributes set by dicom4ortho, '{}' also the ones copied from "
+              "the Modality Worklist. Batches report the issues of all files at "
+              "the end.").format(FAST, FULL),
+    )
+
+
+def add_write_arguments(parser):
+    parser.add_argument(
+        "--fsync",
+        dest="fsync",
+        choices=FSYNC_POLICIES,
+        default=None,
+        help="When DICOM files are flushed to disk: 'none' leaves it to the \
+        operating system, 'file' syncs each file, 'batch' syncs all files \
+        once the batch is done. Files are always written to a temporary \
+        file first and renamed. [default: {}]".format(config.SAVE_FSYNC),
+    )
+    parser.add_argument(
+        "--direct-io",
+        dest="direct_io",
+        action="store_true",
+        default=None,
+        help="Write DICOM files with O_DIRECT, bypassing the page cache, where supported.",
+    )
+
+
+def add_commitment_arguments(parser):
+    parser.add_argument(
+        "--commit",
+        dest="commitment_port",
+        nargs='?',
+        type=int,
+        const=config.COMMITMENT_PORT,
+        default=None,
+        help="Ask the PACS for Storage Commitment of what is sent, and keep \
+        the outbox copies until it commits to them. Its reports are received \
+        on this port. DIMSE only. [default port: %(const)s]",
+        metavar='<port>',
+    )
+    parser.add_argument(
+        "--purge",
+        dest="purge",
+        action="store_true",
+        help="Also delete the DICOM files queued once the PACS committed to them. Needs --commit.",
+    )
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache",
+        dest="cache_directory",
+        nargs='?',
+        const=config.CACHE_DIRECTORY,
+        default=None,
+        help="Keep converted photographs in a cache, so that converting the \
+        same photograph with the same metadata again returns the same DICOM \
+        file and UIDs. [default directory: %(const)s]",
+        metavar='<directory>',
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=config.CACHE_MAX_BYTES // 1000000,
+        help="Least recently used photographs are removed from the cache \
+        past this size, in MB. [default: %(default)s]",
+        metavar='<MB>',
+    )
+
+
+def add_preview_arguments(parser):
+    parser.add_argument(
+        "--icon",
+        dest="icon",
+        action="store_true",
+        default=None,
+        help="Add an Icon Image Sequence of at most {0}x{0} pixels, for PACS \
+        worklists.".format(config.ICON_SIZE),
+    )
+    parser.add_argument(
+        "--preview",
+        dest="preview",
+        action="store_true",
+        default=None,
+        help="Write a JPEG preview of at most {0}x{0} pixels next to each DICOM \
+        file, as <name>{1}.".format(config.PREVIEW_SIZE, config.PREVIEW_SUFFIX),
+    )
+
+
+def preview_metadata_from_args(args):
+    """ The metadata asked for by add_preview_arguments(). """
+    return {key: True for key in ('icon', 'preview') if getattr(args, key)}
+
+
+def add_index_argument(parser):
+    parser.add_argument(
+        "--index",
+        dest="index_path",
+        nargs='?',
+        const=config.INDEX_PATH,
+        default=None,
+        help="Record the DICOM files written and sent into an SQLite index, \
+        see 'dicom4ortho {}'. [default index: %(const)s]".format(INDEX),
+        metavar='<filename>',
+    )
+
+
+def index_from_args(args):
+    """ The ArchiveIndex asked for by add_index_argument(), or None. """
+    if args.index_path is None:
+        return None
+    return ArchiveIndex(args.index_path)
+
+
+def cache_from_args(args):
+    """ The ConversionCache asked for by add_cache_arguments(), or None. """
+    if args.cache_directory is None:
+        return None
+    return ConversionCache(args.cache_directory, max_bytes=args.cache_size * 1000000)
 
+
+def commitment_from_args(args, send):
+    """ The StorageCommitment asked for by add_commitment_arguments(), or None. """
+    from dicom4ortho.dicom.commitment import StorageCommitment
+
+    if args.commitment_port is None:
+        if args.purge:
+            raise ValueError("--purge needs --commit")
+        return None
+    if send.get('send_method') != 'dimse':
+        raise ValueError("--commit needs a DIMSE send method")
+    return StorageCommitment.from_send(send, listen_port=args.commitment_port)
+
+
+def add_address_arguments(parser):
+    parser.add_argument(
+        "--socket",
+        dest="socket_path",
+        default=None,
+        help="Unix socket of the conversion service.",
+        metavar='<path>',
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        default=config.SERVE_HOST,
+        help="Host of the conversion service. [default: %(default)s]",
+        metavar='<host>',
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=config.SERVE_PORT,
+        help="Port of the conversion service. [default: %(default)s]",
+        metavar='<port>',
+    )
+
+
+def add_serve_parser(commands):
+    parser = commands.add_parser(
+        SERVE,
+        help="Run the conversion service until interrupted.",
+        description="Keep a pool of conversion workers running and take \
+        conversion jobs over HTTP, on localhost or on a Unix socket.")
+    add_address_arguments(parser)
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes. [default: number of CPUs]",
+        metavar='<N>',
+    )
+    parser.add_argument(
+        "--send-config",
+        dest="send_config",
+        default=None,
+        help="JSON file with the send() arguments to use for every job, \
+        e.g. {\"send_method\": \"dimse\", \"pacs_dimse_hostname\": ...}.",
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        "-d", "--output-dir",
+        dest="output_dir",
+        default=config.SERVE_OUTPUT_DIR,
+        help="The only directory jobs may save DICOM files into. \
+        [default: jobs cannot save files]",
+        metavar='<directory>',
+    )
+    add_cache_arguments(parser)
+    add_metrics_argument(parser)
+    parser.set_defaults(func=serve_main)
+
+
+def serve_main(args):
+    '''Run the conversion service until interrupted.'''
+    from dicom4ortho.server import ConversionServer
+
+    setup_logging(logging.INFO)
+    if args.metrics:
+        metrics.configure(args.metrics)
+
+    send_defaults = None
+    if args.send_config:
+        with open(args.send_config) as send_config:
+            send_defaults = json.load(send_config)
+
+    server = ConversionServer(
+        host=args.host, port=args.port, socket_path=args.socket_path,
+        workers=args.jobs, send_defaults=send_defaults, cache=cache_from_args(args),
+        output_dir=args.output_dir)
     try:
-        # Setup argument parser
-        parser = ArgumentParser(
-            description=program_license, formatter_class=RawDescriptionHelpFormatter)
-        parser.add_argument(
-            "-v", "--verbose",
-            dest="verbose",
-            action="store_true",
-            help="set verbosity level [default: %(default)s]",
-        )
-        parser.add_argument(
-            "--log-level",
-            dest="log_level",
-            default=logging.INFO,
-            type=lambda x: getattr(logging, x.upper()),
-            help="Configure the logging level. Available values: debug, info, \
-            warning, error, critical.",
-        )
-        parser.add_argument(
-            '-V', '--version',
-            action='version',
-            version=program_version_message,
-        )
-        parser.add_argument(
-            "-o", "--output-filename",
-            dest="output_filename",
-            help="Where to store the DICOM file. ",
-            default=None,
-            metavar='<filename>',
-        )
-        parser.add_argument(
-            "-t", "--image-type",
-            dest="image_type",
-            help="Type of image using the abbreviations defined in DENT-OIP. \
-            Run 'dicom4ortho {}' to get a list of allowed image \
-            types. [default: %(default)s]".format(LIST_IMAGE_TYPES),
-            default='EV01',
-            metavar='<image_type>',
-        )
-        parser.add_argument(
-            "--validate",
-            dest="validate",
-            action="store_true",
-            help="Validate DICOM File",
-        )
-        parser.add_argument(
-            dest="input_filename",
-            help="path of file or CSV file with metadata and filename of files \
-            to convert to DICOM",
-            metavar='<filename>',
-        )
-
-        # Process arguments
-        args = parser.parse_args(argv[1:])
-        if args.verbose is True:
-            args.log_level = logging.DEBUG
-        else:
-            args.log_level = logging.INFO
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.close()
+    return 0
 
-        setup_logging(args.log_level)
 
-        logger.debug("passed arguments: %s",argv)
-        for k,v in sorted(vars(args).items()):
-            logger.debug("%s: %s",k,v)
+def add_submit_parser(commands):
+    parser = commands.add_parser(
+        SUBMIT,
+        help="Send one image to a running conversion service.",
+        description="Convert an image with a running 'dicom4ortho serve'.")
+    add_address_arguments(parser)
+    parser.add_argument(
+        "-t", "--image-type",
+        dest="image_type",
+        default='EV01',
+        help="Type of image using the abbreviations defined in DENT-OIP. \
+        [default: %(default)s]",
+        metavar='<image_type>',
+    )
+    parser.add_argument(
+        "--mwl",
+        dest="mwl_filename",
+        default=None,
+        help="DICOM file with the Modality Worklist item of the image.",
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        "-o", "--output-filename",
+        dest="output_filename",
+        default=None,
+        help="Where the service stores the DICOM file, relative to its output directory. \
+        [default: the name of the image, with .dcm]",
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        dest="input_filename",
+        help="Image to convert.",
+        metavar='<filename>',
+    )
+    parser.set_defaults(func=submit_main)
+
+
+def submit_main(args):
+    '''Send one image to a running conversion service.'''
+    from dicom4ortho.server import submit
+
+    with open(args.input_filename, 'rb') as image_file:
+        image_bytes = image_file.read()
+    mwl_bytes = None
+    if args.mwl_filename:
+        with open(args.mwl_filename, 'rb') as mwl_file:
+            mwl_bytes = mwl_file.read()
+    output_filename = args.output_filename or os.path.splitext(os.path.basename(args.input_filename))[0] + '.dcm'
+
+    address = args.socket_path or f"http://{args.host}:{args.port}"
+    result = submit(
+        image_bytes, address=address, metadata={'image_type': args.image_type},
+        mwl_bytes=mwl_bytes, output_filename=output_filename)
+    print(json.dumps(result, indent=2))
+    return 0 if result.get('status') == 'ok' else 1
 
-        if args.input_filename == LIST_IMAGE_TYPES:
-            print_image_types()
-            return 0
 
-        if not os.path.isfile(args.input_filename):
-            logger.error("Cannot locate file %s:",args.input_filename)
+def add_watch_parser(commands):
+    parser = commands.add_parser(
+        WATCH,
+        help="Convert the images written into a folder until interrupted.",
+        description="Watch a folder and convert the images written into it, \
+        once they are completely written.")
+    parser.add_argument(
+        "-t", "--image-type",
+        dest="image_type",
+        default='EV01',
+        help="Type of image for files whose name tells nothing. [default: %(default)s]",
+        metavar='<image_type>',
+    )
+    parser.add_argument(
+        "--image-type-rule",
+        dest="image_type_rules",
+        action="append",
+        type=parse_image_type_rule,
+        default=[],
+        help="Image type for files whose name matches a pattern, as \
+        <pattern>=<image_type>. Can be repeated.",
+        metavar='<pattern>=<image_type>',
+    )
+    parser.add_argument(
+        "-d", "--output-dir",
+        dest="output_dir",
+        default=None,
+        help="Write DICOM files into this directory. [default: next to each image]",
+        metavar='<directory>',
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of images to convert in parallel. [default: %(default)s]",
+        metavar='<N>',
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        default=config.WATCH_QUEUE_SIZE,
+        help="Maximum number of images waiting for conversion. [default: %(default)s]",
+        metavar='<N>',
+    )
+    parser.add_argument(
+        "--settle",
+        dest="settle_seconds",
+        type=float,
+        default=config.WATCH_SETTLE_SECONDS,
+        help="Seconds a file must stay unchanged before it is converted. \
+        [default: %(default)s]",
+        metavar='<seconds>',
+    )
+    parser.add_argument(
+        "--poll",
+        dest="poll",
+        action="store_true",
+        help="Scan the folder instead of using inotify.",
+    )
+    parser.add_argument(
+        "--send-config",
+        dest="send_config",
+        default=None,
+        help="JSON file with the send() arguments to send every converted image with.",
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        "--outbox",
+        dest="outbox_directory",
+        nargs='?',
+        const=config.OUTBOX_DIRECTORY,
+        default=None,
+        help="Queue the converted images into an outbox, sent in the background \
+        with retries, instead of sending each one right away. Needs --send-config. \
+        See 'dicom4ortho {}'. [default outbox: %(const)s]".format(OUTBOX),
+        metavar='<directory>',
+    )
+    parser.add_argument(
+        dest="directory",
+        help="Folder to watch.",
+        metavar='<directory>',
+    )
+    add_commitment_arguments(parser)
+    add_validate_on_write_argument(parser)
+    add_preview_arguments(parser)
+    add_cache_arguments(parser)
+    add_index_argument(parser)
+    add_metrics_argument(parser)
+    parser.set_defaults(func=watch_main)
+
+
+def watch_main(args):
+    '''Convert the images written into a folder until interrupted.'''
+    from dicom4ortho.watch import FolderWatcher
+
+    setup_logging(logging.INFO)
+    if args.metrics:
+        metrics.configure(args.metrics)
+
+    if not os.path.isdir(args.directory):
+        logger.error("Cannot locate directory %s", args.directory)
+        return 1
+    send = None
+    if args.send_config:
+        with open(args.send_config) as send_config:
+            send = json.load(send_config)
+    outbox = None
+    if args.outbox_directory is not None:
+        if send is None:
+            logger.error("--outbox needs --send-config")
+            return 1
+        try:
+            commitment = commitment_from_args(args, send)
+        except ValueError as e:
+            logger.error("%s", e)
             return 1
+        outbox = Outbox(args.outbox_directory, send=send, index=index_from_args(args),
+                        commitment=commitment, purge_source=args.purge)
+        send = None
+    elif args.commitment_port is not None:
+        logger.error("--commit needs --outbox")
+        return 1
 
-        c = controller.OrthodonticController()
+    watcher = FolderWatcher(
+        args.directory,
+        output_dir=args.output_dir,
+        image_type_rules=args.image_type_rules,
+        default_image_type=args.image_type,
+        metadata=preview_metadata_from_args(args),
+        jobs=args.jobs,
+        send=send,
+        queue_size=args.queue_size,
+        settle_seconds=args.settle_seconds,
+        use_inotify=not args.poll,
+        validate=args.validate_on_write,
+        cache=cache_from_args(args),
+        index=index_from_args(args),
+        outbox=outbox)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: watcher.stop())
+    logger.info("Watching %s", args.directory)
+    summary = watcher.run()
+    logger.info("%s", summary)
+    return 0
 
-        if args.validate is True:
-            c.validate_dicom_file(args.input_filename)
-            return 0
-        elif args.input_filename.lower().endswith('.csv'):
-            c.bulk_convert_from_csv(args.input_filename)
+
+def parse_keywords(value):
+    """ Parse a comma separated list of DICOM keywords. """
+    keywords = [keyword.strip() for keyword in value.split(',') if keyword.strip()]
+    for keyword in keywords:
+        if tag_for_keyword(keyword) is None:
+            raise ArgumentTypeError(f"Unknown DICOM keyword '{keyword}'")
+    return keywords
+
+
+def add_dump_parser(commands):
+    parser = commands.add_parser(
+        DUMP,
+        help="Print a summary of each DICOM file, without reading its pixels.",
+        description="Print one JSON line per DICOM file with its main \
+        attributes, reading only the headers. Fast enough for thousands of \
+        files.")
+    parser.add_argument(
+        "-k", "--keywords",
+        dest="keywords",
+        type=parse_keywords,
+        default=None,
+        help="Comma separated DICOM keywords to print. [default: {}]".format(
+            ','.join(config.DUMP_KEYWORDS)),
+        metavar='<keyword,...>',
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of files to read in parallel. [default: %(default)s]",
+        metavar='<N>',
+    )
+    parser.add_argument(
+        dest="inputs",
+        nargs='+',
+        help="DICOM files, directories or glob patterns.",
+        metavar='<filename>',
+    )
+    parser.set_defaults(func=dump_main)
+
+
+def dump_main(args):
+    '''Print a summary of each DICOM file, without reading its pixels.'''
+    setup_logging(logging.WARNING)
+
+    errors = 0
+    for summary in controller.OrthodonticController().dump_dicom_files(
+            args.inputs, keywords=args.keywords, jobs=args.jobs):
+        errors += 'error' in summary
+        print(json.dumps(summary), flush=True)
+    return 1 if errors else 0
+
+
+def add_index_parser(commands):
+    parser = commands.add_parser(
+        INDEX,
+        help="Fill and query the index of DICOM instances.",
+        description="Index DICOM files in SQLite, and find instances and \
+        sessions missing views without reading the files again.")
+    parser.add_argument(
+        "--index",
+        dest="index_path",
+        default=config.INDEX_PATH,
+        help="SQLite index. [default: %(default)s]",
+        metavar='<filename>',
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser(
+        "scan", help="Add DICOM files, directories or glob patterns, reading only their headers.")
+    scan.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of files to read in parallel. [default: %(default)s]",
+        metavar='<N>',
+    )
+    scan.add_argument(
+        "--sha256",
+        dest="sha256",
+        action="store_true",
+        help="Also hash the files, which reads them whole.",
+    )
+    scan.add_argument(dest="inputs", nargs='+', metavar='<filename>')
+
+    filters = ArgumentParser(add_help=False)
+    filters.add_argument("--patient-id", dest="patient_id", default=None, metavar='<id>')
+    filters.add_argument(
+        "--date", dest="session_date", default=None, metavar='<YYYYMMDD>',
+        help="Session date: the StudyDate, or the acquisition date without one.")
+
+    query = commands.add_parser(
+        "query", parents=[filters], help="Print the indexed instances, one JSON line each.")
+    query.add_argument("--view", dest="view", default=None, metavar='<image_type>')
+    query.add_argument("--study-uid", dest="study_instance_uid", default=None, metavar='<uid>')
+    sent = query.add_mutually_exclusive_group()
+    sent.add_argument("--sent", dest="sent", action="store_const", const=True, default=None,
+                      help="Only instances sent to a PACS.")
+    sent.add_argument("--not-sent", dest="sent", action="store_const", const=False,
+                      help="Only instances never sent.")
+    query.add_argument("--limit", dest="limit", type=int, default=None, metavar='<N>')
+
+    missing = commands.add_parser(
+        "missing", parents=[filters],
+        help="Print the sessions missing some of the views, one JSON line each.")
+    missing.add_argument(
+        dest="views",
+        type=lambda x: [view.strip().replace('-', '').upper() for view in x.split(',') if view.strip()],
+        help="Comma separated image types every session should have, e.g. EV01,EV08,IV03.",
+        metavar='<image_type,...>',
+    )
+
+    parser.set_defaults(func=index_main)
+
+
+def index_main(args):
+    '''Fill and query the index of DICOM instances.'''
+    setup_logging(logging.INFO)
+    index = ArchiveIndex(args.index_path)
+    try:
+        if args.command == "scan":
+            filenames = [path for path, _ in controller.expand_input_paths(args.inputs, extensions=('.dcm',))]
+            index.scan(filenames, jobs=args.jobs, sha256=args.sha256)
             return 0
+        if args.command == "query":
+            rows = index.query(
+                patient_id=args.patient_id, session_date=args.session_date, view=args.view,
+                study_instance_uid=args.study_instance_uid, sent=args.sent, limit=args.limit)
+        else:
+            rows = index.missing_views(
+                args.views, patient_id=args.patient_id, session_date=args.session_date)
+        for row in rows:
+            print(json.dumps(row), flush=True)
+        return 0
+    finally:
+        index.close()
+
+
+def add_outbox_parser(commands):
+    parser = commands.add_parser(
+        OUTBOX,
+        help="Queue DICOM files into the outbox, and send them to a PACS.",
+        description="Queue DICOM files on local disk and send them to a PACS \
+        in the background, in order within each study, retrying with backoff \
+        while the PACS is unreachable.")
+    parser.add_argument(
+        "--outbox",
+        dest="outbox_directory",
+        default=config.OUTBOX_DIRECTORY,
+        help="Outbox directory. [default: %(default)s]",
+        metavar='<directory>',
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser(
+        "enqueue", help="Queue copies of DICOM files, directories or glob patterns.")
+    enqueue.add_argument(dest="inputs", nargs='+', metavar='<filename>')
+
+    drain = commands.add_parser("drain", help="Send the queued files, until interrupted.")
+    drain.add_argument(
+        "--send-config",
+        dest="send_config",
+        required=True,
+        help="JSON file with the send() arguments to send with.",
+        metavar='<filename>',
+    )
+    drain.add_argument(
+        "-w", "--workers",
+        dest="workers",
+        type=int,
+        default=config.OUTBOX_WORKERS,
+        help="Number of studies sent in parallel. [default: %(default)s]",
+        metavar='<N>',
+    )
+    drain.add_argument(
+        "--once",
+        dest="once",
+        action="store_true",
+        help="Send what is due once, then exit instead of waiting for more. \
+        With --commit, wait for the PACS to commit to what was sent first.",
+    )
+    add_commitment_arguments(drain)
+    add_index_argument(drain)
+
+    commands.add_parser(
+        "status", help="Print the number of files pending, failing, sent and committed, as JSON.")
+
+    parser.set_defaults(func=outbox_main)
+
+
+def outbox_main(args):
+    '''Queue DICOM files into the outbox, and send them to a PACS.'''
+    setup_logging(logging.INFO)
+    if args.command == "drain":
+        with open(args.send_config) as send_config:
+            send = json.load(send_config)
+        try:
+            commitment = commitment_from_args(args, send)
+        except ValueError as e:
+            logger.error("%s", e)
+            return 1
+        outbox = Outbox(args.outbox_directory, send=send, index=index_from_args(args),
+                        commitment=commitment, purge_source=args.purge)
+    else:
+        outbox = Outbox(args.outbox_directory)
+    if args.command == "enqueue":
+        queued = 0
+        for path, _ in controller.expand_input_paths(args.inputs, extensions=('.dcm',)):
+            queued += outbox.enqueue(path)
+        logger.info("Queued %d files", queued)
+    elif args.command == "drain":
+        if args.once:
+            outbox.start_commitment()
+            outbox.drain()
+            if commitment is not None:
+                if not outbox.wait_committed(config.COMMITMENT_TIMEOUT):
+                    logger.warning("The PACS did not commit to everything sent yet")
+                commitment.shutdown()
         else:
-            c.convert_image_to_dicom4orthograph_and_save({
-                'image_type': args.image_type,
-                'input_image_filename': args.input_filename,
-                'output_image_filename': args.output_filename})
-            c.photo.print()
+            stopped = threading.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: stopped.set())
+            outbox.start(args.workers)
+            stopped.wait()
+            outbox.stop()
+    print(json.dumps(outbox.status()), flush=True)
+    return 0
+
+
+def add_receive_parser(commands):
+    parser = commands.add_parser(
+        RECEIVE,
+        help="Receive photographs over DICOM, tag them and store or forward them.",
+        description="Run a DICOM Storage SCP which takes the photographs \
+        modalities send, sets their DENT-OIP attributes by routing rules, \
+        without decoding their pixels, and stores them, optionally \
+        forwarding them to a PACS through the outbox.")
+    parser.add_argument(
+        "-d", "--output-dir",
+        dest="output_dir",
+        required=True,
+        help="Store the instances received into this directory, one sub directory per study.",
+        metavar='<directory>',
+    )
+    parser.add_argument(
+        "--aet",
+        dest="ae_title",
+        default=config.RECEIVE_AE_TITLE,
+        help="AE Title to receive as. [default: %(default)s]",
+        metavar='<aet>',
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        default=config.RECEIVE_HOST,
+        help="Address to listen on. [default: %(default)s]",
+        metavar='<host>',
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=config.RECEIVE_PORT,
+        help="Port to listen on. [default: %(default)s]",
+        metavar='<port>',
+    )
+    parser.add_argument(
+        "--route",
+        dest="routes",
+        action="append",
+        type=parse_route,
+        default=[],
+        help="Image type of the instances whose DICOM attribute, or {}, \
+        matches a pattern, as <keyword>:<pattern>=<image_type>. The first \
+        matching rule wins. Can be repeated.".format(CALLING_AE_TITLE),
+        metavar='<keyword>:<pattern>=<image_type>',
+    )
+    parser.add_argument(
+        "-t", "--image-type",
+        dest="image_type",
+        default=None,
+        help="Image type of the instances matching no route. [default: leave them unchanged]",
+        metavar='<image_type>',
+    )
+    parser.add_argument(
+        "--send-config",
+        dest="send_config",
+        default=None,
+        help="JSON file with the send() arguments to forward every instance with, through the outbox.",
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        "--outbox",
+        dest="outbox_directory",
+        default=config.OUTBOX_DIRECTORY,
+        help="Outbox directory to forward through. [default: %(default)s]",
+        metavar='<directory>',
+    )
+    add_commitment_arguments(parser)
+    add_write_arguments(parser)
+    add_index_argument(parser)
+    add_metrics_argument(parser)
+    parser.set_defaults(func=receive_main)
+
+
+def receive_main(args):
+    '''Receive photographs over DICOM, tag them and store or forward them.'''
+    from dicom4ortho.receiver import StorageReceiver
+
+    setup_logging(logging.INFO)
+    if args.metrics:
+        metrics.configure(args.metrics)
+
+    index = index_from_args(args)
+    outbox = None
+    if args.send_config:
+        with open(args.send_config) as send_config:
+            send = json.load(send_config)
+        try:
+            commitment = commitment_from_args(args, send)
+        except ValueError as e:
+            logger.error("%s", e)
+            return 1
+        outbox = Outbox(args.outbox_directory, send=send, index=index,
+                        commitment=commitment, purge_source=args.purge)
+    elif args.commitment_port is not None:
+        logger.error("--commit needs --send-config")
+        return 1
+    receiver = StorageReceiver(
+        args.output_dir,
+        routes=args.routes,
+        default_image_type=args.image_type and args.image_type.replace('-', ''),
+        outbox=outbox,
+        index=index,
+        # A receiver has no end of batch to sync at
+        fsync=FSYNC_FILE if args.fsync == FSYNC_BATCH else args.fsync,
+        direct_io=args.direct_io,
+        ae_title=args.ae_title,
+        host=args.host,
+        port=args.port)
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopped.set())
+    receiver.start()
+    stopped.wait()
+    receiver.shutdown()
+    return 0
+
+
+def add_worklist_parser(commands):
+    parser = commands.add_parser(
+        WORKLIST,
+        help="Query a Modality Worklist SCP.",
+        description="Query a Modality Worklist SCP and print one JSON line \
+        per scheduled item. See dicom4ortho.dicom.worklist.WorklistCache to \
+        keep the worklist cached locally.")
+    parser.add_argument("--host", dest="host", required=True, help="Host of the MWL SCP.", metavar='<host>')
+    parser.add_argument("--port", dest="port", type=int, required=True, help="Port of the MWL SCP.",
+                        metavar='<port>')
+    parser.add_argument("--aet", dest="ae_title", required=True, help="AE Title of the MWL SCP.",
+                        metavar='<aet>')
+    parser.add_argument(
+        "--local-aet",
+        dest="local_aet",
+        default=config.PROJECT_NAME.upper(),
+        help="AE Title to query as. [default: %(default)s]",
+        metavar='<aet>',
+    )
+    parser.add_argument("--patient-id", dest="PatientID", default=None, metavar='<id>')
+    parser.add_argument("--accession-number", dest="AccessionNumber", default=None, metavar='<number>')
+    parser.add_argument(
+        "--date", dest="ScheduledProcedureStepStartDate", default=None, metavar='<YYYYMMDD[-YYYYMMDD]>',
+        help="Scheduled date, or range of dates.")
+    parser.add_argument("--modality", dest="Modality", default=None, metavar='<modality>')
+    parser.add_argument("--station-aet", dest="ScheduledStationAETitle", default=None, metavar='<aet>')
+    parser.set_defaults(func=worklist_main)
+
+
+def worklist_main(args):
+    '''Query a Modality Worklist SCP.'''
+    from dicom4ortho.dicom.worklist import WorklistClient, WorklistError, summary
+
+    setup_logging(logging.WARNING)
+
+    filters = {keyword: value for keyword, value in vars(args).items()
+               if keyword[0].isupper() and value is not None}
+    client = WorklistClient(args.host, args.port, args.ae_title, local_aet=args.local_aet)
+    try:
+        items = client.find(**filters)
+    except WorklistError as e:
+        logger.error("%s", e)
+        return 1
+    for item in items:
+        print(json.dumps(summary(item)), flush=True)
+    return 0
+
+
+def add_convert_parser(commands):
+    parser = commands.add_parser(
+        CONVERT,
+        help="Convert images to DICOM. The default command.",
+        description="Convert images, or the images listed in a CSV file, to \
+        DICOM. Several files, directories or glob patterns are converted as \
+        a batch.")
+    parser.add_argument(
+        "-v", "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="set verbosity level [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        default=logging.INFO,
+        type=lambda x: getattr(logging, x.upper()),
+        help="Configure the logging level. Available values: debug, info, \
+        warning, error, critical.",
+    )
+    parser.add_argument(
+        "-o", "--output-filename",
+        dest="output_filename",
+        help="Where to store the DICOM file. ",
+        default=None,
+        metavar='<filename>',
+    )
+    parser.add_argument(
+        "-t", "--image-type",
+        dest="image_type",
+        help="Type of image using the abbreviations defined in DENT-OIP. \
+        Run 'dicom4ortho {}' to get a list of allowed image \
+        types. [default: %(default)s]".format(LIST_IMAGE_TYPES),
+        default='EV01',
+        metavar='<image_type>',
+    )
+    parser.add_argument(
+        "--validate",
+        dest="validate",
+        action="store_true",
+        help="Validate DICOM files, directories or glob patterns against the \
+        VL Photographic Image IOD and DENT-OIP. Prints one JSON result \
+        per file.",
+    )
+    parser.add_argument(
+        "--image-type-rule",
+        dest="image_type_rules",
+        action="append",
+        type=parse_image_type_rule,
+        default=[],
+        help="Image type for files whose name matches a pattern, as \
+        <pattern>=<image_type>, e.g. '*_smile.jpg=EV08'. Can be repeated; \
+        the first matching rule wins. Files matching no rule use the view \
+        at the start of their name, like EV-01_..., or --image-type.",
+        metavar='<pattern>=<image_type>',
+    )
+    parser.add_argument(
+        "-d", "--output-dir",
+        dest="output_dir",
+        help="Write DICOM files into this directory, reproducing the \
+        layout of the input directories. [default: next to each image]",
+        default=None,
+        metavar='<directory>',
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of images to convert in parallel. [default: %(default)s]",
+        metavar='<N>',
+    )
+    parser.add_argument(
+        dest="input_filenames",
+        nargs='+',
+        help="path of file or CSV file with metadata and filename of files \
+        to convert to DICOM. Directories and glob patterns convert all \
+        images in them.",
+        metavar='<filename>',
+    )
+    add_validate_on_write_argument(parser)
+    add_write_arguments(parser)
+    add_preview_arguments(parser)
+    add_cache_arguments(parser)
+    add_index_argument(parser)
+    add_metrics_argument(parser)
+    parser.set_defaults(func=convert_main)
+
+
+def convert_main(args):
+    '''Convert images to DICOM.'''
+    if args.verbose is True:
+        args.log_level = logging.DEBUG
+    else:
+        args.log_level = logging.INFO
+
+    setup_logging(args.log_level)
+    if args.metrics:
+        metrics.configure(args.metrics)
+
+    for k,v in sorted(vars(args).items()):
+        logger.debug("%s: %s",k,v)
+
+    if args.input_filenames == [LIST_IMAGE_TYPES]:
+        print_image_types()
+        return 0
+
+    c = controller.OrthodonticController()
+
+    if args.validate is True:
+        results = c.validate_dicom_files(args.input_filenames, jobs=args.jobs)
+        for result in results:
+            print(json.dumps(result.to_dict()))
+        return 0 if results and all(result.is_valid for result in results) else 1
+
+    index = index_from_args(args)
+    try:
+        return convert(c, args, index)
+    finally:
+        if index is not None:
+            index.close()
+
+
+def convert(c, args, index):
+    if is_batch(args):
+        summary = c.bulk_convert_images(
+            args.input_filenames,
+            output_dir=args.output_dir,
+            image_type_rules=args.image_type_rules,
+            default_image_type=args.image_type,
+            jobs=args.jobs,
+            metadata=preview_metadata_from_args(args),
+            validate=args.validate_on_write,
+            fsync=args.fsync,
+            direct_io=args.direct_io,
+            cache=cache_from_args(args),
+            index=index)
+        logger.info("%s", summary)
+        return 0 if summary.images and not summary.failures and not summary.validation.invalid else 1
+
+    args.input_filename = args.input_filenames[0]
+    if not os.path.isfile(args.input_filename):
+        logger.error("Cannot locate file %s:",args.input_filename)
+        return 1
+
+    if args.input_filename.lower().endswith('.csv'):
+        if args.cache_directory is not None or index is not None:
+            logger.error("--cache and --index do not apply to CSV files")
+            return 1
+        c.bulk_convert_from_csv(args.input_filename)
+        return 0
+
+    metadata = {
+        'image_type': args.image_type,
+        'input_image_filename': args.input_filename,
+        'output_image_filename': args.output_filename or os.path.splitext(args.input_filename)[0] + '.dcm',
+        'validate': args.validate_on_write,
+        # A single file is a batch of one
+        'fsync': FSYNC_FILE if args.fsync == FSYNC_BATCH else args.fsync,
+        'direct_io': args.direct_io,
+        'index': index,
+        **preview_metadata_from_args(args)}
+    try:
+        if args.cache_directory is not None:
+            controller.convert_image_file(dict(metadata, cache=cache_from_args(args)))
+            logger.info("Converted %s to %s", args.input_filename, metadata['output_image_filename'])
             return 0
+        c.convert_image_to_dicom4orthograph_and_save(metadata)
+    except ValidationError as e:
+        logger.error("%s", e)
+        return 1
+    c.photo.print()
+    return 0
+
+
+def build_parser():
+    program_version = "v%s" % config.VERSION
+    program_version_message = '%%(prog)s %s' % (program_version)
+    program_license = '''{short_description}
+
+USAGE
+'''.format(
+        short_description=config.__short_description__,
+        creation_date=config.__creation_date__)
+
+    parser = ArgumentParser(
+        prog=config.PROJECT_NAME,
+        description=program_license, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-V', '--version',
+        action='version',
+        version=program_version_message,
+    )
+    commands = parser.add_subparsers(dest="subcommand", metavar='<command>')
+    for add_parser in (add_convert_parser, add_serve_parser, add_submit_parser, add_watch_parser,
+                       add_dump_parser, add_index_parser, add_outbox_parser, add_receive_parser,
+                       add_worklist_parser):
+        add_parser(commands)
+    return parser
+
 
+def main(argv=None):
+    '''Command line options.'''
+    if argv is None:
+        argv = sys.argv
+    else:
+        sys.argv.extend(argv)
+
+    argv = list(argv[1:])
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help', '-V', '--version'):
+        # Converting needs no command name
+        argv.insert(0, CONVERT)
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
     except KeyboardInterrupt:
         ### handle keyboard interrupt ###
         return 120
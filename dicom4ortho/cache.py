@@ -0,0 +1,204 @@
+""" On disk cache of converted photographs, keyed by their content.
+
+The same photograph often comes in twice, re-exported or uploaded again
+after a retry. Converting it again would give a new DICOM instance with new
+random UIDs, which the PACS stores as a duplicate. With a ConversionCache,
+the second time returns the DICOM file of the first.
+
+Entries are keyed by the SHA-256 of the image bytes and of the metadata,
+normalized so that file names, output options and the spelling of the image
+type do not matter. The UIDs of a new entry are derived from its key, so
+that even once an entry is evicted the same photograph converts to the same
+instance, in the same series and study.
+
+The cache is a directory of DICOM files, <key[:2]>/<key>.dcm. A hit
+refreshes the modification time of its file, and the least recently used
+files are removed once the cache grows past max_bytes. Several processes
+can share a cache directory: each keeps its own estimate of the size, and
+writes are atomic.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+from pydicom.dataset import Dataset
+
+from dicom4ortho import config, metrics
+from dicom4ortho.m_modality_worklist import ModalityWorklistTags
+from dicom4ortho.utils import uid_allocator
+from dicom4ortho.writer import FSYNC_NONE, FileWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metadata which does not change the DICOM file, or is the image itself.
+_IGNORED_METADATA = frozenset((
+    'input_image_filename',
+    'input_image_bytes',
+    'output_image_filename',
+    'sop_instance_uid',
+    'cache',
+    'file_writer',
+    'fsync',
+    'direct_io',
+    'validate',
+    'validation_report',
+    'stage_hook',
+    'index',
+    'preview',
+    'preview_filename',
+    'preview_size',
+    'preview_quality',
+))
+
+# Once over max_bytes, evict down to this fraction of it, so that eviction
+# does not run on every new entry.
+_EVICT_TO = 0.9
+
+
+def _normalize(key, value):
+    if isinstance(value, ModalityWorklistTags):
+        value = value.dicom_mwl
+    if isinstance(value, Dataset):
+        return value.to_json_dict()
+    value = str(value).strip()
+    if key == 'image_type':
+        value = value.replace('-', '').upper()
+    return value
+
+
+class ConversionCache(object):
+    """ Converted DICOM files in directory, at most max_bytes of them.
+
+    Defaults are config.CACHE_DIRECTORY and config.CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = os.fspath(directory or config.CACHE_DIRECTORY)
+        self.max_bytes = max_bytes or config.CACHE_MAX_BYTES
+        self._size = None
+
+    def key(self, image_bytes, metadata=None) -> str:
+        """ Hex SHA-256 of the image bytes and the normalized metadata. """
+        normalized = {
+            key: _normalize(key, value) for key, value in (metadata or {}).items()
+            if key not in _IGNORED_METADATA and value is not None and value != ''}
+        digest = hashlib.sha256(image_bytes)
+        digest.update(json.dumps(normalized, sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def sop_instance_uid(key) -> str:
+        """ The SOPInstanceUID of the DICOM file of key. """
+        return uid_allocator(config.SOPInstanceUID_ROOT).from_hash(bytes.fromhex(key))
+
+    def uids(self, key, metadata=None) -> dict:
+        """ The UIDs of the DICOM file of key, as OrthodonticPhotograph arguments.
+
+        The Study and Series Instance UIDs are left to metadata when it
+        sets them, and the Study Instance UID to its Modality Worklist.
+        """
+        metadata = metadata or {}
+        uids = {'sop_instance_uid': self.sop_instance_uid(key)}
+        mwl = metadata.get('dicom_mwl')
+        if isinstance(mwl, ModalityWorklistTags):
+            mwl = mwl.dicom_mwl
+        if not metadata.get('study_instance_uid') and not (mwl is not None and mwl.get('StudyInstanceUID')):
+            uids['study_instance_uid'] = uid_allocator(config.StudyInstanceUID_ROOT).from_hash(
+                bytes.fromhex(key), 'study')
+        if not metadata.get('series_instance_uid'):
+            uids['series_instance_uid'] = uid_allocator(config.SeriesInstanceUID_ROOT).from_hash(
+                bytes.fromhex(key), 'series')
+        return uids
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.dcm")
+
+    def get(self, key) -> Optional[str]:
+        """ The path of the DICOM file of key, or None if not cached. """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            metrics.count('cache_misses')
+            return None
+        metrics.count('cache_hits')
+        logger.debug("Cache hit %s", key)
+        return path
+
+    def put(self, key, write) -> str:
+        """ Cache a DICOM file. Returns its path.
+
+        write: callable(fp) writing the DICOM file into fp, like
+        DicomBase.write_to.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._added(FileWriter(fsync=FSYNC_NONE).write(path, write))
+        return path
+
+    def put_file(self, key, filename) -> str:
+        """ Cache a copy of the DICOM file filename. Returns its path.
+
+        The copy is a hard link where possible. Files are always replaced
+        rather than changed, so the cache and filename stay independent.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.link(filename, temporary)
+        except OSError:
+            shutil.copyfile(filename, temporary)
+        os.replace(temporary, path)
+        self._added(os.path.getsize(path))
+        return path
+
+    def copy(self, key, filename) -> int:
+        """ Write the cached DICOM file of key to filename, atomically. Returns its length. """
+        with open(self.path(key), 'rb') as cached:
+            return FileWriter().write(filename, lambda fp: shutil.copyfileobj(cached, fp, config.SAVE_BUFFER_SIZE))
+
+    def size(self) -> int:
+        """ Bytes in the cache. """
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        try:
+            subdirectories = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for subdirectory in subdirectories:
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith('.dcm'):
+                        yield entry
+
+    def _added(self, length):
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += length
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used files, until the cache is well below max_bytes. """
+        entries = sorted(((entry.stat(), entry.path) for entry in self._entries()),
+                         key=lambda stat_path: stat_path[0].st_mtime_ns)
+        size = sum(stat.st_size for stat, _ in entries)
+        target = self.max_bytes * _EVICT_TO
+        for stat, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= stat.st_size
+            metrics.count('cache_evictions')
+            logger.debug("Evicted %s from the cache", path)
+        self._size = size
@@ -2,6 +2,7 @@
 Configurations, defaults and constants
 """
 
+import os
 import re
 from pathlib import Path
 import importlib.resources as importlib_resources
@@ -54,6 +55,12 @@ MediaStorageSOPInstanceUID_ROOT = f"{DICOM4ORTHO_ROOT_UID}.1"
 StudyInstanceUID_ROOT = f"{DICOM4ORTHO_ROOT_UID}.2"
 SeriesInstanceUID_ROOT = f"{DICOM4ORTHO_ROOT_UID}.3"
 SOPInstanceUID_ROOT = f"{DICOM4ORTHO_ROOT_UID}.4"
+PerformedProcedureStepUID_ROOT = f"{DICOM4ORTHO_ROOT_UID}.5"
+
+# Maximum length of a UID (PS3.5 9.1)
+UID_MAX_LENGTH = 64
+# How many random UIDs utils.UIDAllocator prepares at once.
+UID_BATCH_SIZE = 256
  
 
 # The default IDs used for SeriesNumber StudyID and InstanceNumber
@@ -62,3 +69,106 @@ IDS_NUMBERS = '000'
 # This is populated by controller.OrthodonticController._load_image_types()
 image_types = {}
 
+
+# Where `dicom4ortho serve` listens when neither a port nor a socket is given.
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8710
+# The only directory jobs of `dicom4ortho serve` may save DICOM files into. None: jobs cannot save files.
+SERVE_OUTPUT_DIR = None
+
+# `dicom4ortho watch`: a new file is converted once its size and modification
+# time have not changed for WATCH_SETTLE_SECONDS. Without inotify, the folder
+# is scanned every WATCH_POLL_INTERVAL seconds. At most WATCH_QUEUE_SIZE
+# files wait for a worker.
+WATCH_SETTLE_SECONDS = 2.0
+WATCH_POLL_INTERVAL = 1.0
+WATCH_QUEUE_SIZE = 64
+
+# DicomBase.save() writes through a dicom4ortho.writer.FileWriter. When the
+# files reach the disk: 'none', 'file' or 'batch', see dicom4ortho.writer.
+SAVE_FSYNC = 'none'
+# Bytes written at once. Large writes matter on network storage.
+SAVE_BUFFER_SIZE = 1 << 20
+# Bypass the page cache with O_DIRECT where supported.
+SAVE_DIRECT_IO = False
+
+# Multi-frame PixelData larger than this gets an Extended Offset Table rather
+# than a Basic Offset Table, whose offsets are 32 bit.
+EXTENDED_OFFSET_TABLE_THRESHOLD = 0xFFFFFFFF
+
+# dicom4ortho.cache.ConversionCache of already converted photographs.
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'dicom4ortho')
+CACHE_MAX_BYTES = 1 << 30
+
+# Reduced versions of each photograph, see dicom4ortho.preview. Icons go into
+# the Icon Image Sequence, previews into a JPEG file next to the DICOM file.
+ICON_IMAGE = False
+ICON_SIZE = 128
+PREVIEW_SIZE = 512
+PREVIEW_QUALITY = 85
+PREVIEW_SUFFIX = '.preview.jpg'
+
+# Attributes `dicom4ortho dump` lists for each DICOM file.
+DUMP_KEYWORDS = (
+    'SOPInstanceUID',
+    'PatientID',
+    'PatientName',
+    'StudyDate',
+    'AcquisitionDateTime',
+    'SeriesDescription',
+    'ImageComments',
+    'Rows',
+    'Columns',
+    'NumberOfFrames',
+    'LossyImageCompression',
+)
+
+# dicom4ortho.index.ArchiveIndex of the instances written and sent.
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.local', 'share', 'dicom4ortho', 'index.sqlite')
+
+# dicom4ortho.outbox.Outbox of the DICOM files waiting to be sent.
+OUTBOX_DIRECTORY = os.path.join(os.path.expanduser('~'), '.local', 'share', 'dicom4ortho', 'outbox')
+# Threads sending from the outbox, each one study at a time.
+OUTBOX_WORKERS = 2
+# Instances of a study sent over one association or request.
+OUTBOX_BATCH_SIZE = 50
+# Seconds before retrying a failed send, doubling on each failure up to OUTBOX_MAX_BACKOFF.
+OUTBOX_BACKOFF = 5.0
+OUTBOX_MAX_BACKOFF = 600.0
+# Seconds between checks of the outbox when nothing wakes the workers up.
+OUTBOX_POLL_INTERVAL = 1.0
+# dicom4ortho.writer fsync policy of the queued files: 'file' so that nothing queued is lost on a crash.
+OUTBOX_FSYNC = 'file'
+
+# dicom4ortho.receiver.StorageReceiver, a Storage SCP. 11112 is the registered DICOM port which needs no privileges.
+RECEIVE_AE_TITLE = PROJECT_NAME.upper()
+RECEIVE_HOST = '0.0.0.0'
+RECEIVE_PORT = 11112
+# Associations handled at the same time, each in its own thread.
+RECEIVE_MAX_ASSOCIATIONS = 32
+
+# dicom4ortho.dicom.worklist.WorklistCache: seconds before a cached Modality Worklist item expires,
+# seconds between refreshes of each scheduled date, and days after today to keep.
+WORKLIST_TTL = 600
+WORKLIST_REFRESH_INTERVAL = 60
+WORKLIST_DAYS_AHEAD = 1
+# Seconds to wait for the Modality Worklist SCP.
+WORKLIST_TIMEOUT = 10
+
+# dicom4ortho.dicom.mpps.MPPSReporter: Modality of the Performed Procedure Steps, XC for External-camera
+# Photography, and seconds of idleness after which its association is released.
+MPPS_MODALITY = 'XC'
+MPPS_IDLE_SECONDS = 30
+# Times a message is sent again when the MPPS SCP cannot be reached, and seconds before the first retry,
+# doubling on each failure up to MPPS_MAX_BACKOFF.
+MPPS_RETRIES = 5
+MPPS_BACKOFF = 5.0
+MPPS_MAX_BACKOFF = 300.0
+
+# dicom4ortho.dicom.commitment.StorageCommitment: where the PACS sends its N-EVENT-REPORTs to.
+COMMITMENT_HOST = '0.0.0.0'
+COMMITMENT_PORT = 11113
+# Seconds to wait for the PACS to answer an N-ACTION.
+COMMITMENT_TIMEOUT = 30
+# Seconds after which a commitment request the PACS did not report on is sent again.
+COMMITMENT_REPORT_TIMEOUT = 3600
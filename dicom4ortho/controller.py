@@ -3,17 +3,238 @@ Controller
 """
 import os
 import csv
+import fnmatch
+import glob
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator, List
 from pydicom.dataset import Dataset
 
-from dicom4ortho.config import DICOM3TOOLS_PATH
-from dicom4ortho.model import DicomBase
+from dicom4ortho import config, metrics, preview
+from dicom4ortho.config import StudyInstanceUID_ROOT
+from dicom4ortho.m_modality_worklist import ModalityWorklistTags
 from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph, OrthodonticSeries
+from dicom4ortho.utils import generate_dicom_uid
+from dicom4ortho import validation
+from dicom4ortho.validation import ValidationReport, ValidationResult, validate_dataset, validate_file, validate_files
+from dicom4ortho.dump import read_header, summaries
+from dicom4ortho.writer import FSYNC_BATCH, FSYNC_NONE, FileWriter, fsync_files
+from dicom4ortho._generated_codes import VIEWS
 from dicom4ortho.dicom import wado, dimse
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, get_status_classification
 
 import logging
 logger = logging.getLogger(__name__)
 
+# File extensions picked up when a directory is converted.
+IMAGE_FILE_EXTENSIONS = ('.jpg', '.jpeg', '.mpo', '.png', '.jp2', '.j2k', '.tif', '.tiff', '.bmp')
+
+# Image type at the start of a file name, e.g. EV-01_EO.RP.LR.CO.png or IV25.jpg
+_FILENAME_IMAGE_TYPE = re.compile(r'^([EI]V)-?(\d\d)(?![0-9])', re.IGNORECASE)
+
+
+def is_image_file(path, extensions=IMAGE_FILE_EXTENSIONS) -> bool:
+    """ Whether path has one of extensions and is not a preview dicom4ortho wrote. """
+    path = Path(path)
+    return path.suffix.lower() in extensions and not path.name.lower().endswith(config.PREVIEW_SUFFIX)
+
+
+def expand_input_paths(inputs, extensions=IMAGE_FILE_EXTENSIONS):
+    """ Expand files, directories and glob patterns into image files.
+
+    Directories are searched for files with one of extensions.
+
+    Returns a list of (image file, base directory) tuples. The base
+    directory is the directory that was given, so the layout below it can
+    be reproduced in an output directory; for files and globs it is the
+    parent of the file.
+    """
+    expanded = []
+    for _input in inputs:
+        if os.path.isdir(_input):
+            base = Path(_input)
+            expanded.extend(
+                (path, base) for path in sorted(base.rglob('*'))
+                if path.is_file() and is_image_file(path, extensions))
+        elif os.path.isfile(_input):
+            expanded.append((Path(_input), Path(_input).parent))
+        else:
+            matches = sorted(glob.glob(_input, recursive=True))
+            if not matches:
+                logger.warning("Nothing matches %s", _input)
+            expanded.extend(
+                (Path(match), Path(match).parent) for match in matches if os.path.isfile(match))
+    return expanded
+
+
+def image_type_for_filename(filename, image_type_rules=(), default_image_type=None):
+    """ Pick the image type of a file from its name.
+
+    image_type_rules is a sequence of (pattern, image type) tuples; the
+    first fnmatch pattern matching the file name wins. Otherwise a view
+    keyword at the start of the file name is used, as in EV-01_EO.RP.LR.CO.png.
+    Falls back to default_image_type.
+    """
+    name = Path(filename).name
+    for pattern, image_type in image_type_rules:
+        if fnmatch.fnmatch(name, pattern):
+            return image_type
+    match = _FILENAME_IMAGE_TYPE.match(name)
+    if match:
+        keyword = (match.group(1) + match.group(2)).upper()
+        if keyword in VIEWS:
+            return keyword
+    return default_image_type
+
+
+def image_file_metadata(input_path, base=None, output_dir=None, image_type_rules=(), default_image_type=None, metadata=None):
+    """ Metadata to convert the image file input_path.
+
+    The DICOM file goes next to the image, or into output_dir at the same
+    place relative to output_dir as input_path is to base. The image type
+    comes from image_type_for_filename(). metadata is copied in first.
+    """
+    input_path = Path(input_path)
+    output_path = input_path.with_suffix('.dcm')
+    if output_dir is not None:
+        output_path = Path(output_dir) / output_path.relative_to(base or input_path.parent)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+    image_metadata = dict(metadata or {})
+    image_metadata.update({
+        'input_image_filename': str(input_path),
+        'output_image_filename': str(output_path),
+        'image_type': image_type_for_filename(
+            input_path, image_type_rules, default_image_type),
+    })
+    return image_metadata
+
+
+def convert_image_file(metadata, send=None):
+    """ Convert and save one image.
+
+    Returns (bytes in, bytes out, validation result, seconds spent writing).
+
+    send: arguments of OrthodonticController.send() to send the DICOM file
+    with once saved.
+
+    If metadata has 'validate', the DICOM file is validated before writing
+    and saved even if invalid, so that the issues of a whole batch can be
+    reported together. The validation result is None otherwise.
+
+    If metadata has a 'cache', a dicom4ortho.cache.ConversionCache, an image
+    converted before is copied from it rather than converted again. Its
+    preview, if asked for, is made from the image again.
+
+    If metadata has an 'index', a dicom4ortho.index.ArchiveIndex, the DICOM
+    file is recorded into it, and so is its sending.
+
+    Module level so that it can run in a worker process.
+    """
+    metadata = dict(metadata)
+    cache = metadata.pop('cache', None)
+    index = metadata.get('index')
+    if send and index is not None:
+        send = dict(send, index=index)
+    if cache is not None:
+        with open(metadata['input_image_filename'], 'rb') as image_file:
+            metadata['input_image_bytes'] = image_file.read()
+        key = cache.key(metadata['input_image_bytes'], metadata)
+        if cache.get(key) is not None:
+            start = time.perf_counter()
+            bytes_out = cache.copy(key, metadata['output_image_filename'])
+            if metadata.get('preview') or metadata.get('preview_filename'):
+                preview_bytes = preview.jpeg_preview(
+                    metadata['input_image_bytes'], metadata.get('preview_size'), metadata.get('preview_quality'))
+                FileWriter().write(
+                    metadata.get('preview_filename') or preview.filename_for(metadata['output_image_filename']),
+                    lambda fp: fp.write(preview_bytes))
+            write_seconds = time.perf_counter() - start
+            logger.info("%s was converted before, copied from the cache", metadata['input_image_filename'])
+            if index is not None:
+                index.add_file(metadata['output_image_filename'])
+            if send:
+                OrthodonticController().send(dicom_files=[metadata['output_image_filename']], **send)
+            return len(metadata['input_image_bytes']), bytes_out, None, write_seconds
+        metadata.update(cache.uids(key, metadata))
+
+    photo = OrthodonticPhotograph(validation_report=ValidationReport(), **metadata)
+    photo.save()
+    if cache is not None:
+        cache.put_file(key, metadata['output_image_filename'])
+    if send:
+        OrthodonticController().send(dicom_files=[metadata['output_image_filename']], **send)
+    return (os.path.getsize(metadata['input_image_filename']),
+            os.path.getsize(metadata['output_image_filename']),
+            photo.validation_result,
+            photo.file_writer.seconds)
+
+
+def _without_output_collisions(all_metadata):
+    """ Split the metadata of images into those with their own output file, and (metadata, error) of the others. """
+    by_output = {}
+    for image_metadata in all_metadata:
+        by_output.setdefault(os.path.abspath(image_metadata['output_image_filename']), []).append(image_metadata)
+    unique, colliding = [], []
+    for output, group in by_output.items():
+        if len(group) == 1:
+            unique.extend(group)
+            continue
+        inputs = ', '.join(image_metadata['input_image_filename'] for image_metadata in group)
+        for image_metadata in group:
+            colliding.append((image_metadata, ValueError(f"{inputs} would all be written to {output}")))
+    return unique, colliding
+
+
+def _record_sent(index, destination, dicom_files=None, dicom_datasets=None):
+    """ Record a successful send into index. A failure is logged: the PACS has the files all the same. """
+    try:
+        index.record_sent(destination, dicom_files=dicom_files, dicom_datasets=dicom_datasets)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Sent to %s, but could not record it into the index: %s", destination, e)
+
+
+def _log_validation_result(result: ValidationResult):
+    for issue in result.issues:
+        logger.log(logging.ERROR if issue.severity == validation.ERROR else logging.WARNING,
+                   "%s: %s", result.source, issue)
+    if result.is_valid:
+        logger.info("%s is valid", result.source)
+
+
+class BatchSummary(object):
+    """ Throughput of a bulk conversion, and the validation results if validated on write. """
+
+    def __init__(self):
+        self.images = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.write_seconds = 0.0
+        self.validation = ValidationReport()
+
+    def add(self, result):
+        """ Count the result of convert_image_file(). """
+        bytes_in, bytes_out, validation_result, write_seconds = result
+        self.images += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.write_seconds += write_seconds
+        self.validation.add(validation_result)
+
+    def __str__(self):
+        seconds = self.seconds or float('nan')
+        write_seconds = self.write_seconds or float('nan')
+        invalid = f", {len(self.validation.invalid)} invalid" if self.validation.results else ""
+        return (
+            f"{self.images} images converted, {self.failures} failed{invalid} in {self.seconds:.2f} s: "
+            f"{self.images / seconds:.1f} images/s, "
+            f"{self.bytes_in / seconds / 1e6:.1f} MB/s in, {self.bytes_out / seconds / 1e6:.1f} MB/s out, "
+            f"written at {self.bytes_out / write_seconds / 1e6:.1f} MB/s")
+
+
 class OrthodonticController(object):
     """ Controller
 
@@ -30,6 +251,76 @@ class OrthodonticController(object):
                     Path(csv_input).parent / row['input_image_filename'])
                 self.convert_image_to_dicom4orthograph_and_save(metadata=row)
 
+    def bulk_convert_images(self, inputs, output_dir=None, image_type_rules=(), default_image_type=None, jobs=1, metadata=None, validate=None, fsync=None, direct_io=None, cache=None, index=None) -> BatchSummary:
+        """ Convert all images in files, directories and glob patterns.
+
+        inputs: paths, directories or glob patterns. See expand_input_paths().
+        output_dir: where to write the DICOM files, reproducing the layout of
+            the input directories. Default is next to each input file.
+        image_type_rules, default_image_type: see image_type_for_filename().
+        jobs: number of worker processes. Each image is converted on its own,
+            so a failing image does not stop the others.
+        metadata: dict of metadata shared by all images, see
+            convert_image_to_dicom4orthograph().
+        validate: validation.FAST or validation.FULL to validate each DICOM
+            file before writing it. The issues of all files are logged
+            together at the end, and kept in the validation of the summary.
+        fsync, direct_io: how to write the DICOM files, see dicom4ortho.writer.
+            Default are config.SAVE_FSYNC and config.SAVE_DIRECT_IO. With
+            writer.FSYNC_BATCH all files are synced once the batch is done.
+        cache: a dicom4ortho.cache.ConversionCache of images converted before.
+        index: a dicom4ortho.index.ArchiveIndex to record the DICOM files into.
+
+        Images which would be written to the same DICOM file, like x.jpg and
+        x.png, are not converted and count as failures.
+        """
+        summary = BatchSummary()
+        start = time.perf_counter()
+        fsync = fsync or config.SAVE_FSYNC
+        metadata = dict(metadata or {},
+                        fsync=FSYNC_NONE if fsync == FSYNC_BATCH else fsync,
+                        direct_io=direct_io)
+        if validate:
+            metadata['validate'] = validate
+        if cache is not None:
+            metadata['cache'] = cache
+        if index is not None:
+            metadata['index'] = index
+        all_metadata = [
+            image_file_metadata(input_path, base, output_dir, image_type_rules, default_image_type, metadata)
+            for input_path, base in expand_input_paths(inputs)]
+        all_metadata, results = _without_output_collisions(all_metadata)
+
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(convert_image_file, m) for m in all_metadata]
+                results.extend((m, future.exception() or future.result())
+                               for m, future in zip(all_metadata, futures))
+        else:
+            for image_metadata in all_metadata:
+                try:
+                    results.append((image_metadata, convert_image_file(image_metadata)))
+                except Exception as e:
+                    results.append((image_metadata, e))
+
+        for image_metadata, result in results:
+            if isinstance(result, Exception):
+                summary.failures += 1
+                metrics.count('failures')
+                logger.error("Could not convert %s: %s",
+                             image_metadata['input_image_filename'], result)
+            else:
+                summary.add(result)
+        if fsync == FSYNC_BATCH:
+            sync_start = time.perf_counter()
+            fsync_files(image_metadata['output_image_filename']
+                        for image_metadata, result in results if not isinstance(result, Exception))
+            summary.write_seconds += time.perf_counter() - sync_start
+        summary.seconds = time.perf_counter() - start
+        if summary.validation.invalid:
+            logger.error("%s", summary.validation)
+        return summary
+
     def convert_image_to_dicom4orthograph(self, metadata) -> OrthodonticPhotograph:
         ''' Converts a plain image into a DICOM object.
 
@@ -54,6 +345,9 @@ class OrthodonticController(object):
             output_image_filename       : filename to write dicom image into.
                                           Default is the same name as the input file name with replaced
                                           extension.
+            icon                        : True to add an Icon Image Sequence.
+            preview                     : True to write a JPEG preview next to
+                                          the DICOM file. See PhotographBase.
         '''
 
         if ('output_image_filename' not in metadata) or (metadata['output_image_filename'] is None):
@@ -72,7 +366,7 @@ class OrthodonticController(object):
         Parameters:
         image_bytes (bytes): Image bytes. Purposely set to raw bytes to avoid file I/O. Purposely avoiding PIL Image, because once in PIL Image, the image will be decoded and re-encoded even when saved as JPEG. This would result in loss of image quality.
 
-        mwl (Dataset): DICOM MWL object.
+        mwl (Dataset): DICOM MWL object. A ModalityWorklistTags is also accepted.
 
         '''
         metadata = {
@@ -81,7 +375,60 @@ class OrthodonticController(object):
             'dicom_mwl': mwl,
         }
         self.photo = OrthodonticPhotograph(**metadata)
-        pass
+        self.photo.copy_mwl_tags()
+        return self.photo
+
+    def convert_images_plus_mwl_to_orthodontic_series(self, images_bytes, mwl: Dataset, image_types=None, max_workers=1,
+                                                      series_number=1) -> OrthodonticSeries:
+        ''' Converts the images of one session into an OrthodonticSeries, using a single DICOM MWL for metadata.
+
+        The MWL is sorted out once and shared by all photographs, which get
+        the same Study and Series Instance UIDs, the same Series Number, and
+        consecutive Instance Numbers in the order of images_bytes.
+
+        Parameters:
+        images_bytes (List[bytes]): Image bytes, one per photograph. See convert_image_plus_mwl_to_dicom4orthograph.
+
+        mwl (Dataset): DICOM MWL object.
+
+        image_types (List[str], optional): Image type of each photograph, e.g. 'EV01', in the order of images_bytes.
+        Raises ValueError unless there is one per image.
+
+        max_workers (int): Number of threads building photographs at the same time. Default 1, i.e. in the calling thread.
+
+        series_number (int): Series Number of the session within its study. Default 1.
+        '''
+        if image_types is not None and len(image_types) != len(images_bytes):
+            raise ValueError(
+                f"{len(image_types)} image types given for {len(images_bytes)} images")
+        mwl_tags = ModalityWorklistTags(mwl)
+        orthodontic_series = OrthodonticSeries()
+        orthodontic_series.StudyUID = mwl.get('StudyInstanceUID') or generate_dicom_uid(
+            root=StudyInstanceUID_ROOT)
+        image_types = image_types or [None] * len(images_bytes)
+
+        def build_photo(instance_number, image_bytes, image_type):
+            photo = OrthodonticPhotograph(
+                input_image_bytes=image_bytes,
+                dicom_mwl=mwl_tags,
+                image_type=image_type,
+                study_instance_uid=orthodontic_series.StudyUID,
+                series_instance_uid=orthodontic_series.UID)
+            photo.copy_mwl_tags()
+            photo.series_number = series_number
+            photo.instance_number = instance_number
+            return photo
+
+        arguments = (range(1, len(images_bytes) + 1), images_bytes, image_types)
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                photos = list(executor.map(build_photo, *arguments))
+        else:
+            photos = list(map(build_photo, *arguments))
+
+        for photo in photos:
+            orthodontic_series.add(photo)
+        return orthodontic_series
 
     def convert_image_to_dicom4orthograph_and_save(self, metadata):
         _photo = self.convert_image_to_dicom4orthograph(metadata=metadata)
@@ -97,30 +444,39 @@ class OrthodonticController(object):
             orthodontic_series.add(orthodontic_photograph)
         return orthodontic_series
 
-    def validate_dicom_file(self, input_image_filename=None):
-        ''' Validate DICOM File.
+    def validate_dicom_file(self, input_image_filename=None) -> ValidationResult:
+        ''' Validate a DICOM file against the VL Photographic Image IOD and DENT-OIP.
 
-        Requires installation of dicom3tools.
+        Without input_image_filename, validates the last converted photo in
+        memory. Logs the issues found. See dicom4ortho.validation.
         '''
-
         if input_image_filename is None:
-            input_image_filename = self.photo.output_image_filename
-
-        self.print_dicom_file(input_image_filename)
-        logger.info('\nValidating file %s', input_image_filename)
-        os.system('{} {}'.format(
-            Path(DICOM3TOOLS_PATH, 'dciodvfy'),
-            input_image_filename))
+            self.photo.prepare()
+            result = validate_dataset(self.photo._ds, source=self.photo.output_image_filename)
+        else:
+            result = validate_file(input_image_filename)
+        _log_validation_result(result)
+        return result
+
+    def validate_dicom_files(self, inputs, jobs=1) -> List[ValidationResult]:
+        ''' Validate the DICOM files in files, directories and glob patterns, with jobs worker processes. '''
+        filenames = [path for path, _ in expand_input_paths(inputs, extensions=('.dcm',))]
+        results = validate_files(filenames, jobs=jobs)
+        for result in results:
+            _log_validation_result(result)
+        return results
 
     def print_dicom_file(self, input_image_filename):
-        ''' Print DICOM tags
+        ''' Print DICOM tags, without reading PixelData.
         '''
-        _photo = DicomBase(
-            input_image_filename=input_image_filename,
-            output_image_filename=None)
-        _photo.load(input_image_filename)
-        _photo.print()
+        print(read_header(input_image_filename))
+
+    def dump_dicom_files(self, inputs, keywords=None, jobs=1) -> Iterator[dict]:
+        ''' Summaries of the DICOM files in files, directories and glob patterns, as they are read. See dicom4ortho.dump. '''
+        filenames = [path for path, _ in expand_input_paths(inputs, extensions=('.dcm',))]
+        return summaries(filenames, keywords=keywords, jobs=jobs)
 
+    @metrics.timed('send')
     def send(self, send_method, **kwargs):
         """
         Send DICOM files to a PACS.
@@ -130,6 +486,7 @@ class OrthodonticController(object):
         dicom_files (str): Array of paths to the DICOM files to send.
         dicom_datasets (List[Dataset]): List of pydicom Dataset objects to send.
         send_method (str): Method to send DICOM. Must be 'dimse' or 'wado'.
+        index (ArchiveIndex, optional): a dicom4ortho.index.ArchiveIndex to record what was sent, and where, into.
         **kwargs: Additional keyword arguments depending on the send method:
 
             For send_method 'dimse':
@@ -176,17 +533,26 @@ class OrthodonticController(object):
         # Convert image to DICOM (assuming you have a function for this)
 
         # Send the DICOM file based on the specified method
+        index = kwargs.get('index')
         if send_method == 'dimse':
-            return dimse.send(
+            status = dimse.send(
                 dicom_datasets=kwargs.get('dicom_datasets', None),
                 dicom_files=kwargs.get('dicom_files', None),
                 orthodontic_series=kwargs.get('orthodontic_series', None),
                 pacs_dimse_hostname=kwargs['pacs_dimse_hostname'],
                 pacs_dimse_port=kwargs['pacs_dimse_port'],
                 pacs_dimse_aet=kwargs['pacs_dimse_aet'])
+            # Only the status of the last C-STORE is known
+            if index is not None and status and get_status_classification(status) in (
+                    STATUS_CLASSIFICATION['SUCCESS'], STATUS_CLASSIFICATION['WARNING']):
+                _record_sent(
+                    index,
+                    f"dimse://{kwargs['pacs_dimse_aet']}@{kwargs['pacs_dimse_hostname']}:{kwargs['pacs_dimse_port']}",
+                    dicom_files=kwargs.get('dicom_files'), dicom_datasets=kwargs.get('dicom_datasets'))
+            return status
 
         elif send_method == 'wado':
-            return wado.send(
+            response = wado.send(
                 dicom_files=kwargs.get('dicom_files', None),
                 orthodontic_series=kwargs.get('orthodontic_series', None),
                 pacs_wado_url=kwargs['pacs_wado_url'],
@@ -195,6 +561,14 @@ class OrthodonticController(object):
                 ssl_certificate=kwargs.get('ssl_certificate'),
                 ssl_verify=kwargs.get('ssl_verify'),
             )
+            if index is not None and response is not None and response.ok:
+                orthodontic_series = kwargs.get('orthodontic_series')
+                _record_sent(
+                    index,
+                    kwargs['pacs_wado_url'], dicom_files=kwargs.get('dicom_files'),
+                    dicom_datasets=None if kwargs.get('dicom_files') or not orthodontic_series
+                    else [photo.to_dataset() for photo in orthodontic_series])
+            return response
         else:
             logger.error('Invalid send method specified.')
 
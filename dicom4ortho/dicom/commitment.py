@@ -0,0 +1,155 @@
+""" dicom/commitment: Storage Commitment Push Model SCU, see PS3.4 Annex J.
+
+A successful C-STORE only says that the PACS received an instance, not
+that it keeps it. Before deleting the local copy, ask the PACS to commit
+to it: request() sends one N-ACTION for a whole batch of instances, under
+a new Transaction UID, and returns straight away. The PACS answers later
+with an N-EVENT-REPORT listing the instances it committed and those it
+failed to, usually over a new association to the AE Title and port
+listened on by start(), sometimes over the N-ACTION association itself.
+Both call on_report().
+"""
+
+from typing import Callable, Iterable, List, Tuple
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import StorageCommitmentPushModel  # pylint: disable=E0611
+
+from dicom4ortho import config
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, format_status, get_status_classification
+from dicom4ortho.utils import generate_dicom_uid
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Well-known SOP Instance of the Storage Commitment Push Model, PS3.4 J.3.
+STORAGE_COMMITMENT_INSTANCE = '1.2.840.10008.1.20.1.1'
+REQUEST_STORAGE_COMMITMENT = 1
+# N-EVENT-REPORT Event Type IDs, PS3.4 J.3.3.
+ALL_COMMITTED = 1
+SOME_FAILED = 2
+
+
+class CommitmentError(Exception):
+    """ The PACS could not be asked for Storage Commitment. """
+
+
+class StorageCommitment(object):
+    """ Asks a PACS to commit to instances, and listens for its answers.
+
+    hostname, port, ae_title: the PACS.
+    local_aet: the AE Title to request as, which the PACS sends its answers
+        to. Default is PROJECT_NAME.upper().
+    listen_host, listen_port: where the PACS sends its answers to. Default
+        are config.COMMITMENT_HOST and config.COMMITMENT_PORT.
+    on_report: called as on_report(transaction_uid, committed, failed) for
+        each answer, committed a list of SOPInstanceUIDs and failed a list of
+        (SOPInstanceUID, FailureReason). It runs in a listener thread.
+    timeout: seconds to wait for the PACS. Default is config.COMMITMENT_TIMEOUT.
+    report_timeout: seconds after which a request without an answer should be
+        sent again. Default is config.COMMITMENT_REPORT_TIMEOUT.
+    """
+
+    def __init__(self, hostname, port, ae_title, local_aet=None, listen_host=None, listen_port=None,
+                 on_report: Callable = None, timeout=None, report_timeout=None):
+        self.hostname = hostname
+        self.port = port
+        self.ae_title = ae_title
+        self.local_aet = local_aet or config.PROJECT_NAME.upper()
+        self.listen_host = listen_host or config.COMMITMENT_HOST
+        self.listen_port = config.COMMITMENT_PORT if listen_port is None else listen_port
+        self.on_report = on_report
+        self.timeout = timeout or config.COMMITMENT_TIMEOUT
+        self.report_timeout = report_timeout or config.COMMITMENT_REPORT_TIMEOUT
+        self._ae = AE(ae_title=self.local_aet)
+        self._ae.acse_timeout = self._ae.dimse_timeout = self._ae.network_timeout = self.timeout
+        self._ae.add_requested_context(StorageCommitmentPushModel)
+        # The PACS sends its answers as the SCP of the Storage Commitment SOP Class
+        self._ae.add_supported_context(StorageCommitmentPushModel, scu_role=True, scp_role=True)
+        self._server = None
+
+    @classmethod
+    def from_send(cls, send, **kwargs):
+        """ A StorageCommitment with the PACS of OrthodonticController.send() DIMSE arguments. """
+        return cls(send['pacs_dimse_hostname'], send['pacs_dimse_port'], send['pacs_dimse_aet'],
+                   local_aet=send.get('local_aet'), **kwargs)
+
+    def request(self, references: Iterable[Tuple[str, str]]) -> str:
+        """ Ask for the commitment of (SOPClassUID, SOPInstanceUID) references. Returns the Transaction UID. """
+        transaction_uid = generate_dicom_uid()
+        ds = Dataset()
+        ds.TransactionUID = transaction_uid
+        items = []
+        for sop_class_uid, sop_instance_uid in references:
+            item = Dataset()
+            item.ReferencedSOPClassUID = sop_class_uid
+            item.ReferencedSOPInstanceUID = sop_instance_uid
+            items.append(item)
+        ds.ReferencedSOPSequence = Sequence(items)
+
+        assoc = self._ae.associate(self.hostname, self.port, ae_title=self.ae_title,
+                                   evt_handlers=[(evt.EVT_N_EVENT_REPORT, self._handle_report)])
+        if not assoc.is_established:
+            raise CommitmentError(
+                f"Failed to establish association with {self.ae_title}@{self.hostname}:{self.port}")
+        try:
+            status, _ = assoc.send_n_action(
+                ds, REQUEST_STORAGE_COMMITMENT, StorageCommitmentPushModel, STORAGE_COMMITMENT_INSTANCE)
+        finally:
+            assoc.release()
+        if not status:
+            raise CommitmentError("N-ACTION: connection timed out, was aborted, or received an invalid response")
+        if get_status_classification(status) not in (STATUS_CLASSIFICATION['SUCCESS'],
+                                                     STATUS_CLASSIFICATION['WARNING']):
+            raise CommitmentError(f"N-ACTION: {format_status(status)}")
+        logger.info("Requested the commitment of %d instances, transaction %s", len(items), transaction_uid)
+        return transaction_uid
+
+    @staticmethod
+    def parse_report(ds) -> Tuple[str, List[str], List[Tuple[str, int]]]:
+        """ (Transaction UID, committed SOPInstanceUIDs, failed (SOPInstanceUID, FailureReason)) of a report. """
+        committed = [str(item.ReferencedSOPInstanceUID) for item in ds.get('ReferencedSOPSequence', [])]
+        failed = [(str(item.ReferencedSOPInstanceUID), item.get('FailureReason'))
+                  for item in ds.get('FailedSOPSequence', [])]
+        return str(ds.TransactionUID), committed, failed
+
+    def _handle_report(self, event):
+        if event.event_type not in (ALL_COMMITTED, SOME_FAILED):
+            return 0x0113, None
+        try:
+            transaction_uid, committed, failed = self.parse_report(event.event_information)
+        except (AttributeError, KeyError) as e:
+            logger.error("Invalid Storage Commitment report: %s", e)
+            return 0x0115, None
+        logger.info("Transaction %s: %d instances committed, %d failed", transaction_uid, len(committed), len(failed))
+        if self.on_report is not None:
+            try:
+                self.on_report(transaction_uid, committed, failed)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Could not record transaction %s: %s", transaction_uid, e)
+                return 0x0110, None
+        return 0x0000, None
+
+    def start(self):
+        """ Listen for the answers of the PACS, in background threads. """
+        self._server = self._ae.start_server(
+            (self.listen_host, self.listen_port), block=False,
+            evt_handlers=[(evt.EVT_N_EVENT_REPORT, self._handle_report)])
+        logger.info("Listening for Storage Commitment reports as %s on %s:%d",
+                    self.local_aet, *self._server.server_address)
+
+    @property
+    def listening(self) -> bool:
+        return self._server is not None
+
+    @property
+    def address(self):
+        """ The (host, port) listened on, once started. """
+        return self._server.server_address
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
@@ -11,7 +11,7 @@ from pynetdicom.sop_class import VLPhotographicImageStorage  # pylint: disable=E
 
 from dicom4ortho.config import PROJECT_NAME
 from dicom4ortho import logger
-from dicom4ortho.dicom.status_codes import format_status
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, format_status, get_status_classification
 
 
 def send(**kwargs) -> Dataset:
@@ -25,7 +25,8 @@ def send(**kwargs) -> Dataset:
         pacs_dimse_aet (str): AE Title of the PACS server.
         local_aet (str): Local AE Title to use (default: PROJECT_NAME.upper()).
 
-    returns a Status Dataset contiaining the response.
+    returns a Status Dataset contiaining the response: that of the first
+    C-STORE which failed, if any, else that of the last one.
     """
     orthodontic_series = kwargs.get('orthodontic_series', None)
     if orthodontic_series:
@@ -72,6 +73,7 @@ def send(**kwargs) -> Dataset:
         ae_title=pacs_dimse_aet)
 
     status = None
+    failed = None
     if assoc.is_established:
         combined_dicoms = (dicom_files or []) + (dicom_datasets or [])
         for dicom_thing in combined_dicoms:
@@ -94,6 +96,9 @@ def send(**kwargs) -> Dataset:
             else:
                 logger.error(
                     f'Connection timed out, was aborted, or received an invalid response. Status: [{status}]')
+            if failed is None and (not status or get_status_classification(status) not in (
+                    STATUS_CLASSIFICATION['SUCCESS'], STATUS_CLASSIFICATION['WARNING'])):
+                failed = status
 
         # Release the association
         assoc.release()
@@ -102,4 +107,4 @@ def send(**kwargs) -> Dataset:
 
     # Shut down the AE to clean up resources
     ae.shutdown()
-    return status
+    return status if failed is None else failed
@@ -0,0 +1,346 @@
+""" dicom/mpps: Modality Performed Procedure Step reporting, so the RIS can close procedures.
+
+MPPSReporter opens a Performed Procedure Step with N-CREATE when a session
+starts, and sets it COMPLETED with N-SET, listing the instances the session
+produced, one PerformedSeriesSequence item per series. See IHE RAD TF-2
+4.6 and 4.7.
+
+Nothing of it runs in the capture path: start_session() and complete() only
+queue the messages, and add() only records an instance locally. A single
+background thread sends the messages, in order, over one association it
+keeps open between them, and releases after config.MPPS_IDLE_SECONDS
+without anything to send.
+
+A message which cannot be sent because the SCP is unreachable is retried
+with exponential backoff, config.MPPS_RETRIES times, before the ones queued
+after it. When it still fails, ProcedureStep.error says why and
+MPPSReporter.resend() queues what the step is missing again.
+"""
+
+import queue
+import threading
+from datetime import datetime
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pynetdicom import AE
+from pynetdicom.sop_class import ModalityPerformedProcedureStep  # pylint: disable=E0611
+
+from dicom4ortho import config
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, format_status, get_status_classification
+from dicom4ortho.utils import generate_dicom_uid
+
+import logging
+logger = logging.getLogger(__name__)
+
+IN_PROGRESS = 'IN PROGRESS'
+COMPLETED = 'COMPLETED'
+DISCONTINUED = 'DISCONTINUED'
+
+# Patient attributes of the MWL item copied into the N-CREATE.
+PATIENT_KEYWORDS = ('PatientName', 'PatientID', 'IssuerOfPatientID', 'PatientBirthDate', 'PatientSex')
+# MWL attributes copied into the ScheduledStepAttributesSequence item.
+SCHEDULED_STEP_KEYWORDS = ('StudyInstanceUID', 'AccessionNumber', 'RequestedProcedureID',
+                           'RequestedProcedureDescription')
+# Attributes of the MWL ScheduledProcedureStepSequence item copied there too.
+SCHEDULED_PROCEDURE_STEP_KEYWORDS = ('ScheduledProcedureStepID', 'ScheduledProcedureStepDescription',
+                                     'ScheduledProtocolCodeSequence')
+
+
+class MPPSError(Exception):
+    """ The MPPS SCP refused or did not answer a message. """
+
+
+class MPPSConnectionError(MPPSError):
+    """ The MPPS SCP could not be reached, or did not answer: worth sending again. """
+
+
+def _now():
+    now = datetime.now()
+    return now.strftime('%Y%m%d'), now.strftime('%H%M%S')
+
+
+class ProcedureStep(object):
+    """ A Performed Procedure Step: the photographs of one session.
+
+    Made by MPPSReporter.start_session().
+    """
+
+    def __init__(self, mwl=None, station_ae_title='', **attributes):
+        self.sop_instance_uid = generate_dicom_uid(root=config.PerformedProcedureStepUID_ROOT)
+        self.mwl = mwl if mwl is not None else Dataset()
+        self.attributes = attributes
+        self.station_ae_title = station_ae_title
+        self.start_date, self.start_time = _now()
+        self.status = None
+        # COMPLETED or DISCONTINUED once asked for
+        self.final_status = None
+        self.error = None
+        # Messages of this step queued and not sent or given up yet
+        self._queued = 0
+        # SeriesInstanceUID -> (SeriesDescription, [(SOPClassUID, SOPInstanceUID)])
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _get(self, keyword):
+        if keyword in self.attributes:
+            return self.attributes[keyword]
+        return self.mwl.get(keyword, '')
+
+    @property
+    def study_instance_uid(self):
+        uid = self._get('StudyInstanceUID')
+        if not uid:
+            uid = self.attributes['StudyInstanceUID'] = generate_dicom_uid(root=config.StudyInstanceUID_ROOT)
+        return uid
+
+    def add(self, instance):
+        """ Record a DICOM instance, a Dataset or a DicomBase, produced by this step.
+
+        Also sets its ReferencedPerformedProcedureStepSequence to this step,
+        so add() before saving or sending it.
+        """
+        ds = instance.to_dataset() if hasattr(instance, 'to_dataset') else instance
+        reference = Dataset()
+        reference.ReferencedSOPClassUID = ModalityPerformedProcedureStep
+        reference.ReferencedSOPInstanceUID = self.sop_instance_uid
+        ds.ReferencedPerformedProcedureStepSequence = Sequence([reference])
+        with self._lock:
+            _, instances = self._series.setdefault(
+                str(ds.SeriesInstanceUID), (ds.get('SeriesDescription', ''), []))
+            instances.append((str(ds.SOPClassUID), str(ds.SOPInstanceUID)))
+
+    def __len__(self):
+        return sum(len(instances) for _, instances in self._series.values())
+
+    def create_dataset(self) -> Dataset:
+        """ The N-CREATE attributes, see PS3.3 C.4.13 and IHE RAD TF-2 Table 4.6-1. """
+        ds = Dataset()
+        scheduled = Dataset()
+        scheduled.StudyInstanceUID = self.study_instance_uid
+        scheduled.ReferencedStudySequence = self.mwl.get('ReferencedStudySequence', Sequence())
+        for keyword in SCHEDULED_STEP_KEYWORDS[1:]:
+            setattr(scheduled, keyword, self._get(keyword))
+        steps = self.mwl.get('ScheduledProcedureStepSequence')
+        step = steps[0] if steps else Dataset()
+        for keyword in SCHEDULED_PROCEDURE_STEP_KEYWORDS:
+            setattr(scheduled, keyword, step.get(keyword, Sequence() if keyword.endswith('Sequence') else ''))
+        ds.ScheduledStepAttributesSequence = Sequence([scheduled])
+        for keyword in PATIENT_KEYWORDS:
+            setattr(ds, keyword, self._get(keyword))
+        ds.ReferencedPatientSequence = Sequence()
+        ds.PerformedProcedureStepID = self.sop_instance_uid[-16:]
+        ds.PerformedStationAETitle = self.station_ae_title
+        ds.PerformedStationName = ''
+        ds.PerformedLocation = ''
+        ds.PerformedProcedureStepStartDate = self.start_date
+        ds.PerformedProcedureStepStartTime = self.start_time
+        ds.PerformedProcedureStepStatus = IN_PROGRESS
+        ds.PerformedProcedureStepDescription = self._get('RequestedProcedureDescription')
+        ds.PerformedProcedureTypeDescription = ''
+        ds.ProcedureCodeSequence = self.mwl.get('RequestedProcedureCodeSequence', Sequence())
+        ds.PerformedProcedureStepEndDate = ''
+        ds.PerformedProcedureStepEndTime = ''
+        ds.Modality = config.MPPS_MODALITY
+        ds.StudyID = self._get('RequestedProcedureID')
+        ds.PerformedProtocolCodeSequence = step.get('ScheduledProtocolCodeSequence', Sequence())
+        ds.PerformedSeriesSequence = Sequence()
+        return ds
+
+    def set_dataset(self, status) -> Dataset:
+        """ The final N-SET attributes, with one PerformedSeriesSequence item per series. """
+        ds = Dataset()
+        ds.PerformedProcedureStepStatus = status
+        ds.PerformedProcedureStepEndDate, ds.PerformedProcedureStepEndTime = _now()
+        performed_series = []
+        with self._lock:
+            for series_instance_uid, (description, instances) in self._series.items():
+                series = Dataset()
+                series.PerformingPhysicianName = ''
+                series.OperatorsName = ''
+                series.ProtocolName = description or ''
+                series.SeriesInstanceUID = series_instance_uid
+                series.SeriesDescription = description or ''
+                series.RetrieveAETitle = ''
+                images = []
+                for sop_class_uid, sop_instance_uid in instances:
+                    image = Dataset()
+                    image.ReferencedSOPClassUID = sop_class_uid
+                    image.ReferencedSOPInstanceUID = sop_instance_uid
+                    images.append(image)
+                series.ReferencedImageSequence = Sequence(images)
+                series.ReferencedNonImageCompositeSOPInstanceSequence = Sequence()
+                performed_series.append(series)
+        ds.PerformedSeriesSequence = Sequence(performed_series)
+        return ds
+
+
+class MPPSReporter(object):
+    """ Sends the Performed Procedure Steps of sessions to an MPPS SCP, in the background.
+
+    hostname, port, ae_title: the MPPS SCP, usually the RIS.
+    local_aet: AE Title to send as, and PerformedStationAETitle. Default is PROJECT_NAME.upper().
+    idle_seconds: default is config.MPPS_IDLE_SECONDS.
+    retries, backoff: default are config.MPPS_RETRIES and config.MPPS_BACKOFF.
+    """
+
+    def __init__(self, hostname, port, ae_title, local_aet=None, idle_seconds=None, retries=None,
+                 backoff=None):
+        self.hostname = hostname
+        self.port = port
+        self.ae_title = ae_title
+        self.local_aet = local_aet or config.PROJECT_NAME.upper()
+        self.idle_seconds = idle_seconds or config.MPPS_IDLE_SECONDS
+        self.retries = config.MPPS_RETRIES if retries is None else retries
+        self.backoff = config.MPPS_BACKOFF if backoff is None else backoff
+        self._ae = AE(ae_title=self.local_aet)
+        self._ae.add_requested_context(ModalityPerformedProcedureStep)
+        self._assoc = None
+        self._queue = queue.Queue()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mpps", daemon=True)
+        self._thread.start()
+
+    def start_session(self, mwl=None, **attributes) -> ProcedureStep:
+        """ Start a Performed Procedure Step, for the MWL item mwl if scheduled.
+
+        attributes: DICOM keywords overriding those of mwl, e.g. PatientID
+        for an unscheduled session.
+        """
+        step = ProcedureStep(mwl, station_ae_title=self.local_aet, **attributes)
+        self._put(self._create, step)
+        return step
+
+    def complete(self, step: ProcedureStep):
+        """ Set step COMPLETED, with the instances added to it.
+
+        Raises MPPSError if step could not be created: resend() it first.
+        """
+        self._finish(step, COMPLETED)
+
+    def discontinue(self, step: ProcedureStep):
+        """ Set step DISCONTINUED, when the session was abandoned.
+
+        Raises MPPSError if step could not be created: resend() it first.
+        """
+        self._finish(step, DISCONTINUED)
+
+    def resend(self, step: ProcedureStep):
+        """ Queue again the messages of step which could not be sent: the N-CREATE, the N-SET or both. """
+        with step._lock:
+            if step._queued:
+                raise MPPSError(f"Performed Procedure Step {step.sop_instance_uid} is still being sent")
+        if step.status is None:
+            self._put(self._create, step)
+        if step.final_status is not None and step.status != step.final_status:
+            self._put(self._set, step, step.final_status)
+
+    def _put(self, operation, step, *args):
+        with step._lock:
+            step._queued += 1
+        self._queue.put((operation, step, *args))
+
+    def _finish(self, step: ProcedureStep, status):
+        with step._lock:
+            if step.status is None and not step._queued:
+                raise MPPSError(f"Performed Procedure Step {step.sop_instance_uid} was not created: {step.error}")
+            step.final_status = status
+        self._put(self._set, step, status)
+
+    def _association(self):
+        if self._assoc is None or not self._assoc.is_established:
+            self._assoc = self._ae.associate(self.hostname, self.port, ae_title=self.ae_title)
+            if not self._assoc.is_established:
+                self._assoc = None
+                raise MPPSConnectionError(f"Failed to establish association with {self.ae_title}@{self.hostname}:{self.port}")
+        return self._assoc
+
+    def _release(self):
+        if self._assoc is not None:
+            if self._assoc.is_established:
+                self._assoc.release()
+            self._assoc = None
+
+    @staticmethod
+    def _check(status, message):
+        if not status:
+            raise MPPSConnectionError(f"{message}: connection timed out, was aborted, or received an invalid response")
+        if get_status_classification(status) not in (STATUS_CLASSIFICATION['SUCCESS'],
+                                                     STATUS_CLASSIFICATION['WARNING']):
+            raise MPPSError(f"{message}: {format_status(status)}")
+
+    def _create(self, step: ProcedureStep):
+        status, _ = self._association().send_n_create(
+            step.create_dataset(), ModalityPerformedProcedureStep, step.sop_instance_uid)
+        self._check(status, "N-CREATE")
+        step.status = IN_PROGRESS
+        logger.info("Performed Procedure Step %s in progress", step.sop_instance_uid)
+
+    def _set(self, step: ProcedureStep, status):
+        if step.status != IN_PROGRESS:
+            raise MPPSError(f"Performed Procedure Step {step.sop_instance_uid} was not created: {step.error}")
+        result, _ = self._association().send_n_set(
+            step.set_dataset(status), ModalityPerformedProcedureStep, step.sop_instance_uid)
+        self._check(result, "N-SET")
+        step.status = status
+        logger.info("Performed Procedure Step %s %s with %d instances",
+                    step.sop_instance_uid, status.lower(), len(step))
+
+    def _run(self):
+        while True:
+            try:
+                task = self._queue.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                self._release()
+                continue
+            if task is None:
+                self._release()
+                self._queue.task_done()
+                return
+            operation, step, *args = task
+            try:
+                self._send(operation, step, *args)
+            finally:
+                with step._lock:
+                    step._queued -= 1
+                self._queue.task_done()
+
+    def _backoff(self, attempts) -> float:
+        return min(config.MPPS_MAX_BACKOFF, self.backoff * 2 ** (attempts - 1))
+
+    def _send(self, operation, step, *args):
+        """ Send one message, retrying while the SCP cannot be reached: the next ones must wait for it. """
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                operation(step, *args)
+                step.error = None
+                return
+            except MPPSConnectionError as e:
+                # A dropped association is opened again for the next attempt
+                self._release()
+                if attempts > self.retries or self._closing.is_set():
+                    step.error = str(e)
+                    logger.error("Performed Procedure Step %s: %s", step.sop_instance_uid, e)
+                    return
+                delay = self._backoff(attempts)
+                logger.warning("Performed Procedure Step %s: %s, retrying in %.1f seconds",
+                               step.sop_instance_uid, e, delay)
+                self._closing.wait(delay)
+            except Exception as e:  # pylint: disable=broad-except
+                self._release()
+                step.error = str(e)
+                logger.error("Performed Procedure Step %s: %s", step.sop_instance_uid, e)
+                return
+
+    def flush(self):
+        """ Wait until everything queued is sent, or failed after all its retries. """
+        self._queue.join()
+
+    def close(self):
+        """ Send what is queued, without retrying any more, release the association and stop. """
+        self._closing.set()
+        self._queue.put(None)
+        self._thread.join()
+        self._ae.shutdown()
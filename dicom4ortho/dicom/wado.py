@@ -5,6 +5,9 @@ This module is here to satisfy specificion  **IE-03:** ``dicom4ortho`` SHALL sup
 """
 
 from typing import cast
+import contextlib
+import functools
+import os
 import tempfile
 import uuid
 import logging
@@ -14,6 +17,51 @@ from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
 logger = logging.getLogger(__name__)
 
 
+def _part_header(boundary, length) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        "Content-Type: application/dicom\r\n"
+        f"Content-Length: {length}\r\n\r\n"
+    ).encode('ascii')
+
+
+def _read_file_into(f, view):
+    position = 0
+    while position < len(view):
+        read = f.readinto(view[position:])
+        if not read:
+            raise IOError(f"{f.name} is shorter than expected")
+        position += read
+
+
+def _write_photo_into(photo, view):
+    photo.to_buffer(view)
+
+
+def _multipart_body(contents, boundary) -> bytearray:
+    """ The multipart/related body of a STOW-RS request.
+
+    contents: (length, write) of each DICOM file, where write(view) fills
+    a memoryview of that length with the file. Each file is written straight
+    into the body, which is allocated once.
+    """
+    headers = [_part_header(boundary, length) for length, _ in contents]
+    closing = f"--{boundary}--".encode('ascii')
+    body = bytearray(
+        sum(len(header) + length + 2 for header, (length, _) in zip(headers, contents)) + len(closing))
+    view = memoryview(body)
+    position = 0
+    for header, (length, write) in zip(headers, contents):
+        view[position:position + len(header)] = header
+        position += len(header)
+        write(view[position:position + length])
+        position += length
+        view[position:position + 2] = b"\r\n"
+        position += 2
+    view[position:] = closing
+    return body
+
+
 def send(**kwargs) -> requests.Response:
     """ send images or OrthodonticSeries to PACS using STOW-RS.
 
@@ -43,40 +91,35 @@ def send(**kwargs) -> requests.Response:
         return None
 
     boundary = str(uuid.uuid4())
-    parts = []
-
-    # Prepare content
-    def add_content(content): return (
-        f"--{boundary}\r\n"
-        "Content-Type: application/dicom\r\n"
-        f"Content-Length: {len(content)}\r\n\r\n"
-    ).encode('ascii') + content + b"\r\n"
+    contents = []
 
     dicom_files = kwargs.get('dicom_files', [])
     orthodontic_series = kwargs.get('orthodontic_series')
     ssl_certificate = kwargs.get('ssl_certificate')
     ssl_verify = kwargs.get('ssl_verify',True)
 
-    if dicom_files:
-        for dicom_file in dicom_files:
-            try:
-                with open(dicom_file, 'rb') as f:
-                    parts.append(add_content(f.read()))
-            except Exception as e:
-                logger.error('Error processing file %s: %s',
-                             dicom_file, str(e))
-    elif orthodontic_series:
-        for photo in orthodontic_series:
-            photo = cast(OrthodonticPhotograph, photo)
-            parts.append(add_content(photo.to_byte().getvalue()))
-    else:
-        logger.error(
-            "No data to send. Specify either dicom_files or orthodontic_series.")
-        return None
-
-    # Finalize the multipart body
-    parts.append(f"--{boundary}--".encode('ascii'))
-    body = b''.join(parts)
+    # Files are opened here, so that one which cannot be is left out, and read into the body later
+    with contextlib.ExitStack() as files:
+        if dicom_files:
+            for dicom_file in dicom_files:
+                try:
+                    f = files.enter_context(open(dicom_file, 'rb', buffering=0))
+                    contents.append((os.fstat(f.fileno()).st_size,
+                                     functools.partial(_read_file_into, f)))
+                except Exception as e:
+                    logger.error('Error processing file %s: %s',
+                                 dicom_file, str(e))
+        elif orthodontic_series:
+            for photo in orthodontic_series:
+                photo = cast(OrthodonticPhotograph, photo)
+                contents.append((photo.encoded_length(),
+                                 functools.partial(_write_photo_into, photo)))
+        else:
+            logger.error(
+                "No data to send. Specify either dicom_files or orthodontic_series.")
+            return None
+
+        body = _multipart_body(contents, boundary)
 
     # Send request
     headers = {
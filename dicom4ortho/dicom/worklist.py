@@ -0,0 +1,306 @@
+""" dicom/worklist: Modality Worklist C-FIND client, and a local cache of its results.
+
+convert_image_plus_mwl_to_dicom4orthograph() needs the Modality Worklist
+item of the patient being photographed. Querying the MWL SCP at capture
+time makes every photograph wait for a network round trip, and every
+capture station query the same items again.
+
+WorklistCache keeps the items scheduled from today to days_ahead days from
+now in memory, indexed by PatientID, AccessionNumber and scheduled date,
+so that lookups are local. It refreshes incrementally: one scheduled date
+at a time, each date when its items are older than refresh_interval, over
+a single association. Items a refresh no longer returns, because they were
+cancelled or completed, are dropped. Items expire after ttl seconds
+without a refresh, and a lookup which finds nothing in the cache queries
+the SCP, for walk-in patients scheduled since the last refresh.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pynetdicom import AE
+from pynetdicom.sop_class import ModalityWorklistInformationFind  # pylint: disable=E0611
+
+from dicom4ortho import config
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, format_status, get_status_classification
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Return keys of the Modality Worklist item, see PS3.4 K.6.1.2.2.
+RETURN_KEYS = (
+    'PatientName',
+    'PatientID',
+    'IssuerOfPatientID',
+    'PatientBirthDate',
+    'PatientSex',
+    'AccessionNumber',
+    'StudyInstanceUID',
+    'ReferencedStudySequence',
+    'RequestedProcedureID',
+    'RequestedProcedureDescription',
+    'RequestedProcedureCodeSequence',
+    'ReasonForTheRequestedProcedure',
+    'InstitutionName',
+)
+
+# Return keys of the Scheduled Procedure Step Sequence item.
+STEP_RETURN_KEYS = (
+    'Modality',
+    'ScheduledStationAETitle',
+    'ScheduledProcedureStepStartDate',
+    'ScheduledProcedureStepStartTime',
+    'ScheduledProcedureStepID',
+    'ScheduledProcedureStepDescription',
+    'ScheduledProtocolCodeSequence',
+    'ScheduledPerformingPhysicianName',
+)
+
+# C-FIND statuses which carry a matching item.
+_PENDING_STATUSES = (0xFF00, 0xFF01)
+
+
+class WorklistError(Exception):
+    """ The Modality Worklist SCP could not be queried. """
+
+
+def _step(ds) -> Optional[Dataset]:
+    steps = ds.get('ScheduledProcedureStepSequence')
+    return steps[0] if steps else None
+
+
+def _scheduled(item):
+    """ (date, time) the item is scheduled at, to sort by. """
+    step = _step(item) or Dataset()
+    return step.get('ScheduledProcedureStepStartDate', ''), step.get('ScheduledProcedureStepStartTime', '')
+
+
+def identifier(**filters) -> Dataset:
+    """ A C-FIND identifier asking for RETURN_KEYS, matching filters.
+
+    filters: DICOM keywords and values to match, e.g. PatientID='1234'.
+    Keywords of STEP_RETURN_KEYS go into the Scheduled Procedure Step, e.g.
+    ScheduledProcedureStepStartDate='20240623' or a '20240623-20240630' range.
+    """
+    ds = Dataset()
+    step = Dataset()
+    for keyword in RETURN_KEYS:
+        setattr(ds, keyword, Sequence() if keyword.endswith('Sequence') else '')
+    for keyword in STEP_RETURN_KEYS:
+        setattr(step, keyword, Sequence() if keyword.endswith('Sequence') else '')
+    for keyword, value in filters.items():
+        setattr(step if keyword in STEP_RETURN_KEYS else ds, keyword, value)
+    ds.ScheduledProcedureStepSequence = Sequence([step])
+    return ds
+
+
+class WorklistClient(object):
+    """ Queries a Modality Worklist SCP.
+
+    hostname, port, ae_title: the MWL SCP.
+    local_aet: AE Title to query as. Default is PROJECT_NAME.upper().
+    timeout: seconds to wait for the SCP. Default is config.WORKLIST_TIMEOUT.
+    """
+
+    def __init__(self, hostname, port, ae_title, local_aet=None, timeout=None):
+        self.hostname = hostname
+        self.port = port
+        self.ae_title = ae_title
+        self.local_aet = local_aet or config.PROJECT_NAME.upper()
+        self.timeout = timeout or config.WORKLIST_TIMEOUT
+
+    def find_all(self, identifiers: Iterable[Dataset]) -> List[List[Dataset]]:
+        """ The items matching each of identifiers, queried over a single association. """
+        ae = AE(ae_title=self.local_aet)
+        ae.acse_timeout = ae.dimse_timeout = ae.network_timeout = self.timeout
+        ae.add_requested_context(ModalityWorklistInformationFind)
+        assoc = ae.associate(self.hostname, self.port, ae_title=self.ae_title)
+        if not assoc.is_established:
+            ae.shutdown()
+            raise WorklistError(
+                f"Failed to establish association with {self.ae_title}@{self.hostname}:{self.port}")
+        try:
+            results = []
+            for query in identifiers:
+                items = []
+                for status, item in assoc.send_c_find(query, ModalityWorklistInformationFind):
+                    if not status:
+                        raise WorklistError("Connection timed out, was aborted, or received an invalid response")
+                    if status.Status in _PENDING_STATUSES:
+                        items.append(item)
+                    elif get_status_classification(status) != STATUS_CLASSIFICATION['SUCCESS']:
+                        raise WorklistError(format_status(status))
+                results.append(items)
+            return results
+        finally:
+            assoc.release()
+            ae.shutdown()
+
+    def find(self, **filters) -> List[Dataset]:
+        """ The items matching filters, see identifier(). """
+        return self.find_all([identifier(**filters)])[0]
+
+
+class WorklistCache(object):
+    """ The items of a WorklistClient, cached and indexed. See the module docstring.
+
+    filters: added to every query, e.g. {'Modality': 'XC'} or
+        {'ScheduledStationAETitle': 'CAMERA1'}.
+    ttl, refresh_interval, days_ahead: see config.
+
+    Lookups return the cached Dataset objects, which should not be modified.
+    """
+
+    def __init__(self, client, filters=None, ttl=None, refresh_interval=None, days_ahead=None):
+        self.client = client
+        self.filters = dict(filters or {})
+        self.ttl = ttl or config.WORKLIST_TTL
+        self.refresh_interval = refresh_interval or config.WORKLIST_REFRESH_INTERVAL
+        self.days_ahead = config.WORKLIST_DAYS_AHEAD if days_ahead is None else days_ahead
+        self._lock = threading.Lock()
+        # key -> (item, time fetched)
+        self._items = {}
+        self._by_patient_id = defaultdict(set)
+        self._by_accession_number = defaultdict(set)
+        self._by_date = defaultdict(set)
+        # scheduled date -> time refreshed
+        self._refreshed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _key(item):
+        step = _step(item)
+        return (item.get('StudyInstanceUID', ''), item.get('AccessionNumber', ''),
+                step.get('ScheduledProcedureStepID', '') if step else '')
+
+    def _indexes(self, item):
+        return ((self._by_patient_id, item.get('PatientID', '')),
+                (self._by_accession_number, item.get('AccessionNumber', '')),
+                (self._by_date, _scheduled(item)[0]))
+
+    def _remove(self, key):
+        item, _ = self._items.pop(key)
+        for index, value in self._indexes(item):
+            index[value].discard(key)
+            if not index[value]:
+                del index[value]
+
+    def _put(self, items, now):
+        for item in items:
+            key = self._key(item)
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (item, now)
+            for index, value in self._indexes(item):
+                index[value].add(key)
+
+    def dates(self, today=None) -> List[str]:
+        """ The scheduled dates kept in the cache, as DICOM dates. """
+        today = today or date.today()
+        return [(today + timedelta(days=n)).strftime('%Y%m%d') for n in range(self.days_ahead + 1)]
+
+    def refresh(self, force=False) -> int:
+        """ Query the dates whose items are older than refresh_interval, or all with force.
+
+        Returns the number of dates queried.
+        """
+        now = time.time()
+        with self._lock:
+            dates = [scheduled_date for scheduled_date in self.dates()
+                     if force or now - self._refreshed.get(scheduled_date, 0) >= self.refresh_interval]
+        if not dates:
+            return 0
+        results = self.client.find_all(
+            identifier(**dict(self.filters, ScheduledProcedureStepStartDate=scheduled_date))
+            for scheduled_date in dates)
+        with self._lock:
+            for scheduled_date, items in zip(dates, results):
+                for key in list(self._by_date.get(scheduled_date, ())):
+                    self._remove(key)
+                self._put(items, now)
+                self._refreshed[scheduled_date] = now
+            # Forget the days gone by
+            window = set(self.dates())
+            for scheduled_date in [d for d in self._refreshed if d not in window]:
+                del self._refreshed[scheduled_date]
+                for key in list(self._by_date.get(scheduled_date, ())):
+                    self._remove(key)
+        logger.debug("Refreshed the worklist of %s: %d items", ', '.join(dates), len(self))
+        return len(dates)
+
+    def find(self, patient_id=None, accession_number=None, scheduled_date=None, query=True) -> List[Dataset]:
+        """ The cached items matching all the filters given, by scheduled time.
+
+        query: if nothing matches in the cache, query the SCP, and cache
+        what it returns.
+        """
+        filters = ((self._by_patient_id, patient_id),
+                   (self._by_accession_number, accession_number),
+                   (self._by_date, scheduled_date))
+        now = time.time()
+        with self._lock:
+            keys = None
+            for index, value in filters:
+                if value is not None:
+                    matches = index.get(value, set())
+                    keys = set(matches) if keys is None else keys & matches
+            if keys is None:
+                keys = set(self._items)
+            for key in [key for key in keys if now - self._items[key][1] > self.ttl]:
+                self._remove(key)
+                keys.discard(key)
+            items = [self._items[key][0] for key in keys]
+        if not items and query:
+            query_filters = dict(self.filters)
+            for keyword, value in (('PatientID', patient_id), ('AccessionNumber', accession_number),
+                                   ('ScheduledProcedureStepStartDate', scheduled_date)):
+                if value is not None:
+                    query_filters[keyword] = value
+            items = self.client.find(**query_filters)
+            with self._lock:
+                self._put(items, now)
+        return sorted(items, key=_scheduled)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not refresh the worklist: %s", e)
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """ Refresh in a background thread until stop(). """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="worklist", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __len__(self):
+        return len(self._items)
+
+
+def summary(item) -> Dict[str, str]:
+    """ The main attributes of a worklist item, for printing. """
+    result = {}
+    step = _step(item) or Dataset()
+    for ds, keywords in ((item, ('PatientID', 'PatientName', 'AccessionNumber', 'StudyInstanceUID',
+                                 'RequestedProcedureDescription')),
+                         (step, ('Modality', 'ScheduledStationAETitle', 'ScheduledProcedureStepStartDate',
+                                 'ScheduledProcedureStepStartTime', 'ScheduledProcedureStepDescription'))):
+        for keyword in keywords:
+            value = ds.get(keyword)
+            if value not in (None, ''):
+                result[keyword] = str(value)
+    return result
@@ -0,0 +1,93 @@
+""" Read the headers of many DICOM files quickly, to inspect them.
+
+Reading stops before PixelData, and only the attributes asked for are
+parsed: the values of all others, icons and ICC profiles included, are
+skipped over. Each file then costs a few kilobytes of I/O, however large its
+image, and a day of photographs can be listed in seconds.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from typing import Iterator
+
+from pydicom import dcmread
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+from dicom4ortho import config
+
+
+def read_header(filename, keywords=None) -> Dataset:
+    """ The dataset of a DICOM file without PixelData.
+
+    keywords: only parse these attributes, keywords or tags. Default is all of them.
+    """
+    return dcmread(os.fspath(filename), stop_before_pixels=True, specific_tags=keywords)
+
+
+@lru_cache(maxsize=16)
+def _tags(keywords):
+    """ The tags of keywords. Parsing is faster with tags than with keywords. """
+    tags = []
+    for keyword in keywords:
+        tag = tag_for_keyword(keyword)
+        if tag is None:
+            raise ValueError(f"Unknown DICOM keyword '{keyword}'")
+        tags.append(Tag(tag))
+    return tuple(tags)
+
+
+def _json_value(value):
+    if isinstance(value, MultiValue):
+        return [_json_value(v) for v in value]
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, bytes):
+        return value.hex()
+    return str(value)
+
+
+def summary(filename, keywords=None) -> dict:
+    """ The file name, size and transfer syntax of a DICOM file, and the values of keywords.
+
+    Default keywords are config.DUMP_KEYWORDS. Missing attributes are left
+    out. A file which cannot be read has an 'error' instead.
+    """
+    keywords = tuple(keywords or config.DUMP_KEYWORDS)
+    tags = _tags(keywords)
+    result = {'filename': str(filename)}
+    try:
+        result['size'] = os.path.getsize(filename)
+        ds = read_header(filename, tags)
+    except Exception as e:  # pylint: disable=broad-except
+        result['error'] = str(e)
+        return result
+    result['transfer_syntax'] = str(ds.file_meta.get('TransferSyntaxUID', ''))
+    for keyword, tag in zip(keywords, tags):
+        if tag in ds:
+            element = ds[tag]
+            if element.VR != 'SQ' and not element.is_empty:
+                result[keyword] = _json_value(element.value)
+    return result
+
+
+def summaries(filenames, keywords=None, jobs=1) -> Iterator[dict]:
+    """ summary() of each of filenames, in order, as soon as it is read. With jobs worker processes.
+
+    Raises ValueError for an unknown keyword right away, rather than from the workers.
+    """
+    keywords = tuple(keywords or config.DUMP_KEYWORDS)
+    _tags(keywords)
+    return _summaries([str(filename) for filename in filenames], keywords, jobs)
+
+
+def _summaries(filenames, keywords, jobs) -> Iterator[dict]:
+    if jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(partial(summary, keywords=keywords), filenames, chunksize=64)
+    else:
+        for filename in filenames:
+            yield summary(filename, keywords)
@@ -0,0 +1,390 @@
+""" SQLite index of the DICOM instances dicom4ortho wrote and sent.
+
+Answering "which views are missing from this session" used to mean reading
+every DICOM file of a folder. An ArchiveIndex keeps one row per instance,
+keyed by SOPInstanceUID:
+
+    patient, study, series and SOP Instance UIDs
+    session_date: StudyDate, or the AcquisitionDate or ContentDate when the
+        StudyDate is empty, as it is without a Modality Worklist
+    view: the DENT-OIP keyword, like EV01, from ImageComments
+    treatment_event, days_after_event: from the Acquisition Context (TID 3465)
+    path, size, mtime and SHA-256 of the file
+    sent_at and destination of the last successful send
+
+DicomBase.save() and OrthodonticController.send() record into the index
+given to them. Existing folders are added with scan(), which reads only the
+headers, in worker processes, and skips the files which have not changed
+since they were last indexed.
+
+Several processes can write into the same index: the database is in WAL
+mode and waits for locks. Each thread opens its own connection on first
+use, so that an ArchiveIndex can be shared by threads, like those of the
+outbox and the receiver, and handed to worker processes.
+"""
+
+import datetime
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, List, Optional
+
+from dicom4ortho import config
+from dicom4ortho._generated_codes import CODES
+from dicom4ortho.dump import read_header
+
+import logging
+logger = logging.getLogger(__name__)
+
+_COLUMNS = (
+    'sop_instance_uid',
+    'patient_id',
+    'patient_name',
+    'study_instance_uid',
+    'series_instance_uid',
+    'session_date',
+    'view',
+    'treatment_event',
+    'days_after_event',
+    'path',
+    'size',
+    'mtime',
+    'sha256',
+    'indexed_at',
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    sop_instance_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    patient_name TEXT,
+    study_instance_uid TEXT,
+    series_instance_uid TEXT,
+    session_date TEXT,
+    view TEXT,
+    treatment_event TEXT,
+    days_after_event INTEGER,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT,
+    indexed_at TEXT,
+    sent_at TEXT,
+    destination TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_session ON instances (patient_id, session_date, view);
+CREATE INDEX IF NOT EXISTS instances_study ON instances (study_instance_uid);
+CREATE INDEX IF NOT EXISTS instances_path ON instances (path);
+"""
+
+_FILE_COLUMNS = ('path', 'size', 'mtime')
+
+# A row without a path, of a dataset sent without being saved, leaves the
+# file of the instance as it was. A hash is kept only while the file stays
+# the same.
+_UPSERT = """
+INSERT INTO instances ({columns}) VALUES ({values})
+ON CONFLICT (sop_instance_uid) DO UPDATE SET {updates}, {file_updates},
+    sha256 = CASE
+        WHEN excluded.sha256 IS NOT NULL THEN excluded.sha256
+        WHEN excluded.path IS NULL THEN sha256
+        WHEN excluded.path IS path AND excluded.size IS size AND excluded.mtime IS mtime THEN sha256
+    END
+""".format(
+    columns=', '.join(_COLUMNS),
+    values=', '.join(f':{column}' for column in _COLUMNS),
+    updates=', '.join(f'{column} = excluded.{column}' for column in _COLUMNS
+                      if column not in ('sop_instance_uid', 'sha256') + _FILE_COLUMNS),
+    file_updates=', '.join(
+        f'{column} = CASE WHEN excluded.path IS NULL THEN {column} ELSE excluded.{column} END'
+        for column in _FILE_COLUMNS))
+
+# The attributes the index reads from each file
+HEADER_KEYWORDS = (
+    'SOPInstanceUID',
+    'PatientID',
+    'PatientName',
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'StudyDate',
+    'AcquisitionDate',
+    'ContentDate',
+    'ImageComments',
+    'AcquisitionContextSequence',
+)
+
+_VIEW = re.compile(r'^([EI]V\d\d)')
+
+# Rows written at once by scan()
+_SCAN_BATCH = 1000
+
+
+def _treatment_event_keywords():
+    """ DENT-OIP keyword of each (code value, coding scheme) of a treatment event. """
+    keywords = {}
+    for keyword in ('PatientRegistration', 'OrthodonticTreatment', 'Posttreatment'):
+        code = CODES.get(keyword)
+        if code is not None:
+            keywords[(code.value, code.scheme)] = keyword
+    return keywords
+
+
+_TREATMENT_EVENTS = _treatment_event_keywords()
+
+
+def _treatment_progress(ds):
+    """ (treatment event, days after event) of the Acquisition Context of ds. """
+    event = days = None
+    for item in ds.get('AcquisitionContextSequence', []):
+        names = item.get('ConceptNameCodeSequence')
+        if not names:
+            continue
+        name = names[0].get('CodeValue')
+        if name == CODES['TemporalEventType'].value and item.get('ConceptCodeSequence'):
+            code = item.ConceptCodeSequence[0]
+            event = _TREATMENT_EVENTS.get(
+                (code.get('CodeValue'), code.get('CodingSchemeDesignator')), code.get('CodeMeaning'))
+        elif name == CODES['OffsetFromEvent'].value and item.get('NumericValue') is not None:
+            days = int(float(item.NumericValue))
+    return event, days
+
+
+def row_from_dataset(ds, path=None, size=None, mtime=None, sha256=None) -> Dict:
+    """ The index row of the dataset ds, stored at path. """
+    view = _VIEW.match(str(ds.get('ImageComments', '')))
+    treatment_event, days_after_event = _treatment_progress(ds)
+    return {
+        'sop_instance_uid': str(ds.SOPInstanceUID),
+        'patient_id': str(ds.get('PatientID', '')),
+        'patient_name': str(ds.get('PatientName', '')),
+        'study_instance_uid': str(ds.get('StudyInstanceUID', '')),
+        'series_instance_uid': str(ds.get('SeriesInstanceUID', '')),
+        'session_date': str(ds.get('StudyDate') or ds.get('AcquisitionDate') or ds.get('ContentDate') or ''),
+        'view': view.group(1) if view else None,
+        'treatment_event': treatment_event,
+        'days_after_event': days_after_event,
+        'path': os.path.abspath(path) if path is not None else None,
+        'size': size,
+        'mtime': mtime,
+        'sha256': sha256,
+        'indexed_at': datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+    }
+
+
+def file_sha256(filename) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as dicom_file:
+        while True:
+            chunk = dicom_file.read(config.SAVE_BUFFER_SIZE)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def row_from_file(filename, sha256=False) -> Optional[Dict]:
+    """ The index row of a DICOM file, reading only its header. None if it cannot be read.
+
+    sha256: also hash the file, which means reading all of it.
+    """
+    try:
+        stat = os.stat(filename)
+        ds = read_header(filename, HEADER_KEYWORDS)
+        return row_from_dataset(
+            ds, filename, stat.st_size, stat.st_mtime,
+            file_sha256(filename) if sha256 else None)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.warning("Cannot index %s: %s", filename, e)
+        return None
+
+
+class ArchiveIndex(object):
+    """ Index of DICOM instances in the SQLite database at path.
+
+    Default path is config.INDEX_PATH.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.fspath(path or config.INDEX_PATH)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ The connection of the calling thread. """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            # Only used by this thread, but close() closes it from another one
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """ Close the connections of all threads, once they are done with them. """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def _upsert(self, rows):
+        with self.connection:
+            self.connection.executemany(_UPSERT, rows)
+
+    def add_dataset(self, ds, path=None, size=None, sha256=None):
+        """ Index the dataset ds, written to path. """
+        mtime = os.path.getmtime(path) if path is not None else None
+        self._upsert([row_from_dataset(ds, path, size, mtime, sha256)])
+
+    def add_file(self, filename, sha256=True) -> bool:
+        """ Index a DICOM file. Returns whether it could be read. """
+        row = row_from_file(filename, sha256)
+        if row is not None:
+            self._upsert([row])
+        return row is not None
+
+    def _unchanged(self, filenames):
+        """ The files of filenames indexed with their current size and modification time. """
+        unchanged = set()
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if self.connection.execute(
+                    'SELECT 1 FROM instances WHERE path = ? AND size = ? AND mtime = ?',
+                    (os.path.abspath(filename), stat.st_size, stat.st_mtime)).fetchone():
+                unchanged.add(filename)
+        return unchanged
+
+    def scan(self, filenames: Iterable, jobs=1, sha256=False) -> int:
+        """ Index DICOM files, reading their headers with jobs worker processes.
+
+        Files already indexed with the same size and modification time are
+        skipped. sha256: also hash the files, which means reading them whole.
+        Returns the number of files indexed.
+        """
+        filenames = [str(filename) for filename in filenames]
+        unchanged = self._unchanged(filenames)
+        filenames = [filename for filename in filenames if filename not in unchanged]
+        read = partial(row_from_file, sha256=sha256)
+        indexed = 0
+        batch = []
+        executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(filenames) > 1 else None
+        try:
+            rows = executor.map(read, filenames, chunksize=64) if executor else map(read, filenames)
+            for row in rows:
+                if row is None:
+                    continue
+                batch.append(row)
+                if len(batch) == _SCAN_BATCH:
+                    self._upsert(batch)
+                    indexed += len(batch)
+                    batch = []
+            self._upsert(batch)
+            indexed += len(batch)
+        finally:
+            if executor:
+                executor.shutdown()
+        logger.info("Indexed %d files, %d unchanged", indexed, len(unchanged))
+        return indexed
+
+    def record_sent(self, destination, dicom_files=(), dicom_datasets=()):
+        """ Record that dicom_files and dicom_datasets were sent to destination, indexing them if need be. """
+        sent_at = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        uids = [str(ds.SOPInstanceUID) for ds in dicom_datasets or ()]
+        rows = [row_from_dataset(ds) for ds in dicom_datasets or ()]
+        for filename in dicom_files or ():
+            row = self.connection.execute(
+                'SELECT sop_instance_uid FROM instances WHERE path = ?', (os.path.abspath(filename),)).fetchone()
+            if row is None:
+                row = row_from_file(filename)
+                if row is None:
+                    continue
+                rows.append(row)
+            uids.append(row['sop_instance_uid'])
+        with self.connection:
+            self.connection.executemany(_UPSERT, rows)
+            self.connection.executemany(
+                'UPDATE instances SET sent_at = ?, destination = ? WHERE sop_instance_uid = ?',
+                [(sent_at, destination, uid) for uid in uids])
+
+    def query(self, patient_id=None, session_date=None, view=None, study_instance_uid=None,
+              sent=None, limit=None) -> List[Dict]:
+        """ Indexed instances matching all the filters given, by patient, session date and view.
+
+        sent: True for instances sent somewhere, False for those never sent.
+        """
+        where, parameters = self._filters(patient_id, session_date, view, study_instance_uid)
+        if sent is not None:
+            where.append('sent_at IS NOT NULL' if sent else 'sent_at IS NULL')
+        sql = 'SELECT * FROM instances'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY patient_id, session_date, view, sop_instance_uid'
+        if limit:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    @staticmethod
+    def _filters(patient_id=None, session_date=None, view=None, study_instance_uid=None):
+        where, parameters = [], []
+        for column, value in (('patient_id', patient_id), ('session_date', session_date),
+                              ('view', view), ('study_instance_uid', study_instance_uid)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                parameters.append(value)
+        return where, parameters
+
+    def missing_views(self, views, patient_id=None, session_date=None) -> List[Dict]:
+        """ The sessions, a patient on a date, which lack some of views.
+
+        Returns a list of {'patient_id', 'session_date', 'missing'}, where
+        missing are the views of views without any instance.
+        """
+        views = list(dict.fromkeys(views))
+        if not views:
+            return []
+        where, parameters = self._filters(patient_id, session_date)
+        sql = """
+            WITH required (view) AS (VALUES {required}),
+            sessions AS (SELECT DISTINCT patient_id, session_date FROM instances {where})
+            SELECT sessions.patient_id, sessions.session_date, required.view
+            FROM sessions CROSS JOIN required
+            WHERE NOT EXISTS (
+                SELECT 1 FROM instances
+                WHERE instances.patient_id IS sessions.patient_id
+                AND instances.session_date IS sessions.session_date
+                AND instances.view = required.view)
+            ORDER BY sessions.patient_id, sessions.session_date
+        """.format(
+            required=', '.join('(?)' for _ in views),
+            where='WHERE ' + ' AND '.join(where) if where else '')
+        sessions = {}
+        for row in self.connection.execute(sql, views + parameters):
+            sessions.setdefault((row['patient_id'], row['session_date']), []).append(row['view'])
+        return [{'patient_id': patient_id, 'session_date': session_date,
+                 'missing': sorted(missing, key=views.index)}
+                for (patient_id, session_date), missing in sessions.items()]
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM instances').fetchone()[0]
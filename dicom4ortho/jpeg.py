@@ -0,0 +1,110 @@
+""" Just enough of JPEG and MPO to split a file into frames without decoding it.
+
+An MPO file (CIPA DC-007, Multi-Picture Format) is a sequence of JPEG
+images. Its first image carries an APP2 "MPF" segment, a small TIFF
+structure whose MP Entry tag lists the size and offset of every image.
+Cameras use it for stereo pairs, bursts and large preview images.
+"""
+
+import struct
+from typing import List, Optional, Tuple
+
+SOI = 0xFFD8
+SOS = 0xFFDA
+APP2 = 0xFFE2
+# Start Of Frame markers: C0 to CF, except DHT (C4), JPG (C8) and DAC (CC)
+SOF_MARKERS = frozenset(range(0xFFC0, 0xFFD0)) - {0xFFC4, 0xFFC8, 0xFFCC}
+# Markers without a length
+STANDALONE_MARKERS = frozenset(range(0xFFD0, 0xFFD8)) | {0xFF01}
+
+MPF_IDENTIFIER = b'MPF\0'
+MP_ENTRY = 0xB002
+MP_ENTRY_SIZE = 16
+
+
+class JPEGError(ValueError):
+    """ Not a JPEG image which can be split as it is. """
+
+
+def _segments(data):
+    """ (marker, start of content, end of content) of the header segments of a JPEG, up to SOS. """
+    if len(data) < 2 or struct.unpack_from('>H', data)[0] != SOI:
+        raise JPEGError("JPEG does not start with SOI")
+    position = 2
+    while position + 4 <= len(data):
+        marker, = struct.unpack_from('>H', data, position)
+        if marker & 0xFF00 != 0xFF00:
+            raise JPEGError(f"No marker at {position}")
+        if marker == 0xFFFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            position += 2
+            continue
+        length, = struct.unpack_from('>H', data, position + 2)
+        yield marker, position + 4, position + 2 + length
+        if marker == SOS:
+            return
+        position += 2 + length
+
+
+def dimensions(data) -> Tuple[int, int]:
+    """ (width, height) of a JPEG, from its Start Of Frame segment. """
+    for marker, start, _ in _segments(data):
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, start + 1)
+            return width, height
+    raise JPEGError("JPEG without a Start Of Frame")
+
+
+def _mp_entries(data, start) -> Optional[List[Tuple[int, int]]]:
+    """ (offset in data, size) of the images listed in the MPF segment at start.
+
+    MP entries count offsets from the start of the TIFF header, except for
+    the first image, at offset 0, which starts the file.
+    """
+    tiff = start + len(MPF_IDENTIFIER)
+    byte_order = bytes(data[tiff:tiff + 2])
+    if byte_order == b'II':
+        endian = '<'
+    elif byte_order == b'MM':
+        endian = '>'
+    else:
+        raise JPEGError("MPF segment without a TIFF header")
+    ifd, = struct.unpack_from(endian + 'I', data, tiff + 4)
+    count, = struct.unpack_from(endian + 'H', data, tiff + ifd)
+    for entry in range(count):
+        tag, _, length, value = struct.unpack_from(endian + 'HHII', data, tiff + ifd + 2 + 12 * entry)
+        if tag == MP_ENTRY:
+            entries = []
+            for image in range(length // MP_ENTRY_SIZE):
+                _, size, offset = struct.unpack_from(endian + 'III', data, tiff + value + MP_ENTRY_SIZE * image)
+                entries.append((tiff + offset if offset else 0, size))
+            return entries
+    return None
+
+
+def frames(data) -> List[memoryview]:
+    """ The JPEG images in data, an MPO or a plain JPEG, as memoryviews of it.
+
+    The first one is the primary image. A plain JPEG is a single frame.
+
+    Some writers get the sizes of the MP entries wrong, so an image never
+    runs into the next one, or past the end of data.
+    """
+    view = memoryview(data)
+    for marker, start, _ in _segments(view):
+        if marker == APP2 and view[start:start + len(MPF_IDENTIFIER)] == MPF_IDENTIFIER:
+            entries = _mp_entries(view, start)
+            if not entries:
+                break
+            starts = sorted({offset for offset, _ in entries} | {len(view)})
+            images = []
+            for offset, size in entries:
+                if offset >= len(view):
+                    raise JPEGError(f"MP entry at {offset} is past the end of the file")
+                end = min(offset + size, next(s for s in starts if s > offset))
+                images.append(view[offset:end])
+            return images
+    return [view]
@@ -0,0 +1,151 @@
+""" Just enough of JPEG 2000 to encapsulate a codestream in DICOM as it is.
+
+DICOM encapsulates the bare JPEG 2000 codestream (ISO 15444-1 Annex A), not
+the JP2 file format around it (Annex I). codestream() takes the codestream
+out of a JP2 file, and parse() reads the image attributes DICOM needs from
+its SIZ and COD marker segments, so that the image never has to be decoded.
+
+See PS3.5 8.2.4 for how these map to the Image Pixel Module and to the
+transfer syntax.
+"""
+
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+JP2_SIGNATURE = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+
+# Markers of ISO 15444-1 Annex A
+SOC = 0xFF4F
+SIZ = 0xFF51
+COD = 0xFF52
+SOT = 0xFF90
+
+# Wavelet transformation of the COD marker segment, Table A.20
+IRREVERSIBLE_9_7 = 0
+REVERSIBLE_5_3 = 1
+
+# Enumerated colour spaces of the JP2 colr box, Table I.10
+SRGB = 16
+GREYSCALE = 17
+SYCC = 18
+
+
+class JPEG2000Error(ValueError):
+    """ Not a JPEG 2000 image which can be encapsulated as it is. """
+
+
+@dataclass
+class CodestreamInfo(object):
+    """ What DICOM needs to know about a JPEG 2000 codestream. """
+    columns: int
+    rows: int
+    components: int
+    bits_stored: int
+    signed: bool
+    reversible: bool
+    multiple_component_transform: bool
+    colour_space: Optional[int] = None
+    decomposition_levels: int = 0
+
+    @property
+    def bits_allocated(self) -> int:
+        return 8 if self.bits_stored <= 8 else 16
+
+    @property
+    def photometric_interpretation(self) -> str:
+        """ PS3.5 8.2.4 """
+        if self.components == 1:
+            return 'MONOCHROME2'
+        if self.multiple_component_transform:
+            return 'YBR_RCT' if self.reversible else 'YBR_ICT'
+        if self.colour_space == SYCC:
+            return 'YBR_FULL'
+        return 'RGB'
+
+
+def _boxes(data, start=0, end=None):
+    """ (type, start of content, end of content) of the JP2 boxes in data[start:end]. """
+    end = len(data) if end is None else end
+    position = start
+    while position + 8 <= end:
+        length, box_type = struct.unpack_from('>I4s', data, position)
+        header = 8
+        if length == 1:
+            length, = struct.unpack_from('>Q', data, position + 8)
+            header = 16
+        elif length == 0:
+            length = end - position
+        if length < header or position + length > end:
+            raise JPEG2000Error(f"Truncated JP2 box {box_type!r}")
+        yield box_type, position + header, position + length
+        position += length
+
+
+def codestream(data):
+    """ The JPEG 2000 codestream of data, a JP2 file or a codestream, as a memoryview.
+
+    Also returns the enumerated colour space of a JP2 file, or None.
+    """
+    view = memoryview(data)
+    if view[:len(JP2_SIGNATURE)] == JP2_SIGNATURE:
+        colour_space = None
+        for box_type, start, end in _boxes(view):
+            if box_type == b'jp2h':
+                for sub_type, sub_start, sub_end in _boxes(view, start, end):
+                    if sub_type == b'pclr':
+                        raise JPEG2000Error("Palette JP2 images cannot be encapsulated as they are")
+                    # Method 1 is an enumerated colour space
+                    if sub_type == b'colr' and view[sub_start] == 1 and colour_space is None:
+                        colour_space, = struct.unpack_from('>I', view, sub_start + 3)
+            elif box_type == b'jp2c':
+                return view[start:end], colour_space
+        raise JPEG2000Error("JP2 file without a codestream")
+    if len(view) >= 2 and struct.unpack_from('>H', view)[0] == SOC:
+        return view, None
+    raise JPEG2000Error("Neither a JP2 file nor a JPEG 2000 codestream")
+
+
+def parse(data, colour_space=None) -> CodestreamInfo:
+    """ Read the SIZ and COD marker segments of the main header of a codestream. """
+    if struct.unpack_from('>H', data)[0] != SOC:
+        raise JPEG2000Error("Codestream does not start with SOC")
+    position = 2
+    siz = cod = None
+    while position + 4 <= len(data) and (siz is None or cod is None):
+        marker, length = struct.unpack_from('>HH', data, position)
+        if marker == SOT:
+            break
+        if marker == SIZ:
+            siz = position + 4
+        elif marker == COD:
+            cod = position + 4
+        position += 2 + length
+    if siz is None or cod is None:
+        raise JPEG2000Error("Main header without SIZ or COD")
+
+    xsiz, ysiz, xosiz, yosiz = struct.unpack_from('>4I', data, siz + 2)
+    components, = struct.unpack_from('>H', data, siz + 34)
+    depths = set()
+    for component in range(components):
+        ssiz, xrsiz, yrsiz = struct.unpack_from('>3B', data, siz + 36 + 3 * component)
+        if (xrsiz, yrsiz) != (1, 1):
+            raise JPEG2000Error("Subsampled components cannot be encapsulated as they are")
+        depths.add(ssiz)
+    if len(depths) != 1 or components not in (1, 3):
+        raise JPEG2000Error(f"{components} components of depths {sorted(depths)} are not supported by DICOM")
+    ssiz = depths.pop()
+
+    multiple_component_transform, = struct.unpack_from('>B', data, cod + 4)
+    decomposition_levels, = struct.unpack_from('>B', data, cod + 5)
+    transformation, = struct.unpack_from('>B', data, cod + 9)
+    return CodestreamInfo(
+        columns=xsiz - xosiz,
+        rows=ysiz - yosiz,
+        components=components,
+        bits_stored=(ssiz & 0x7F) + 1,
+        signed=bool(ssiz & 0x80),
+        reversible=transformation == REVERSIBLE_5_3,
+        multiple_component_transform=bool(multiple_component_transform),
+        colour_space=colour_space,
+        decomposition_levels=decomposition_levels)
@@ -16,9 +16,10 @@ background.
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
+from pydicom.dataelem import RawDataElement
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 
@@ -30,20 +31,87 @@ logger = logging.getLogger(__name__)
 # Typed data layer
 # ---------------------------------------------------------------------------
 
-@dataclass(frozen=True)
+# (tag, VR, max length) of the three Basic Code Sequence Macro attributes.
+_CODE_ATTRIBUTES = (
+    (0x00080100, 'SH', None),   # CodeValue
+    (0x00080102, 'SH', None),   # CodingSchemeDesignator
+    (0x00080104, 'LO', 64),     # CodeMeaning
+)
+
+# Every DicomCode ever built, keyed by (value, scheme, meaning).
+_INTERNED_CODES: dict[tuple[str, str, str], DicomCode] = {}
+
+
+def _encode_code_elements(value: str, scheme: str, meaning: str) -> Optional[tuple[RawDataElement, ...]]:
+    """Pre-encode the code attributes as raw data elements.
+
+    SH and LO values are byte strings whose encoding does not depend on
+    endianness or implicit/explicit VR, so the same raw elements serve every
+    uncompressed transfer syntax and pydicom writes them out verbatim.
+
+    Returns None for non-ASCII values, whose bytes would depend on the
+    SpecificCharacterSet of the dataset they end up in.
+    """
+    elements = []
+    for (tag, vr, max_length), text in zip(_CODE_ATTRIBUTES, (value, scheme, meaning)):
+        if max_length is not None:
+            text = text[:max_length]
+        try:
+            encoded = text.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        if len(encoded) % 2:
+            encoded += b' '  # DICOM values have even length
+        elements.append(RawDataElement(
+            tag=tag, VR=vr, length=len(encoded), value=encoded,
+            value_tell=0, is_implicit_VR=False, is_little_endian=True))
+    return tuple(elements)
+
+
+@dataclass(frozen=True, slots=True)
 class DicomCode:
-    """A single DICOM coded entry (code value, scheme designator, code meaning)."""
+    """A single DICOM coded entry (code value, scheme designator, code meaning).
+
+    Codes are interned: constructing a code equal to an existing one returns
+    the existing object, so the same code shared across many views is held
+    in memory only once, together with its pre-encoded elements.
+    """
 
     value: str
     scheme: str
     meaning: str
+    _raw_elements: Optional[tuple[RawDataElement, ...]] = field(
+        init=False, repr=False, compare=False)
+
+    def __new__(cls, value: str, scheme: str, meaning: str):
+        code = _INTERNED_CODES.get((value, scheme, meaning))
+        if code is None:
+            code = object.__new__(cls)
+            _INTERNED_CODES[(value, scheme, meaning)] = code
+        return code
+
+    def __post_init__(self):
+        try:
+            self._raw_elements
+        except AttributeError:
+            object.__setattr__(self, '_raw_elements', _encode_code_elements(
+                self.value, self.scheme, self.meaning))
+
+    def __reduce__(self):
+        return (DicomCode, (self.value, self.scheme, self.meaning))
 
     def to_dataset(self) -> Dataset:
         """Return a pydicom Dataset representing this code."""
         ds = Dataset()
-        ds.CodeValue = self.value
-        ds.CodingSchemeDesignator = self.scheme
-        ds.CodeMeaning = self.meaning[:64]  # LO max 64 chars
+        if self._raw_elements is None:
+            ds.CodeValue = self.value
+            ds.CodingSchemeDesignator = self.scheme
+            ds.CodeMeaning = self.meaning[:64]  # LO max 64 chars
+            return ds
+        # Raw elements are immutable: pydicom converts them to a fresh
+        # DataElement on first access, so the cached copy is never modified.
+        for raw_element in self._raw_elements:
+            ds[raw_element.tag] = raw_element
         return ds
 
     def to_sequence(self) -> Sequence:
@@ -51,7 +119,7 @@ class DicomCode:
         return Sequence([self.to_dataset()])
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OrthoView:
     """A fully-typed representation of one row in views.csv.
 
@@ -0,0 +1,181 @@
+""" Modality Worklist attributes to copy into new IODs.
+
+The mapping from Modality Worklist attributes to attributes of the new IOD
+follows IHE RAD TF-2x. It is kept as tables of tags, resolved once at import
+time, so copying never goes through pydicom keyword lookups.
+
+A Modality Worklist item usually feeds a whole session of photographs, so
+the elements to copy are picked out of it once by ModalityWorklistTags and
+then applied to every dataset.
+"""
+
+import copy
+
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# MWL attribute -> attribute of the new IOD, copied as it is.
+MWL_ATTRIBUTE_MAP = (
+    # Study
+    ('StudyInstanceUID', 'StudyInstanceUID'),
+    ('ReferencedStudySequence', 'ReferencedStudySequence'),
+    ('AccessionNumber', 'AccessionNumber'),
+    ('IssuerOfAccessionNumberSequence', 'IssuerOfAccessionNumberSequence'),
+    ('InstitutionName', 'InstitutionName'),
+    ('InstitutionAddress', 'InstitutionAddress'),
+    ('InstitutionCodeSequence', 'InstitutionCodeSequence'),
+    ('PerformedProtocolCodeSequence', 'PerformedProtocolCodeSequence'),
+    ('PerformedProcedureStepID', 'PerformedProcedureStepID'),
+    # Recommended by IHE RAD TF-2x
+    ('RequestedProcedureCodeSequence', 'ProcedureCodeSequence'),
+    ('ReferencedSOPClassUID', 'ReferencedSOPClassUID'),
+    # Patient Identification
+    ('PatientName', 'PatientName'),
+    ('PatientID', 'PatientID'),
+    ('IssuerOfPatientID', 'IssuerOfPatientID'),
+    ('IssuerOfPatientIDQualifiersSequence', 'IssuerOfPatientIDQualifiersSequence'),
+    # Patient Demographic
+    ('PatientBirthDate', 'PatientBirthDate'),
+    ('PatientSex', 'PatientSex'),
+    ('ConfidentialityConstraintOnPatientDataDescription',
+     'ConfidentialityConstraintOnPatientDataDescription'),
+    ('EthnicGroup', 'EthnicGroup'),
+    ('PatientComments', 'PatientComments'),
+    # Patient Medical
+    ('PatientState', 'PatientState'),
+    ('PregnancyStatus', 'PregnancyStatus'),
+    ('MedicalAlerts', 'MedicalAlerts'),
+    ('PatientAge', 'PatientAge'),
+    ('PatientSize', 'PatientSize'),
+    ('PatientWeight', 'PatientWeight'),
+    ('SpecialNeeds', 'SpecialNeeds'),
+    ('AdmittingDiagnosesDescription', 'AdmittingDiagnosesDescription'),
+    ('AdmittingDiagnosesCodeSequence', 'AdmittingDiagnosesCodeSequence'),
+)
+
+# MWL attributes copied into the RequestAttributesSequence item.
+MWL_REQUEST_ATTRIBUTES = (
+    'AccessionNumber',
+    'RequestedProcedureID',
+    'RequestedProcedureDescription',
+    'ReasonForTheRequestedProcedure',
+    'ReasonForRequestedProcedureCodeSequence',
+    'ScheduledProcedureStepID',
+    'ScheduledProcedureStepDescription',
+)
+
+# MWL attributes whose copy depends on other attributes. See apply().
+MWL_CONDITIONAL_ATTRIBUTES = (
+    'StudyID',
+    'RequestedProcedureID',
+    'PerformedProcedureStepStartDate',
+    'PerformedProcedureStepStartTime',
+    'PerformedProcedureStepDescription',
+)
+
+_ATTRIBUTE_TAGS = {
+    tag_for_keyword(source): tag_for_keyword(target) for source, target in MWL_ATTRIBUTE_MAP}
+_REQUEST_TAGS = frozenset(tag_for_keyword(keyword) for keyword in MWL_REQUEST_ATTRIBUTES)
+_CONDITIONAL_TAGS = {tag_for_keyword(keyword): keyword for keyword in MWL_CONDITIONAL_ATTRIBUTES}
+_SCHEDULED_PROCEDURE_STEP_SEQUENCE = tag_for_keyword('ScheduledProcedureStepSequence')
+_SCHEDULED_PROTOCOL_CODE_SEQUENCE = tag_for_keyword('ScheduledProtocolCodeSequence')
+
+
+def _copy(element):
+    """ A copy of element to put into a dataset. Sequences are copied with their items. """
+    element = copy.copy(element)
+    if element.VR == 'SQ':
+        element.value = Sequence([_copy_item(item) for item in element.value])
+    return element
+
+
+def _copy_item(item: Dataset) -> Dataset:
+    copied = Dataset()
+    for element in item:
+        copied.add(_copy(element))
+    return copied
+
+
+class ModalityWorklistTags(object):
+    """ The elements of one Modality Worklist item to copy into new IODs.
+
+    Built with a single pass over the top level elements of the MWL. The
+    elements, and the items of sequences, are copied into each dataset they
+    are applied to, so changing an attribute of one photograph does not
+    affect the others.
+    """
+
+    def __init__(self, dicom_mwl: Dataset):
+        self.dicom_mwl = dicom_mwl
+        self._elements = []
+        self._request_elements = []
+        self._conditional = {}
+
+        for element in dicom_mwl:
+            tag = element.tag
+            target_tag = _ATTRIBUTE_TAGS.get(tag)
+            if target_tag == tag:
+                self._elements.append(element)
+            elif target_tag is not None:
+                retagged = copy.copy(element)
+                retagged.tag = target_tag
+                self._elements.append(retagged)
+            if tag in _REQUEST_TAGS:
+                self._request_elements.append(element)
+            keyword = _CONDITIONAL_TAGS.get(tag)
+            if keyword is not None:
+                self._conditional[keyword] = element
+
+        scheduled_procedure_steps = dicom_mwl.get(_SCHEDULED_PROCEDURE_STEP_SEQUENCE)
+        if scheduled_procedure_steps is not None and scheduled_procedure_steps.value:
+            scheduled_protocol_code = scheduled_procedure_steps.value[0].get(
+                _SCHEDULED_PROTOCOL_CODE_SEQUENCE)
+            if scheduled_protocol_code is not None:
+                self._request_elements.append(scheduled_protocol_code)
+
+    def apply(self, ds: Dataset) -> None:
+        """ Copy the Modality Worklist attributes into ds, as specified in IHE RAD TF-2x. """
+        for element in self._elements:
+            ds[element.tag] = _copy(element)
+
+        conditional = self._conditional
+        if 'StudyID' in conditional:
+            # RequestedProcedureID is recommended by IHE RAD TF-2x
+            ds.StudyID = (conditional.get('RequestedProcedureID') or conditional['StudyID']).value
+
+        # The values of the new IOD are recommended by IHE RAD TF-2x
+        for own, performed in (
+                ('StudyDate', 'PerformedProcedureStepStartDate'),
+                ('StudyTime', 'PerformedProcedureStepStartTime'),
+                ('StudyDescription', 'PerformedProcedureStepDescription')):
+            own_value = ds.get(own)
+            if own_value:
+                setattr(ds, performed, own_value)
+            elif performed in conditional:
+                ds[conditional[performed].tag] = _copy(conditional[performed])
+
+    def request_attributes(self) -> Dataset:
+        """ Return a new item for the RequestAttributesSequence. """
+        ras = Dataset()
+        for element in self._request_elements:
+            ras[element.tag] = _copy(element)
+        return ras
+
+    @property
+    def tags(self) -> frozenset:
+        """ Tags of the top level attributes apply() can copy into a dataset. """
+        return frozenset(
+            [element.tag for element in self._elements]
+            + [element.tag for element in self._conditional.values()]
+            + [tag_for_keyword('StudyID')])
+
+    @property
+    def requested_procedure_id(self):
+        element = self._conditional.get('RequestedProcedureID')
+        return element.value if element is not None else None
+
@@ -11,6 +11,7 @@ from pydicom.sequence import Sequence
 from pydicom.dataset import Dataset
 from dicom4ortho.config import VL_DENTAL_VIEW_CID, DICOM4ORTHO_ROOT_UID, DATE_FORMAT
 
+from dicom4ortho import metrics
 from dicom4ortho.model import PhotographBase
 from dicom4ortho.config import IMPORT_DATE_FORMAT, SeriesInstanceUID_ROOT, StudyInstanceUID_ROOT
 from dicom4ortho.utils import generate_dicom_uid
@@ -21,6 +22,97 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def apply_view(ds: Dataset, view: OrthoView, progress_items=()) -> None:
+    """Set all DICOM tags of a typed OrthoView into ds, in place.
+
+    progress_items: TID 3465 treatment progress items to add to the
+    AcquisitionContextSequence.
+    """
+    # ImageComments (0020,4000)
+    comments = f"{view.keyword}^{view.description}"
+    ds.ImageComments = comments.replace('\xa0', '\x20')
+
+    # SeriesDescription (0008,103E)
+    ds.SeriesDescription = view.series_description
+
+    # PatientOrientation (0020,0020) — absent when orientation cannot be determined
+    if view.patient_orientation is not None:
+        ds.PatientOrientation = list(view.patient_orientation)
+
+    # ImageLaterality (0020,0062)
+    ds.ImageLaterality = view.image_laterality
+
+    # DeviceSequence (0050,0010)
+    if view.devices:
+        ds.DeviceSequence = Sequence(
+            [c.to_dataset() for c in view.devices])
+
+    # AnatomicRegionSequence (0008,2218)
+    ar_ds = view.anatomic_region.to_dataset()
+    if view.anatomic_region_modifier is not None:
+        ar_ds.AnatomicRegionModifierSequence = Sequence(
+            [view.anatomic_region_modifier.to_dataset()])
+    ds.AnatomicRegionSequence = Sequence([ar_ds])
+
+    # ViewCodeSequence (0054,0220)
+    if view.view_code is not None:
+        vc_ds = view.view_code.to_dataset()
+        if view.view_modifiers:
+            vc_ds.ViewModifierCodeSequence = Sequence(
+                [c.to_dataset() for c in view.view_modifiers])
+        ds.ViewCodeSequence = Sequence([vc_ds])
+    # PrimaryAnatomicStructureSequence (0008,2228)
+    if view.primary_anatomic_structure is not None:
+        pas_ds = view.primary_anatomic_structure.to_dataset()
+        if view.primary_anatomic_structure_modifier is not None:
+            pas_ds.PrimaryAnatomicStructureModifierSequence = Sequence(
+                [view.primary_anatomic_structure_modifier.to_dataset()])
+        ds.PrimaryAnatomicStructureSequence = Sequence([pas_ds])
+
+    # AcquisitionContextSequence (0040,0555) — TID 3465
+    ds.AcquisitionContextSequence = Sequence(
+        acquisition_context_items(view, progress_items))
+
+
+def acquisition_context_items(view: OrthoView, progress_items=()) -> list:
+    """Build TID 3465 AcquisitionContextSequence items from a typed OrthoView."""
+    items = []
+
+    def _code_item(concept_name_code, concept_code) -> Dataset:
+        item = Dataset()
+        item.ValueType = 'CODE'
+        item.ConceptNameCodeSequence = concept_name_code.to_sequence()
+        item.ConceptCodeSequence = concept_code.to_sequence()
+        return item
+
+    # TID 3465 row 1: OrthognathicFunctionalCondition (130325, DCM)
+    if view.orthognathic_functional_conditions:
+        cn = CODES['OrthognathicFunctionalConditions']
+        for code in view.orthognathic_functional_conditions:
+            items.append(_code_item(cn, code))
+
+    # TID 3465 row 2: FindingByInspection (118243007, SCT)
+    if view.findings_by_inspection:
+        cn = CODES['FindingByInspection']
+        for code in view.findings_by_inspection:
+            items.append(_code_item(cn, code))
+
+    # TID 3465 row 3: ObservableEntity (363787002, SCT)
+    if view.observable_entities:
+        cn = CODES['ObservableEntity']
+        for code in view.observable_entities:
+            items.append(_code_item(cn, code))
+
+    # TID 3465 row 4: DentalOcclusion (25272006, SCT)
+    if view.dental_occlusion is not None:
+        items.append(_code_item(CODES['DentalOcclusion'], view.dental_occlusion))
+
+    # TID 3465 rows 5-6: Treatment progress (set by library user)
+    items.extend(progress_items)
+
+    return items
+
+
 class OrthodonticPhotograph(PhotographBase):
     """ An Orthodontic Photograph as defined in WP-1100
 
@@ -64,9 +156,7 @@ class OrthodonticPhotograph(PhotographBase):
             except (ValueError, TypeError):
                 logger.warning("Invalid Patient Birthdate provided.")
 
-        self.study_instance_uid = metadata.get('study_instance_uid')
         self.study_description = metadata.get('study_description')
-        self.series_instance_uid = metadata.get('series_instance_uid')
         self.series_description = metadata.get('series_description')
         self.patient_firstname = metadata.get('patient_firstname', '')
         self.patient_lastname = metadata.get('patient_lastname', '')
@@ -208,90 +298,14 @@ class OrthodonticPhotograph(PhotographBase):
         if view.view_code is None and self._view_code_keyword:
             self.set_view_code(self._view_code_keyword)
 
+    @metrics.timed('apply_view')
     def _apply_view(self, view: OrthoView) -> None:
         """Set all DICOM tags from a typed OrthoView."""
-        # ImageComments (0020,4000)
-        comments = f"{view.keyword}^{view.description}"
-        self._ds.ImageComments = comments.replace('\xa0', '\x20')
-
-        # SeriesDescription (0008,103E)
-        self._ds.SeriesDescription = view.series_description
-
-        # PatientOrientation (0020,0020) — absent when orientation cannot be determined
-        if view.patient_orientation is not None:
-            self._ds.PatientOrientation = list(view.patient_orientation)
-
-        # ImageLaterality (0020,0062)
-        self._ds.ImageLaterality = view.image_laterality
-
-        # DeviceSequence (0050,0010)
-        if view.devices:
-            self._ds.DeviceSequence = Sequence(
-                [c.to_dataset() for c in view.devices])
-
-        # AnatomicRegionSequence (0008,2218)
-        ar_ds = view.anatomic_region.to_dataset()
-        if view.anatomic_region_modifier is not None:
-            ar_ds.AnatomicRegionModifierSequence = Sequence(
-                [view.anatomic_region_modifier.to_dataset()])
-        self._ds.AnatomicRegionSequence = Sequence([ar_ds])
-
-        # ViewCodeSequence (0054,0220)
-        if view.view_code is not None:
-            vc_ds = view.view_code.to_dataset()
-            if view.view_modifiers:
-                vc_ds.ViewModifierCodeSequence = Sequence(
-                    [c.to_dataset() for c in view.view_modifiers])
-            self._ds.ViewCodeSequence = Sequence([vc_ds])
-        # PrimaryAnatomicStructureSequence (0008,2228)
-        if view.primary_anatomic_structure is not None:
-            pas_ds = view.primary_anatomic_structure.to_dataset()
-            if view.primary_anatomic_structure_modifier is not None:
-                pas_ds.PrimaryAnatomicStructureModifierSequence = Sequence(
-                    [view.primary_anatomic_structure_modifier.to_dataset()])
-            self._ds.PrimaryAnatomicStructureSequence = Sequence([pas_ds])
-
-        # AcquisitionContextSequence (0040,0555) — TID 3465
-        self._ds.AcquisitionContextSequence = Sequence(
-            self._build_acquisition_context_items(view))
+        apply_view(self._ds, view, self._make_progress_items())
 
     def _build_acquisition_context_items(self, view: OrthoView) -> list:
         """Build TID 3465 AcquisitionContextSequence items from a typed OrthoView."""
-        items = []
-
-        def _code_item(concept_name_code, concept_code) -> Dataset:
-            ds = Dataset()
-            ds.ValueType = 'CODE'
-            ds.ConceptNameCodeSequence = concept_name_code.to_sequence()
-            ds.ConceptCodeSequence = concept_code.to_sequence()
-            return ds
-
-        # TID 3465 row 1: OrthognathicFunctionalCondition (130325, DCM)
-        if view.orthognathic_functional_conditions:
-            cn = CODES['OrthognathicFunctionalConditions']
-            for code in view.orthognathic_functional_conditions:
-                items.append(_code_item(cn, code))
-
-        # TID 3465 row 2: FindingByInspection (118243007, SCT)
-        if view.findings_by_inspection:
-            cn = CODES['FindingByInspection']
-            for code in view.findings_by_inspection:
-                items.append(_code_item(cn, code))
-
-        # TID 3465 row 3: ObservableEntity (363787002, SCT)
-        if view.observable_entities:
-            cn = CODES['ObservableEntity']
-            for code in view.observable_entities:
-                items.append(_code_item(cn, code))
-
-        # TID 3465 row 4: DentalOcclusion (25272006, SCT)
-        if view.dental_occlusion is not None:
-            items.append(_code_item(CODES['DentalOcclusion'], view.dental_occlusion))
-
-        # TID 3465 rows 5-6: Treatment progress (set by library user)
-        items.extend(self._make_progress_items())
-
-        return items
+        return acquisition_context_items(view, self._make_progress_items())
 
     def _make_progress_items(self) -> list:
         """Build TID 3465 rows 5-6 from treatment_event_type and days_after_event."""
@@ -0,0 +1,193 @@
+""" Timing spans and counters of the conversion pipeline.
+
+Instrumentation is off unless a sink is configured, with configure() or the
+``--metrics`` command line option or the DICOM4ORTHO_METRICS environment
+variable, which take the same values:
+
+    summary     : keep everything in a Collector and print span percentiles
+                  and counters to stderr on exit.
+    -           : write JSON lines to stderr.
+    <filename>  : append JSON lines to a file.
+
+When off, a span costs one global lookup.
+
+Worker processes configure themselves from DICOM4ORTHO_METRICS, which
+configure() sets. JSON lines from all processes go to the same file, one
+line per record; a summary only covers the process it was collected in.
+
+Spans:
+
+    read, image_format, build.<stage>, apply_view, prepare, exif, save,
+    to_byte, send
+
+Counters:
+
+    images, bytes_in, bytes_out, failures
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from prettytable import PrettyTable
+
+ENVIRONMENT_VARIABLE = 'DICOM4ORTHO_METRICS'
+SUMMARY = 'summary'
+STDERR = '-'
+
+_sink = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class JsonLinesSink(object):
+    """ Write each span and counter increment as a line of JSON. """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def span(self, name, seconds):
+        self._write({'type': 'span', 'name': name, 'seconds': seconds})
+
+    def count(self, name, value):
+        self._write({'type': 'count', 'name': name, 'value': value})
+
+    def _write(self, record):
+        record['time'] = time.time()
+        record['pid'] = os.getpid()
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+
+
+class Collector(object):
+    """ Keep spans and counters in memory, for percentiles. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def span(self, name, seconds):
+        with self._lock:
+            self.spans[name].append(seconds)
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] += value
+
+    def percentile(self, name, percent):
+        """ Nearest rank percentile of the span name, in seconds. """
+        durations = sorted(self.spans[name])
+        if not durations:
+            return None
+        rank = max(1, -(-len(durations) * percent // 100))
+        return durations[int(rank) - 1]
+
+    def __str__(self):
+        table = PrettyTable(['Span', 'Count', 'Total ms', 'p50 ms', 'p90 ms', 'p99 ms'])
+        table.align['Span'] = 'l'
+        for name in sorted(self.spans):
+            table.add_row([
+                name, len(self.spans[name]), f"{sum(self.spans[name]) * 1e3:.1f}",
+                *(f"{self.percentile(name, percent) * 1e3:.2f}" for percent in (50, 90, 99))])
+        counters = ', '.join(f"{name}={value}" for name, value in sorted(self.counters.items()))
+        return f"{table}\n{counters}"
+
+
+def set_sink(sink):
+    """ Send spans and counters to sink, or turn instrumentation off with None. """
+    global _sink  # pylint: disable=global-statement
+    _sink = sink
+
+
+def get_sink():
+    return _sink
+
+
+def enabled():
+    return _sink is not None
+
+
+def configure(target):
+    """ Configure the sink from a target, see the module docstring.
+
+    Returns the sink.
+    """
+    if not target:
+        set_sink(None)
+        return None
+    if target == SUMMARY:
+        sink = Collector()
+        atexit.register(lambda: print(sink, file=sys.stderr))
+    elif target == STDERR:
+        sink = JsonLinesSink(sys.stderr)
+    else:
+        sink = JsonLinesSink(open(target, 'a', encoding='utf-8'))  # pylint: disable=consider-using-with
+    os.environ[ENVIRONMENT_VARIABLE] = target
+    set_sink(sink)
+    return sink
+
+
+def span(name):
+    """ Context manager timing the block as the span name. """
+    if _sink is None:
+        return _NULL_SPAN
+    return _Span(_sink, name)
+
+
+class _Span(object):
+
+    def __init__(self, sink, name):
+        self._sink = sink
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._sink.span(self._name, time.perf_counter() - self._start)
+
+
+def timed(name):
+    """ Decorator timing each call of the function as the span name. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if sink is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                sink.span(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """ Add value to the counter name. """
+    sink = _sink
+    if sink is not None:
+        sink.count(name, value)
+
+
+def stage_hook(stage, seconds):
+    """ DicomBase stage_hook reporting each module stage as a build.<stage> span. """
+    sink = _sink
+    if sink is not None:
+        sink.span('build.' + stage.lstrip('_'), seconds)
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    configure(os.environ[ENVIRONMENT_VARIABLE])
@@ -2,15 +2,18 @@
 The model.
 """
 import datetime
+import hashlib
 import logging
 import io
+import struct
+import time
 from math import copysign
 
 from pydicom.sequence import Sequence
 from pydicom.dataset import FileDataset, DataElement, FileMetaDataset, Dataset
 from pydicom.datadict import tag_for_keyword
-from pydicom.encaps import encapsulate
-from pydicom.uid import JPEGBaseline8Bit,  ImplicitVRLittleEndian, ExplicitVRBigEndian, ExplicitVRLittleEndian, JPEG2000, VLPhotographicImageStorage
+from pydicom.encaps import encapsulate, encapsulate_extended
+from pydicom.uid import JPEGBaseline8Bit,  ImplicitVRLittleEndian, ExplicitVRBigEndian, ExplicitVRLittleEndian, JPEG2000, JPEG2000Lossless, VLPhotographicImageStorage
 from pydicom import dcmread, dcmwrite
 import numpy
 
@@ -18,41 +21,156 @@ import numpy
 from PIL import Image
 from PIL.ExifTags import TAGS
 
-from dicom4ortho import config
+from dicom4ortho import config, jpeg, jpeg2000, metrics, preview
 from dicom4ortho.utils import generate_dicom_uid
+from dicom4ortho.m_modality_worklist import ModalityWorklistTags
+from dicom4ortho.validation import FAST, ValidationError, validate_dataset
+from dicom4ortho.writer import FileWriter
 
 logger = logging.getLogger(__name__)
 
+_PIXEL_DATA_TAG = tag_for_keyword('PixelData')
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+# Sequence Delimitation Item, which ends values of undefined length
+_SEQUENCE_DELIMITER = struct.pack('<HHL', 0xFFFE, 0xE0DD, 0)
+
+
+class _CountingWriter(object):
+    """ Writable stream that counts the bytes written to it, and passes them on to fp if given.
+
+    Gives pydicom the tell() it needs on streams without one, like sockets.
+    Also hashes them into digest, a hashlib object, if given.
+    """
+
+    def __init__(self, fp=None, digest=None):
+        self.fp = fp
+        self.digest = digest
+        self.length = 0
+
+    def write(self, data):
+        if self.fp is not None:
+            self.fp.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.length += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.length
+
+    def close(self):
+        pass
+
+
+class _BufferWriter(object):
+    """ Writable stream over a preallocated buffer. """
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def write(self, data):
+        end = self.position + len(data)
+        if end > len(self.view):
+            raise ValueError(f"Buffer of {len(self.view)} bytes is too small")
+        self.view[self.position:end] = data
+        self.position = end
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
 
 class DicomBase(object):
     """ Functions and fields common to most DICOM images.
 
+    The dataset is built in a single pass over MODULE_STAGES, one method per
+    IOD module, each run exactly once. Subclasses extend MODULE_STAGES
+    rather than re-running the base stages in their own __init__.
+
     kwargs:
         dicom_mwl: DICOM dataset from a Modality Worklist. If set, the new IOD
         will copy tags from Modality Worklist as specified in IHE RAD TF-2x. If
-        not set, a new one will be created.
+        not set, a new one will be created. A ModalityWorklistTags is also
+        accepted, to share one Modality Worklist between many images.
 
         input_pil_image: PIL Image object. If set, the image will be used to set
         the image data. If not set, the input_image_filename will be used.
+
+        stage_hook: callable(stage_name, seconds), called after each stage
+        of MODULE_STAGES with the time it took. Useful for profiling.
+        Defaults to dicom4ortho.metrics.stage_hook when metrics are enabled.
+
+        validate: validate the dataset before save() and to_byte() write it.
+        validation.FAST only checks the values of the attributes set by
+        dicom4ortho, trusting the ones copied from the Modality Worklist.
+        validation.FULL checks all of them. Default is not to validate.
+
+        validation_report: a validation.ValidationReport to add the result
+        to, to report the issues of a whole batch at once. If not set, an
+        invalid dataset raises a validation.ValidationError and is not
+        written.
+
+        file_writer: the writer.FileWriter save() writes with. Default is
+        one with the fsync and direct_io kwargs, see config.SAVE_FSYNC and
+        config.SAVE_DIRECT_IO.
+
+        index: a dicom4ortho.index.ArchiveIndex to record the files save()
+        writes into, with their SHA-256, hashed while writing.
     """
 
+    MODULE_STAGES = (
+        '_set_dataset',
+        # Before the series: its request attributes set StudyID from the MWL
+        '_set_general_study',
+        '_set_general_series',
+        '_set_general_image',
+        '_set_acquisition_context',
+        '_set_sop_common',
+    )
+
     def __init__(self, **kwargs):
         self.sop_instance_uid = kwargs.get(
             "sop_instance_uid") or generate_dicom_uid(root=config.SOPInstanceUID_ROOT)
-        self.time_string = datetime.datetime.now().strftime(config.TIME_FORMAT)
-        self.date_string = datetime.datetime.now().strftime(config.DATE_FORMAT)
+        self._supplied_uids = {
+            'StudyInstanceUID': kwargs.get('study_instance_uid'),
+            'SeriesInstanceUID': kwargs.get('series_instance_uid'),
+        }
+        self._created = datetime.datetime.now().astimezone()
+        self.time_string = self._created.strftime(config.TIME_FORMAT)
+        self.date_string = self._created.strftime(config.DATE_FORMAT)
         self.input_image_filename = kwargs.get('input_image_filename')
         self.output_image_filename = kwargs.get('output_image_filename')
         self.input_image_bytes = kwargs.get('input_image_bytes')
         self.file_meta = FileMetaDataset()
         self.dicom_mwl = kwargs.get('dicom_mwl', None)
+        self._mwl_tags = None
         self._image_format = None  # Cache for image format
-        self._set_dataset()
-        self._set_general_series()
-        self._set_general_study()
-        self._set_general_image()
-        self._set_acquisition_context()
-        self._set_sop_common()
+        self._probed_image = None  # Image opened by the image_format probe
+        self.validate = kwargs.get('validate')
+        self.validation_report = kwargs.get('validation_report')
+        self.validation_result = None
+        self.file_writer = kwargs.get('file_writer') or FileWriter(
+            fsync=kwargs.get('fsync'), direct=kwargs.get('direct_io'))
+        self.index = kwargs.get('index')
+        self._build(kwargs.get('stage_hook'))
+
+    def _build(self, stage_hook=None):
+        """ Run every stage of MODULE_STAGES once, in order. """
+        if stage_hook is None and metrics.enabled():
+            stage_hook = metrics.stage_hook
+        if stage_hook is None:
+            for stage in self.MODULE_STAGES:
+                getattr(self, stage)()
+        else:
+            for stage in self.MODULE_STAGES:
+                start = time.perf_counter()
+                getattr(self, stage)()
+                stage_hook(stage, time.perf_counter() - start)
+        metrics.count('images')
 
     def set_file_meta(self):
         self.file_meta.MediaStorageSOPClassUID = VLPhotographicImageStorage
@@ -68,22 +186,31 @@ class DicomBase(object):
             preamble=config.DICOM_PREAMBLE)
 
         self._ds.PatientName = "^"
+        # PatientBirthDate is "2", i.e. required, empty if unknown
+        self._ds.PatientBirthDate = ""
 
     def _set_general_study(self):
         self._ds.AccessionNumber = ''
-        self._ds.StudyInstanceUID = generate_dicom_uid(
-            root=config.StudyInstanceUID_ROOT)
+        self._set_instance_uid('StudyInstanceUID', config.StudyInstanceUID_ROOT)
         self._ds.StudyID = config.IDS_NUMBERS
         # StudyDate and StudyTime are "2", i.e. required fields, empty if unknown
         self._ds.StudyDate = ""
         self._ds.StudyTime = ""
 
     def _set_general_series(self):
-        self._ds.SeriesInstanceUID = generate_dicom_uid(
-            root=config.SeriesInstanceUID_ROOT)
+        self._set_instance_uid('SeriesInstanceUID', config.SeriesInstanceUID_ROOT)
         self._ds.SeriesNumber = config.IDS_NUMBERS
         self._set_request_attributes()
 
+    def _set_instance_uid(self, keyword, root):
+        """ Set a Study or Series Instance UID, generating one only if needed.
+
+        A UID passed to the constructor, or one already in the dataset, is
+        kept, so no UID is generated just to be replaced later.
+        """
+        uid = self._supplied_uids.get(keyword) or self._ds.get(keyword)
+        setattr(self._ds, keyword, uid or generate_dicom_uid(root=root))
+
     def _set_general_image(self):
         self._ds.InstanceNumber = config.IDS_NUMBERS
         self._ds_PatientOrientation = ''
@@ -94,7 +221,7 @@ class DicomBase(object):
     def _set_sop_common(self):
         self._ds.SpecificCharacterSet = "ISO_IR 192"  # UTF-8
         self._ds.SOPInstanceUID = self.sop_instance_uid
-        self._ds.TimezoneOffsetFromUTC = datetime.datetime.now().astimezone().strftime("%z")
+        self._ds.TimezoneOffsetFromUTC = self._created.strftime("%z")
 
     def _set_name(self, tagname, name, position):
         """ Helper function for setting firstname of PN Datatype
@@ -124,168 +251,43 @@ class DicomBase(object):
     def copy_mwl_tags(self, dicom_mwl=None):
         """ Copy tags from Modality Worklist to the new IOD.
 
-        This is done according to IHE RAD TF-2x.
+        This is done according to IHE RAD TF-2x, see m_modality_worklist.
 
+        dicom_mwl can also be a ModalityWorklistTags, to reuse the same
+        Modality Worklist for many images without sorting it out each time.
         """
         if self.dicom_mwl is None:
             self.dicom_mwl = dicom_mwl
 
-        if self.dicom_mwl is None:
+        mwl_tags = self._modality_worklist_tags()
+        if mwl_tags is None:
             logger.warning("No Modality Worklist to copy tags from.")
             return
 
-        if 'StudyInstanceUID' in self.dicom_mwl:
-            self._ds.StudyInstanceUID = self.dicom_mwl.StudyInstanceUID
-
-        if 'ReferencedStudySequence' in self.dicom_mwl:
-            self._ds.ReferencedStudySequence = self.dicom_mwl.ReferencedStudySequence
-
-        if 'AccessionNumber' in self.dicom_mwl:
-            self._ds.AccessionNumber = self.dicom_mwl.AccessionNumber
-
-        if 'IssuerOfAccessionNumberSequence' in self.dicom_mwl:
-            self._ds.IssuerOfAccessionNumberSequence = self.dicom_mwl.IssuerOfAccessionNumberSequence
-
-        if 'InstitutionName' in self.dicom_mwl:
-            self._ds.InstitutionName = self.dicom_mwl.InstitutionName
-
-        if 'InstitutionAddress' in self.dicom_mwl:
-            self._ds.InstitutionAddress = self.dicom_mwl.InstitutionAddress
-
-        if 'InstitutionCodeSequence' in self.dicom_mwl:
-            self._ds.InstitutionCodeSequence = self.dicom_mwl.InstitutionCodeSequence
-
-        if 'PerformedProtocolCodeSequence' in self.dicom_mwl:
-            self._ds.PerformedProtocolCodeSequence = self.dicom_mwl.PerformedProtocolCodeSequence
-
-        if 'StudyID' in self.dicom_mwl:
-            if 'RequestedProcedureID' in self.dicom_mwl:
-                # Recommended by IHE RAD TF-2x
-                self._ds.StudyID = self.dicom_mwl.RequestedProcedureID
-            else:
-                self._ds.StudyID = self.dicom_mwl.StudyID
-
-        if 'PerformedProcedureStepID' in self.dicom_mwl:
-            self._ds.PerformedProcedureStepID = self.dicom_mwl.PerformedProcedureStepID
-
-        if self._ds.StudyDate:
-            # Recommended by IHE RAD TF-2x
-            self._ds.PerformedProcedureStepStartDate = self._ds.StudyDate
-        elif 'PerformedProcedureStepStartDate' in self.dicom_mwl:
-            self._ds.PerformedProcedureStepStartDate = self.dicom_mwl.PerformedProcedureStepStartDate
-
-        if self._ds.StudyTime:
-            # Recommended by IHE RAD TF-2x
-            self._ds.PerformedProcedureStepStartTime = self._ds.StudyTime
-        elif 'PerformedProcedureStepStartTime' in self.dicom_mwl:
-            self._ds.PerformedProcedureStepStartTime = self.dicom_mwl.PerformedProcedureStepStartTime
-
-        if self._ds.StudyDescription:
-            # Recommended by IHE RAD TF-2x
-            self._ds.PerformedProcedureStepDescription = self._ds.StudyDescription
-        elif 'PerformedProcedureStepDescription' in self.dicom_mwl:
-            self._ds.PerformedProcedureStepDescription = self.dicom_mwl.PerformedProcedureStepDescription
-
-        if 'RequestedProcedureCodeSequence' in self.dicom_mwl:
-            # Recommended by IHE RAD TF-2x
-            self._ds.ProcedureCodeSequence = self.dicom_mwl.RequestedProcedureCodeSequence
-
-        if 'ReferencedSOPClassUID' in self.dicom_mwl:
-            self._ds.ReferencedSOPClassUID = self.dicom_mwl.ReferencedSOPClassUID
-
-        # Patient Identification
-        if 'PatientName' in self.dicom_mwl:
-            self._ds.PatientName = self.dicom_mwl.PatientName
-
-        if 'PatientID' in self.dicom_mwl:
-            self._ds.PatientID = self.dicom_mwl.PatientID
-
-        if 'IssuerOfPatientID' in self.dicom_mwl:
-            self._ds.IssuerOfPatientID = self.dicom_mwl.IssuerOfPatientID
-
-        if 'IssuerOfPatientIDQualifiersSequence' in self.dicom_mwl:
-            self._ds.IssuerOfPatientIDQualifiersSequence = self.dicom_mwl.IssuerOfPatientIDQualifiersSequence
-
-        # Patient Demographic
-        if 'PatientBirthDate' in self.dicom_mwl:
-            self._ds.PatientBirthDate = self.dicom_mwl.PatientBirthDate
-
-        if 'PatientSex' in self.dicom_mwl:
-            self._ds.PatientSex = self.dicom_mwl.PatientSex
-
-        if 'ConfidentialityConstraintOnPatientDataDescription' in self.dicom_mwl:
-            self._ds.ConfidentialityConstraintOnPatientDataDescription = self.dicom_mwl.ConfidentialityConstraintOnPatientDataDescription
-
-        if 'EthnicGroup' in self.dicom_mwl:
-            self._ds.EthnicGroup = self.dicom_mwl.EthnicGroup
-
-        if 'PatientComments' in self.dicom_mwl:
-            self._ds.PatientComments = self.dicom_mwl.PatientComments
-
-        # Patient Medical
-        if 'PatientState' in self.dicom_mwl:
-            self._ds.PatientState = self.dicom_mwl.PatientState
-
-        if 'PregnancyStatus' in self.dicom_mwl:
-            self._ds.PregnancyStatus = self.dicom_mwl.PregnancyStatus
-
-        if 'MedicalAlerts' in self.dicom_mwl:
-            self._ds.MedicalAlerts = self.dicom_mwl.MedicalAlerts
-
-        if 'PatientAge' in self.dicom_mwl:
-            self._ds.PatientAge = self.dicom_mwl.PatientAge
-
-        if 'PatientSize' in self.dicom_mwl:
-            self._ds.PatientSize = self.dicom_mwl.PatientSize
+        mwl_tags.apply(self._ds)
 
-        if 'PatientWeight' in self.dicom_mwl:
-            self._ds.PatientWeight = self.dicom_mwl.PatientWeight
-
-        if 'SpecialNeeds' in self.dicom_mwl:
-            self._ds.SpecialNeeds = self.dicom_mwl.SpecialNeeds
-
-        if 'AdmittingDiagnosesDescription' in self.dicom_mwl:
-            self._ds.AdmittingDiagnosesDescription = self.dicom_mwl.AdmittingDiagnosesDescription
-
-        if 'AdmittingDiagnosesCodeSequence' in self.dicom_mwl:
-            self._ds.AdmittingDiagnosesCodeSequence = self.dicom_mwl.AdmittingDiagnosesCodeSequence
+    def _modality_worklist_tags(self):
+        """ Return the ModalityWorklistTags of dicom_mwl, computed once. """
+        if isinstance(self.dicom_mwl, ModalityWorklistTags):
+            self._mwl_tags = self.dicom_mwl
+            self.dicom_mwl = self._mwl_tags.dicom_mwl
+        elif self.dicom_mwl is None:
+            self._mwl_tags = None
+        elif self._mwl_tags is None or self._mwl_tags.dicom_mwl is not self.dicom_mwl:
+            self._mwl_tags = ModalityWorklistTags(self.dicom_mwl)
+        return self._mwl_tags
 
     def _set_request_attributes(self):
-        if self.dicom_mwl is None:
+        mwl_tags = self._modality_worklist_tags()
+        if mwl_tags is None:
             logger.warning("No Modality Worklist to copy tags from.")
             return
 
-        ras = Dataset()
-        if 'AccessionNumber' in self.dicom_mwl:
-            ras.AccessionNumber = self.dicom_mwl.AccessionNumber
-
-        if 'RequestedProcedureID' in self.dicom_mwl:
+        if mwl_tags.requested_procedure_id is not None:
             # Recommended by IHE RAD TF-2x
-            self._ds.StudyID = self.dicom_mwl.RequestedProcedureID
-            ras.RequestedProcedureID = self.dicom_mwl.RequestedProcedureID
-
-        if 'RequestedProcedureDescription' in self.dicom_mwl:
-            ras.RequestedProcedureDescription = self.dicom_mwl.RequestedProcedureDescription
-
-        if 'ReasonForTheRequestedProcedure' in self.dicom_mwl:
-            ras.ReasonForTheRequestedProcedure = self.dicom_mwl.ReasonForTheRequestedProcedure
-
-        if 'ReasonForRequestedProcedureCodeSequence' in self.dicom_mwl:
-            ras.ReasonForRequestedProcedureCodeSequence = self.dicom_mwl.ReasonForRequestedProcedureCodeSequence
+            self._ds.StudyID = mwl_tags.requested_procedure_id
 
-        if 'ScheduledProcedureStepID' in self.dicom_mwl:
-            ras.ScheduledProcedureStepID = self.dicom_mwl.ScheduledProcedureStepID
-
-        if 'ScheduledProcedureStepDescription' in self.dicom_mwl:
-            ras.ScheduledProcedureStepDescription = self.dicom_mwl.ScheduledProcedureStepDescription
-
-        if 'ScheduledProcedureStepSequence' in self.dicom_mwl and self.dicom_mwl.ScheduledProcedureStepSequence:
-            if 'ScheduledProtocolCodeSequence' in self.dicom_mwl.ScheduledProcedureStepSequence[0]:
-                ras.ScheduledProtocolCodeSequence = self.dicom_mwl.ScheduledProcedureStepSequence[
-                    0].ScheduledProtocolCodeSequence
-
-        self._ds.RequestAttributesSequence = Sequence([])
-        self._ds.RequestAttributesSequence.append(ras)
+        self._ds.RequestAttributesSequence = Sequence([mwl_tags.request_attributes()])
 
     def _set_referenced_performed_procedure_step(self):
         rpps = Dataset()
@@ -295,6 +297,7 @@ class DicomBase(object):
         self._ds.ReferencedPerformedProcedureStepSequence = Sequence([])
         self._ds.ReferencedPerformedProcedureStepSequence.append(rpps)
 
+    @metrics.timed('read')
     def _input_filename_to_image_bytes(self) -> bytes:
         try:
             with open(self.input_image_filename, "rb") as image_file:
@@ -310,10 +313,16 @@ class DicomBase(object):
     @property
     def image_format(self):
         if self._image_format is None:
-            im = Image.open(io.BytesIO(self.image_bytes))
-            self._image_format = im.format
+            with metrics.span('image_format'):
+                self._probed_image = Image.open(io.BytesIO(self.image_bytes))
+            self._image_format = self._probed_image.format
         return self._image_format
 
+    def _open_image(self) -> Image.Image:
+        """ The image, opened but not decoded yet. Takes over the one the image_format probe opened. """
+        im, self._probed_image = self._probed_image, None
+        return im or Image.open(io.BytesIO(self.image_bytes))
+
     @property
     def image_bytes(self) -> Image:
         if self.input_image_bytes is None:
@@ -719,20 +728,119 @@ class DicomBase(object):
     def to_dataset(self):
         return self._ds
 
-    def to_byte(self):
-        """Return a bytes-like object which can be accessed with read() and seek()."""
-
+    def _validate_on_write(self):
+        """ Validate the dataset about to be written, if asked to. See validate in the class docstring. """
+        if not self.validate:
+            return
+        tags = None
+        if self.validate == FAST:
+            mwl_tags = self._modality_worklist_tags()
+            tags = set(self._ds.keys())
+            if mwl_tags is not None:
+                tags -= mwl_tags.tags
+        with metrics.span('validate'):
+            self.validation_result = validate_dataset(
+                self._ds, source=self.output_image_filename or self.sop_instance_uid, tags=tags)
+        if self.validation_report is not None:
+            self.validation_report.add(self.validation_result)
+        elif not self.validation_result.is_valid:
+            raise ValidationError([self.validation_result])
+
+    def _pixel_data_to_write_apart(self):
+        """ The PixelData element, if it can be written after the rest of the dataset without pydicom.
+
+        pydicom copies each value into a buffer before writing it, which for
+        PixelData is as big as the whole file. PixelData is usually the last
+        element, so it is written apart, straight from its value. Big endian
+        datasets are left to pydicom, which may need to swap bytes.
+        """
+        element = self._ds.get(_PIXEL_DATA_TAG)
+        if (element is None or not self._ds.is_little_endian
+                or max(self._ds.keys()) != _PIXEL_DATA_TAG):
+            return None
+        return self._ds[_PIXEL_DATA_TAG]
+
+    def _pixel_data_header(self, element, length):
+        if self._ds.is_implicit_VR:
+            return struct.pack('<HHL', 0x7FE0, 0x0010, length)
+        return struct.pack('<HH2s2xL', 0x7FE0, 0x0010, element.VR.encode('ascii'), length)
+
+    def _write(self, fp):
+        """ Write the DICOM file into the writable binary stream fp. Returns the number of bytes written. """
+        fp = _CountingWriter(fp)
+        element = self._pixel_data_to_write_apart()
+        if element is None:
+            dcmwrite(fp, self._ds, write_like_original=False)
+            return fp.length
+
+        del self._ds[_PIXEL_DATA_TAG]
+        try:
+            dcmwrite(fp, self._ds, write_like_original=False)
+        finally:
+            self._ds[_PIXEL_DATA_TAG] = element
+        value = element.value
+        padding = b'\0' if len(value) % 2 else b''
+        length = _UNDEFINED_LENGTH if element.is_undefined_length else len(value) + len(padding)
+        fp.write(self._pixel_data_header(element, length))
+        fp.write(value)
+        fp.write(padding)
+        if element.is_undefined_length:
+            fp.write(_SEQUENCE_DELIMITER)
+        return fp.length
+
+    def encoded_length(self) -> int:
+        """ Length in bytes of the DICOM file, without encoding the pixel data. """
         self.add_missing_instance_uids()
+        element = self._pixel_data_to_write_apart()
+        if element is None:
+            return self._write(_CountingWriter())
+        writer = _CountingWriter()
+        del self._ds[_PIXEL_DATA_TAG]
+        try:
+            dcmwrite(writer, self._ds, write_like_original=False)
+        finally:
+            self._ds[_PIXEL_DATA_TAG] = element
+        value_length = len(element.value)
+        delimiter_length = len(_SEQUENCE_DELIMITER) if element.is_undefined_length else 0
+        return (writer.length + len(self._pixel_data_header(element, 0))
+                + value_length + value_length % 2 + delimiter_length)
+
+    def write_to(self, fp) -> int:
+        """ Write the DICOM file into fp, a writable binary stream like an open file or socket.
+
+        Returns the number of bytes written. Nothing is copied in memory
+        besides the header elements, see _pixel_data_to_write_apart().
+        """
+        self.add_missing_instance_uids()
+        self._validate_on_write()
+        length = self._write(fp)
+        metrics.count('bytes_out', length)
+        return length
+
+    @metrics.timed('to_byte')
+    def to_buffer(self, buffer=None) -> memoryview:
+        """ Return the DICOM file as a memoryview.
+
+        buffer: a writable bytes-like object, like a bytearray or a slice of
+        a memoryview, to write the file into. It must be at least
+        encoded_length() bytes. Default is to allocate one of that length.
+        The returned memoryview is the part of buffer holding the file.
+        """
+        if buffer is None:
+            buffer = bytearray(self.encoded_length())
+        writer = _BufferWriter(buffer)
+        self.write_to(writer)
+        return writer.view[:writer.position]
 
-        # Create an in-memory file-like object
-        file_like = io.BytesIO()
-
-        # Write the DICOM dataset to the in-memory file-like object
-        dcmwrite(file_like, self._ds)
+    @metrics.timed('to_byte')
+    def to_byte(self):
+        """Return a bytes-like object which can be accessed with read() and seek().
 
-        # Seek to the beginning of the file-like object to read its contents
+        See to_buffer() and write_to() to avoid the copies of a BytesIO.
+        """
+        file_like = io.BytesIO()
+        self.write_to(file_like)
         file_like.seek(0)
-
         return file_like
 
     def prepare(self):
@@ -746,14 +854,23 @@ class DicomBase(object):
         self.add_missing_instance_uids()
 
     def save(self, filename=None):
-        """Save the byte stream to a file."""
+        """Save the byte stream to a file, atomically. See file_writer in the class docstring."""
         self.prepare()
         filename = filename or self.output_image_filename
-        self._ds.save_as(filename=filename, write_like_original=False)
+        self._validate_on_write()
+        with metrics.span('save'):
+            if self.index is None:
+                metrics.count('bytes_out', self.file_writer.write(filename, self._write))
+            else:
+                digest = hashlib.sha256()
+                length = self.file_writer.write(filename, lambda fp: self._write(_CountingWriter(fp, digest)))
+                metrics.count('bytes_out', length)
+                self.index.add_dataset(self._ds, filename, length, digest.hexdigest())
         logger.info("File [%s] saved.", filename)
 
-    def load(self, filename):
-        self._ds = dcmread(filename)
+    def load(self, filename, stop_before_pixels=False):
+        """ Read the dataset of a DICOM file. With stop_before_pixels, without its PixelData, which is much faster. """
+        self._ds = dcmread(filename, stop_before_pixels=stop_before_pixels)
 
     def print(self):
         print(self._ds)
@@ -762,28 +879,50 @@ class DicomBase(object):
 class PhotographBase(DicomBase):
     """
     A.32.4 VL Photographic Image IOD
+
+    kwargs, besides those of DicomBase:
+        icon: add an Icon Image Sequence, at most icon_size pixels wide and
+        high. Defaults are config.ICON_IMAGE and config.ICON_SIZE.
+
+        preview: make a JPEG preview, at most preview_size pixels wide and
+        high, of preview_quality, into preview_bytes. save() writes it to
+        preview_filename, by default next to the DICOM file with
+        config.PREVIEW_SUFFIX. Setting preview_filename implies preview.
+        Defaults are config.PREVIEW_SIZE and config.PREVIEW_QUALITY.
+
+    Icon and preview come from a single decode of the photograph at a
+    reduced size, in the same pass as the image data, see
+    dicom4ortho.preview.
     """
 
+    MODULE_STAGES = DicomBase.MODULE_STAGES + (
+        'set_file_meta',
+        '_set_vl_image',
+        'set_image',
+    )
+
     def __init__(self, **kwargs):
+        self.icon = config.ICON_IMAGE if kwargs.get('icon') is None else kwargs['icon']
+        self.icon_size = kwargs.get('icon_size') or config.ICON_SIZE
+        self.preview_filename = kwargs.get('preview_filename')
+        self.preview = bool(kwargs.get('preview') or self.preview_filename)
+        self.preview_size = kwargs.get('preview_size') or config.PREVIEW_SIZE
+        self.preview_quality = kwargs.get('preview_quality') or config.PREVIEW_QUALITY
+        self.preview_bytes = None
         super().__init__(**kwargs)
-        self.set_file_meta()
-        self.file_meta.MediaStorageSOPClassUID = VLPhotographicImageStorage
-        self._set_sop_common()
-        self._set_general_series()
-        self._set_vl_image()
-        input_image_filename = kwargs.get('input_image_filename', None)
-        if input_image_filename:
-            self.input_image_filename = input_image_filename
-
-        self.set_image()
 
+    @metrics.timed('prepare')
     def prepare(self):
         super().prepare()
         self.set_exif_tags()
 
     def save(self, filename=None):
-        self.prepare()
+        """ Save the DICOM file and, if asked for, the preview next to it. """
         super().save(filename)
+        if self.preview_bytes is not None:
+            preview_filename = self.preview_filename or preview.filename_for(filename or self.output_image_filename)
+            self.file_writer.write(preview_filename, lambda fp: fp.write(self.preview_bytes))
+            logger.info("Preview [%s] saved.", preview_filename)
 
     def _set_sop_common(self):
         super()._set_sop_common()
@@ -867,6 +1006,25 @@ class PhotographBase(DicomBase):
         elif lossy == False:
             self._ds.LossyImageCompression = '00'
 
+    def _set_reduced_images(self, im, resolution_levels=0):
+        """ Set the icon and make the preview asked for, from im, opened but not decoded yet. """
+        sizes = []
+        if self.icon:
+            sizes.append(self.icon_size)
+        if self.preview:
+            sizes.append(self.preview_size)
+        if not sizes:
+            return
+        with metrics.span('preview'):
+            small = preview.reduced(im, max(sizes), resolution_levels)
+            if self.preview:
+                preview_image = small.copy()
+                preview_image.thumbnail((self.preview_size, self.preview_size))
+                self.preview_bytes = preview.jpeg(preview_image, self.preview_quality)
+            if self.icon:
+                small.thumbnail((self.icon_size, self.icon_size))
+                self._ds.IconImageSequence = preview.icon_image_sequence(small)
+
     def _set_image_raw_data(self):
         """ Sets general Image Module Data and Metadata
 
@@ -881,7 +1039,7 @@ class PhotographBase(DicomBase):
             0
             The sample values for the first pixel are followed by the sample values for the second pixel, etc. For RGB images, this means the order of the pixel values encoded shall be R1, G1, B1, R2, G2, B2, …, etc.
         """
-        im = Image.open(io.BytesIO(self.image_bytes))
+        im = self._open_image()
         # Note
 
         # self._ds.Rows = im.size[1]
@@ -985,45 +1143,109 @@ class PhotographBase(DicomBase):
             print(
                 "ERROR: mode [{}] is not yet implemented.".format(im.mode))
             raise NotImplementedError
+        self._set_reduced_images(im)
         self._ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
         self._ds.is_little_endian = True
         self._ds.is_implicit_VR = False
 
-    def _set_image_jpeg2000_data(self):
-        """ Set Image Data for JPEG2000 Images.
+    def _set_encapsulated_frames(self, frames):
+        """ Encapsulate compressed frames into PixelData, one fragment per frame.
 
-        Encapsulates a JPEG2000 as it is, without touching anything.
+        The offset of each frame goes into a Basic Offset Table, or into an
+        Extended Offset Table once the frames are too large for the 32 bit
+        offsets of the former, see config.EXTENDED_OFFSET_TABLE_THRESHOLD.
+        Viewers can then go to any frame without parsing the ones before.
         """
-        im = Image.open(io.BytesIO(self.image_bytes))
-        self._ds.Rows = im.height
-        self._ds.Columns = im.width
+        frames = [bytes(frame) for frame in frames]
+        for keyword in ('ExtendedOffsetTable', 'ExtendedOffsetTableLengths'):
+            if keyword in self._ds:
+                delattr(self._ds, keyword)
+        if len(frames) > 1 and sum(len(frame) for frame in frames) > config.EXTENDED_OFFSET_TABLE_THRESHOLD:
+            pixel_data, offsets, lengths = encapsulate_extended(frames)
+            self._ds.PixelData = pixel_data
+            self._ds.ExtendedOffsetTable = offsets
+            self._ds.ExtendedOffsetTableLengths = lengths
+        else:
+            self._ds.PixelData = encapsulate(frames, has_bot=True)
+        if len(frames) > 1:
+            self._ds.NumberOfFrames = len(frames)
+        elif 'NumberOfFrames' in self._ds:
+            del self._ds.NumberOfFrames
+
+    def _set_image_jpeg2000_data(self):
+        """ Set Image Data for JPEG2000 Images.
 
-        image_bytes = io.BytesIO()
-        im.save(image_bytes, format='JPEG2000')
+        Encapsulates the JPEG2000 codestream as it is, without decoding it.
+        A JP2 file is stripped of its boxes, as DICOM only takes the bare
+        codestream. The Image Pixel attributes come from its SIZ and COD
+        marker segments, and the transfer syntax from its wavelet: 5-3
+        reversible is JPEG 2000 Lossless, 9-7 irreversible is JPEG 2000.
 
-        # Encapsulate the image bytes
-        self._ds.PixelData = encapsulate([image_bytes.getvalue()])
+        Codestreams DICOM cannot take as they are, like palette or
+        subsampled images, are decoded and encoded again, losslessly.
+        """
+        try:
+            data, colour_space = jpeg2000.codestream(self.image_bytes)
+            info = jpeg2000.parse(data, colour_space)
+            lossy = not info.reversible
+            resolution_levels = info.decomposition_levels
+        except jpeg2000.JPEG2000Error as e:
+            logger.warning("Encoding JPEG2000 image again: %s", e)
+            im = self._open_image()
+            image_bytes = io.BytesIO()
+            im.convert('L' if im.mode in ('1', 'L', 'LA', 'I;16') else 'RGB').save(
+                image_bytes, format='JPEG2000', irreversible=False, no_jp2=True)
+            data, colour_space = image_bytes.getbuffer(), None
+            info = jpeg2000.parse(data)
+            # Whatever loss there was in the original codestream is still there.
+            lossy = True
+            # Decoded already
+            self._probed_image = im
+            resolution_levels = 0
+
+        self._ds.Rows = info.rows
+        self._ds.Columns = info.columns
+
+        # Encapsulate the codestream
+        self._set_encapsulated_frames([data])
 
         self._ds['PixelData'].is_undefined_length = True
 
         # Values as defined in Part 5 Sect 8.2.4
         # https://dicom.nema.org/medical/dicom/current/output/chtml/part05/sect_8.2.4.html
-        self._ds.PhotometricInterpretation = 'RGB'
-        self._ds.SamplesPerPixel = 3
-        self._ds.PlanarConfiguration = 0
-        self._ds.PixelRepresentation = 0
-        self._ds.BitsAllocated = 8
-        self._ds.BitsStored = 8
-        self._ds.HighBit = 7
+        self._ds.PhotometricInterpretation = info.photometric_interpretation
+        self._ds.SamplesPerPixel = info.components
+        if info.components > 1:
+            self._ds.PlanarConfiguration = 0
+        elif 'PlanarConfiguration' in self._ds:
+            del self._ds.PlanarConfiguration
+        self._ds.PixelRepresentation = int(info.signed)
+        self._ds.BitsAllocated = info.bits_allocated
+        self._ds.BitsStored = info.bits_stored
+        self._ds.HighBit = info.bits_stored - 1
+
+        if lossy:
+            uncompressed = info.rows * info.columns * info.components * info.bits_allocated // 8
+            self._ds.LossyImageCompressionRatio = f"{uncompressed / len(data):.2f}"
+            self._ds.LossyImageCompressionMethod = 'ISO_15444_1'  # The JPEG-2000 Standard
 
-        self._ds.LossyImageCompressionMethod = 'ISO_15444_1'  # The JPEG-2000 Standard
+        self._set_reduced_images(self._open_image(), resolution_levels)
 
-        self._ds.file_meta.TransferSyntaxUID = JPEG2000
+        self._ds.file_meta.TransferSyntaxUID = JPEG2000Lossless if info.reversible else JPEG2000
         self._ds.is_little_endian = True
         self._ds.is_implicit_VR = False
 
-        self.lossy_compression(False)
-        # self._ds.compress(RLELossless)
+        self.lossy_compression(lossy)
+
+    def _jpeg_frames(self, size):
+        """ The JPEG images of size in image_bytes, or image_bytes as it is if it cannot be split. """
+        try:
+            frames = [frame for frame in jpeg.frames(self.image_bytes)
+                      if jpeg.dimensions(frame) == size]
+        except (jpeg.JPEGError, struct.error) as e:
+            logger.warning("Could not split the JPEG into frames, keeping it whole: %s", e)
+            frames = []
+        return frames or [self.image_bytes]
 
     def _set_image_jpeg_data(self, recompress_quality=None):
         """ Set Image Data for JPG Images.
@@ -1032,25 +1254,27 @@ class PhotographBase(DicomBase):
 
         Some cameras, like the Nikon D5600 will actually save MPO images, which will not support the quality argument and throw a ValueError.
 
-        If the MPO image contains multiple frames, they are expanded in multiframe DICOM encapsulation, as described here: https://stackoverflow.com/questions/58518357/how-to-create-jpeg-compressed-dicom-dataset-using-pydicom Not sure there is a usecase for it. 
+        If the MPO image contains multiple images of the size of the primary image, like stereo pairs or bursts, they are split without decoding and encapsulated as frames of a multiframe DICOM, as described here: https://stackoverflow.com/questions/58518357/how-to-create-jpeg-compressed-dicom-dataset-using-pydicom Images of other sizes, like previews, are left out.
 
         Quality of 98
 
         """
-        im = Image.open(io.BytesIO(self.image_bytes))
+        im = self._open_image()
         logger.info("Found format %s for image", im.format)
         self._ds.Rows = im.height
         self._ds.Columns = im.width
+        size = im.size
 
         if recompress_quality is None:
             # PIL does not saving the JPEG the way it was loaded. The original JPEG is required.
-            image_bytes = io.BytesIO(self.image_bytes)
+            frames = self._jpeg_frames(size)
         else:
             image_bytes = io.BytesIO()
             im.save(image_bytes, format='jpeg', quality=recompress_quality)
+            frames = [image_bytes.getbuffer()]
 
-        self._ds.PixelData = encapsulate(
-            [image_bytes.getvalue()])  # needs to be an array
+        self._set_encapsulated_frames(frames)
+        compressed = sum(len(frame) for frame in frames)
 
         # Set the undefined length for PixelData, which is required for compressed data (e.g., JPEG).
         # In DICOM, compressed PixelData must be encoded as an element with undefined length (encapsulated format).
@@ -1068,9 +1292,12 @@ class PhotographBase(DicomBase):
         self._ds.BitsStored = 8
         self._ds.HighBit = 7
 
-        self._ds.LossyImageCompressionRatio = 10
+        self._ds.LossyImageCompressionRatio = f"{size[0] * size[1] * 3 * len(frames) / compressed:.2f}"
         self._ds.LossyImageCompressionMethod = 'ISO_10918_1'  # The JPEG Standard
 
+        # Decodes im at a reduced size, so last
+        self._set_reduced_images(im)
+
         self._ds.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
         self._ds.is_little_endian = True
         self._ds.is_implicit_VR = False
@@ -1082,6 +1309,8 @@ class PhotographBase(DicomBase):
             logger.warning(
                 f"set_image() called on an object without image data. Either set input_image_filename or input_image_bytes")
             return False
+        if metrics.enabled() and self.image_bytes is not None:
+            metrics.count('bytes_in', len(self.image_bytes))
         if self.image_format in ('JPEG', 'MPO'):
             return self._set_image_jpeg_data()
         elif self.image_format in ('JPEG2000'):
@@ -1090,6 +1319,7 @@ class PhotographBase(DicomBase):
             # DICOM only supports encapsulation for JPEG. Everything else needs to be decoded and re-encoded as raw.
             return self._set_image_raw_data()
 
+    @metrics.timed('exif')
     def set_exif_tags(self):
         """
         Sets EXIF tags, if they exist, according to https://dicom.nema.org/medical/dicom/current/output/chtml/part17/chapter_NNNN.html
@@ -0,0 +1,463 @@
+""" Durable store-and-forward outbox of DICOM files to send to a PACS.
+
+Sending straight after converting loses the photographs when the PACS is
+down, and makes capture wait for it when it is slow. Instead, enqueue()
+copies each DICOM file into the outbox directory and records it in an
+SQLite queue, which takes a few milliseconds whatever the state of the PACS.
+Background workers, start(), then send the queue with
+OrthodonticController.send(), through DIMSE or STOW-RS:
+
+    Instances are deduplicated by SOPInstanceUID: enqueuing one again,
+    even once sent, does nothing.
+    The instances of a study are sent in the order they were enqueued, in
+    batches of up to batch_size over one association or request. Different
+    studies are sent in parallel, one per worker.
+    A failed batch is retried with exponential backoff, up to
+    config.OUTBOX_MAX_BACKOFF. The first batch to go through again cancels
+    the backoff of all the others, so that the backlog drains at full speed
+    as soon as the PACS is back.
+    Sent files are removed from the outbox. Their rows are kept, for
+    deduplication, until forget_sent().
+
+With a dicom4ortho.dicom.commitment.StorageCommitment, a sent batch is
+only a step: the outbox asks the PACS to commit to it, with one N-ACTION,
+and keeps its copies until the PACS reports the instances committed. Those
+it fails to commit are queued again. Requests the PACS does not answer
+within config.COMMITMENT_REPORT_TIMEOUT are sent again. With purge_source, the
+DICOM files enqueued are deleted too once committed, which frees the disk
+of capture stations without manual cleanup.
+
+The queue survives restarts: files are written atomically and, by default,
+fsynced (config.OUTBOX_FSYNC) before enqueue() returns. A single process
+should drain an outbox at a time.
+"""
+
+import os
+import random
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+import sqlite3
+
+from dicom4ortho import config
+from dicom4ortho.dicom.status_codes import STATUS_CLASSIFICATION, get_status_classification
+from dicom4ortho.dump import read_header
+from dicom4ortho.writer import FSYNC_FILE, FileWriter, fsync_files
+
+import logging
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENT = 'sent'
+COMMITTED = 'committed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+    sop_instance_uid TEXT NOT NULL UNIQUE,
+    study_instance_uid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    sent_at REAL,
+    last_error TEXT
+);
+"""
+
+# Columns added since, with their types, for outboxes made before.
+_ADDED_COLUMNS = (
+    ('sop_class_uid', 'TEXT'),
+    # The file enqueued, to purge once committed
+    ('source', 'TEXT'),
+    ('transaction_uid', 'TEXT'),
+    ('commit_requested_at', 'REAL'),
+    ('committed_at', 'REAL'),
+)
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS outbox_study ON outbox (study_instance_uid, state, sequence);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt);
+CREATE INDEX IF NOT EXISTS outbox_commit ON outbox (state, commit_requested_at);
+"""
+
+# The first pending instance of each study not being sent, when it is due.
+_NEXT_STUDY = """
+SELECT study_instance_uid, next_attempt FROM outbox AS first
+WHERE state = 'pending'
+AND sequence = (SELECT MIN(sequence) FROM outbox
+                WHERE state = 'pending' AND study_instance_uid = first.study_instance_uid)
+AND study_instance_uid NOT IN ({busy})
+ORDER BY next_attempt, sequence
+LIMIT 1
+"""
+
+
+def _migrate(connection):
+    """ Add the _ADDED_COLUMNS an outbox lacks, once, whichever thread or process gets there first. """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(outbox)')}
+        for column, column_type in _ADDED_COLUMNS:
+            if column not in columns:
+                connection.execute(f'ALTER TABLE outbox ADD COLUMN {column} {column_type}')
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+class SendError(Exception):
+    """ The PACS did not take the DICOM files sent to it. """
+
+
+def send_files(filenames, send, index=None):
+    """ Send DICOM files with OrthodonticController.send(**send).
+
+    Raises SendError unless the PACS took all of them.
+    """
+    from dicom4ortho.controller import OrthodonticController
+    try:
+        result = OrthodonticController().send(**dict(send, dicom_files=list(filenames), index=index))
+    except Exception as e:  # pylint: disable=broad-except
+        raise SendError(str(e)) from e
+    if send.get('send_method') == 'wado':
+        if result is None or not result.ok:
+            raise SendError(f"STOW-RS failed: {getattr(result, 'status_code', 'no response')}")
+    elif not result or get_status_classification(result) not in (
+            STATUS_CLASSIFICATION['SUCCESS'], STATUS_CLASSIFICATION['WARNING']):
+        raise SendError(f"C-STORE failed: {result.Status if result else 'no association'}")
+
+
+class Outbox(object):
+    """ Queue of DICOM files to send, in directory.
+
+    directory: default is config.OUTBOX_DIRECTORY.
+    send: OrthodonticController.send() arguments, without the files, e.g.
+        {"send_method": "dimse", "pacs_dimse_hostname": ...}. Needed to
+        drain the outbox, not to enqueue.
+    index: a dicom4ortho.index.ArchiveIndex to record the sends into.
+    batch_size: instances sent at once. Default is config.OUTBOX_BATCH_SIZE.
+    fsync: writer fsync policy of the queued files. Default is
+        config.OUTBOX_FSYNC.
+    commitment: a dicom4ortho.dicom.commitment.StorageCommitment to the
+        PACS of send, to ask for Storage Commitment. Its listener runs along
+        the workers.
+    purge_source: delete the files enqueued once committed. Needs commitment.
+    """
+
+    def __init__(self, directory=None, send=None, index=None, batch_size=None, fsync=None,
+                 commitment=None, purge_source=False):
+        self.directory = os.fspath(directory or config.OUTBOX_DIRECTORY)
+        self.send = send
+        self.index = index
+        self.batch_size = batch_size or config.OUTBOX_BATCH_SIZE
+        self.fsync = fsync or config.OUTBOX_FSYNC
+        if purge_source and commitment is None:
+            raise ValueError("Purging the files enqueued needs Storage Commitment")
+        self.commitment = commitment
+        if commitment is not None:
+            commitment.on_report = self._on_commitment_report
+        self.purge_source = purge_source
+        self.files_directory = os.path.join(self.directory, 'files')
+        os.makedirs(self.files_directory, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._busy = set()
+        self._failing = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._workers = []
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ The connection of the calling thread. """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(os.path.join(self.directory, 'outbox.sqlite'), timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            _migrate(connection)
+            connection.executescript(_INDEXES)
+            self._local.connection = connection
+        return connection
+
+    def _path(self, sop_instance_uid) -> str:
+        return os.path.join(self.files_directory, f"{sop_instance_uid}.dcm")
+
+    def _queued(self, sop_instance_uid) -> bool:
+        return self.connection.execute(
+            'SELECT 1 FROM outbox WHERE sop_instance_uid = ?', (sop_instance_uid,)).fetchone() is not None
+
+    def _insert(self, ds, path, source=None) -> bool:
+        now = time.time()
+        with self.connection:
+            inserted = self.connection.execute(
+                'INSERT OR IGNORE INTO outbox (sop_instance_uid, study_instance_uid, sop_class_uid, path, source, '
+                'state, next_attempt, enqueued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(ds.SOPInstanceUID), str(ds.get('StudyInstanceUID', '')), str(ds.get('SOPClassUID', '')),
+                 path, source, PENDING, now, now)).rowcount
+        if inserted:
+            logger.debug("Queued %s", ds.SOPInstanceUID)
+            self._wake.set()
+        return bool(inserted)
+
+    def enqueue(self, filename) -> bool:
+        """ Queue a copy of the DICOM file filename. Returns False if its instance was queued before. """
+        ds = read_header(filename, ['SOPClassUID', 'SOPInstanceUID', 'StudyInstanceUID'])
+        sop_instance_uid = str(ds.SOPInstanceUID)
+        if self._queued(sop_instance_uid):
+            return False
+        path = self._path(sop_instance_uid)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(filename, temporary)
+        except OSError:
+            shutil.copyfile(filename, temporary)
+        os.replace(temporary, path)
+        if self.fsync == FSYNC_FILE:
+            fsync_files([path])
+        return self._insert(ds, path, os.path.abspath(filename))
+
+    def enqueue_photo(self, photo) -> bool:
+        """ Queue a DicomBase, without saving it anywhere else. Returns False if it was queued before. """
+        photo.prepare()
+        ds = photo.to_dataset()
+        sop_instance_uid = str(ds.SOPInstanceUID)
+        if self._queued(sop_instance_uid):
+            return False
+        path = self._path(sop_instance_uid)
+        FileWriter(fsync=self.fsync).write(path, photo.write_to)
+        return self._insert(ds, path)
+
+    def _claim(self):
+        """ The study and the batch of instances to send next, or (None, seconds until the next is due). """
+        with self._lock:
+            busy = sorted(self._busy)
+            row = self.connection.execute(
+                _NEXT_STUDY.format(busy=', '.join('?' for _ in busy)), busy).fetchone()
+            if row is None:
+                return None, None
+            wait = row['next_attempt'] - time.time()
+            if wait > 0:
+                return None, wait
+            study_instance_uid = row['study_instance_uid']
+            self._busy.add(study_instance_uid)
+        batch = self.connection.execute(
+            'SELECT sequence, sop_instance_uid, sop_class_uid, path, attempts FROM outbox '
+            'WHERE state = ? AND study_instance_uid = ? ORDER BY sequence LIMIT ?',
+            (PENDING, study_instance_uid, self.batch_size)).fetchall()
+        return study_instance_uid, batch
+
+    def _backoff(self, attempts) -> float:
+        delay = min(config.OUTBOX_MAX_BACKOFF, config.OUTBOX_BACKOFF * 2 ** (attempts - 1))
+        # Jitter, so that the studies do not all come back at once
+        return delay * random.uniform(0.5, 1.0)
+
+    def _send_batch(self, batch):
+        sequences = [(row['sequence'],) for row in batch]
+        try:
+            send_files([row['path'] for row in batch], self.send, self.index)
+        except SendError as e:
+            now = time.time()
+            attempts = max(row['attempts'] for row in batch) + 1
+            logger.warning("Sending %d instances failed, attempt %d: %s", len(batch), attempts, e)
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE sequence = ?',
+                    [(attempts, now + self._backoff(attempts), str(e), sequence) for sequence, in sequences])
+            self._failing = True
+            return False
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE outbox SET state = ?, sent_at = ?, last_error = NULL, commit_requested_at = ? '
+                'WHERE sequence = ?',
+                [(SENT, now, now if self.commitment else None, sequence) for sequence, in sequences])
+            if self._failing:
+                # The PACS is back: retry everything now
+                self._failing = False
+                self.connection.execute(
+                    'UPDATE outbox SET next_attempt = ? WHERE state = ? AND next_attempt > ?', (now, PENDING, now))
+                self._wake.set()
+        logger.info("Sent %d instances", len(batch))
+        if self.commitment is not None:
+            self._request_commitment(batch)
+        else:
+            _remove([row['path'] for row in batch])
+        return True
+
+    def _request_commitment(self, rows):
+        """ Ask the PACS to commit to the sent rows. Failed requests are sent again after OUTBOX_MAX_BACKOFF. """
+        try:
+            transaction_uid = self.commitment.request(
+                (row['sop_class_uid'], row['sop_instance_uid']) for row in rows)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Could not request the commitment of %d instances: %s", len(rows), e)
+            overdue_at = time.time() - self.commitment.report_timeout + config.OUTBOX_MAX_BACKOFF
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE outbox SET commit_requested_at = ? WHERE sequence = ? AND state = ?',
+                    [(overdue_at, row['sequence'], SENT) for row in rows])
+            return
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE outbox SET transaction_uid = ? WHERE sequence = ? AND state = ?',
+                [(transaction_uid, row['sequence'], SENT) for row in rows])
+
+    def _request_overdue_commitment(self) -> bool:
+        """ Ask again for the commitment of a batch the PACS did not answer for in time. """
+        now = time.time()
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT sequence, sop_instance_uid, sop_class_uid FROM outbox '
+                'WHERE state = ? AND commit_requested_at < ? ORDER BY sequence LIMIT ?',
+                (SENT, now - self.commitment.report_timeout, self.batch_size)).fetchall()
+            if not rows:
+                return False
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE outbox SET commit_requested_at = ? WHERE sequence = ?',
+                    [(now, row['sequence']) for row in rows])
+        self._request_commitment(rows)
+        return True
+
+    def _on_commitment_report(self, transaction_uid, committed, failed):
+        """ Purge the instances committed, and queue again those which failed. """
+        now = time.time()
+        with self.connection:
+            purged = []
+            for sop_instance_uid in committed:
+                row = self.connection.execute(
+                    'SELECT sequence, path, source FROM outbox WHERE sop_instance_uid = ? AND state = ?',
+                    (sop_instance_uid, SENT)).fetchone()
+                if row is None:
+                    continue
+                self.connection.execute(
+                    'UPDATE outbox SET state = ?, committed_at = ? WHERE sequence = ?',
+                    (COMMITTED, now, row['sequence']))
+                purged.append(row['path'])
+                if self.purge_source and row['source']:
+                    purged.append(row['source'])
+            requeued = 0
+            for sop_instance_uid, reason in failed:
+                requeued += self.connection.execute(
+                    'UPDATE outbox SET state = ?, attempts = attempts + 1, next_attempt = ?, last_error = ?, '
+                    'commit_requested_at = NULL, transaction_uid = NULL '
+                    # The report may come before request() returned the transaction
+                    'WHERE sop_instance_uid = ? AND state = ? AND (transaction_uid = ? OR transaction_uid IS NULL)',
+                    (PENDING, now, f"Storage Commitment failed, reason {reason}", sop_instance_uid,
+                     SENT, transaction_uid)).rowcount
+        _remove(purged)
+        if requeued:
+            logger.warning("%d instances were not committed, queued again", requeued)
+            self._wake.set()
+
+    def wait_committed(self, timeout=None) -> bool:
+        """ Wait until the PACS committed to everything sent, at most timeout seconds. Returns whether it did.
+
+        Default timeout is the report_timeout of commitment.
+        """
+        deadline = time.time() + (self.commitment.report_timeout if timeout is None else timeout)
+        while self.status()['sent']:
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(config.OUTBOX_POLL_INTERVAL, max(0, deadline - time.time())))
+        return True
+
+    def drain_once(self) -> Optional[float]:
+        """ Send the next batch due. Returns 0 if one was sent or tried, else the seconds until one is due, or None if the outbox is empty. """
+        if not self.send:
+            raise ValueError("Nowhere to send to: set the send arguments of the Outbox")
+        if self.commitment is not None and self._request_overdue_commitment():
+            return 0
+        study_instance_uid, batch = self._claim()
+        if study_instance_uid is None:
+            return batch
+        try:
+            self._send_batch(batch)
+        finally:
+            with self._lock:
+                self._busy.discard(study_instance_uid)
+        return 0
+
+    def drain(self) -> Dict[str, int]:
+        """ Send everything due, in this thread, until nothing is due. Returns status(). """
+        while self.drain_once() == 0:
+            pass
+        return self.status()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                wait = self.drain_once()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Outbox worker: %s", e)
+                wait = config.OUTBOX_POLL_INTERVAL
+            if wait != 0:
+                self._wake.wait(config.OUTBOX_POLL_INTERVAL if wait is None
+                                else min(wait, config.OUTBOX_POLL_INTERVAL))
+                self._wake.clear()
+
+    def start(self, workers=None):
+        """ Drain the outbox in workers background threads until stop(). Default is config.OUTBOX_WORKERS. """
+        self.start_commitment()
+        self._stop.clear()
+        self._workers = [threading.Thread(target=self._work, name=f"outbox-{n}", daemon=True)
+                         for n in range(workers or config.OUTBOX_WORKERS)]
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """ Stop the workers once their current batch is done. What is left stays queued. """
+        self._stop.set()
+        self._wake.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self.commitment is not None:
+            self.commitment.shutdown()
+
+    def start_commitment(self):
+        """ Listen for Storage Commitment reports, if asking for them. start() does it. """
+        if self.commitment is not None and not self.commitment.listening:
+            self.commitment.start()
+
+    def status(self) -> Dict[str, int]:
+        """ Number of instances pending, of those failing to send, of those sent, and of those committed.
+
+        With commitment, 'sent' counts the instances the PACS did not commit to yet.
+        """
+        row = self.connection.execute(
+            'SELECT SUM(state = ?) AS pending, SUM(state = ? AND attempts > 0) AS failing, '
+            'SUM(state = ?) AS sent, SUM(state = ?) AS committed FROM outbox',
+            (PENDING, PENDING, SENT, COMMITTED)).fetchone()
+        return {key: row[key] or 0 for key in ('pending', 'failing', 'sent', 'committed')}
+
+    def pending(self) -> List[Dict]:
+        """ The instances waiting to be sent, in the order they will be. """
+        return [dict(row) for row in self.connection.execute(
+            'SELECT * FROM outbox WHERE state = ? ORDER BY next_attempt, sequence', (PENDING,))]
+
+    def forget_sent(self, older_than=0) -> int:
+        """ Remove the rows of the instances sent more than older_than seconds ago. They can be queued again.
+
+        Instances waiting for commitment are kept.
+        """
+        with self.connection:
+            return self.connection.execute(
+                'DELETE FROM outbox WHERE ((state = ? AND commit_requested_at IS NULL) OR state = ?) AND sent_at < ?',
+                (SENT, COMMITTED, time.time() - older_than)).rowcount
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
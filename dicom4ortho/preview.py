@@ -0,0 +1,102 @@
+""" Small versions of a photograph, made without decoding it at full size.
+
+Decoding a 24 MP photograph only to shrink it to a thumbnail is most of the
+cost of the thumbnail. JPEG can be decoded at 1/2, 1/4 or 1/8 of its size
+straight from its DCT coefficients, with PIL draft(), and JPEG 2000 at a
+lower resolution level, skipping the finest wavelet levels. reduced() does
+that, then resizes the rest of the way.
+
+icon_image_sequence() makes the Icon Image Sequence (0088,0200) of the
+General Image Module, which PACS worklists show, and jpeg() a sidecar
+preview for web viewers.
+"""
+
+import io
+import os
+
+from PIL import Image
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from dicom4ortho import config, jpeg2000
+
+# Modes which stay greyscale. Everything else becomes RGB.
+_GREYSCALE_MODES = frozenset(('1', 'L', 'LA', 'I', 'I;16', 'F'))
+
+
+def _decodable_at(im, factor) -> bool:
+    """ Whether PIL decodes the JPEG 2000 im reduced by 2**factor.
+
+    OpenJPEG rounds the reduced size up, PIL to the nearest, and fails to
+    decode when they disagree.
+    """
+    return all(-(-length >> factor) == (length + (1 << factor >> 1)) >> factor for length in im.size)
+
+
+def reduced(im, size, resolution_levels=0) -> Image.Image:
+    """ A copy of im no larger than size x size, in RGB or L.
+
+    im should not be loaded yet, so that it can be decoded at a reduced
+    size. It cannot be used at full size afterwards.
+
+    resolution_levels: the number of wavelet decomposition levels of a
+    JPEG 2000 im, which it can be decoded at a fraction of its size by.
+    """
+    if resolution_levels and im.format == 'JPEG2000':
+        im.reduce = max((factor for factor in range(resolution_levels + 1)
+                         if max(im.size) >> factor >= size and _decodable_at(im, factor)), default=0)
+    else:
+        # A no-op for anything but JPEG
+        im.draft(None, (size, size))
+    small = im.convert('L' if im.mode in _GREYSCALE_MODES else 'RGB')
+    small.thumbnail((size, size))
+    return small
+
+
+def icon_image_sequence(im) -> Sequence:
+    """ An Icon Image Sequence of im, an RGB or L image, with native Pixel Data.
+
+    Icons should be at most 128 x 128, see PS3.3 F.7.
+    """
+    icon = Dataset()
+    icon.Rows = im.height
+    icon.Columns = im.width
+    icon.SamplesPerPixel = len(im.getbands())
+    if icon.SamplesPerPixel == 3:
+        icon.PhotometricInterpretation = 'RGB'
+        icon.PlanarConfiguration = 0
+    else:
+        icon.PhotometricInterpretation = 'MONOCHROME2'
+    icon.BitsAllocated = 8
+    icon.BitsStored = 8
+    icon.HighBit = 7
+    icon.PixelRepresentation = 0
+    icon.add_new(0x7FE00010, 'OB', im.tobytes())
+    return Sequence([icon])
+
+
+def jpeg(im, quality=None) -> bytes:
+    """ im as a JPEG file. Default quality is config.PREVIEW_QUALITY. """
+    preview = io.BytesIO()
+    im.save(preview, format='JPEG', quality=quality or config.PREVIEW_QUALITY)
+    return preview.getvalue()
+
+
+def jpeg_preview(image_bytes, size=None, quality=None) -> bytes:
+    """ A JPEG preview of the image file in image_bytes.
+
+    Defaults are config.PREVIEW_SIZE and config.PREVIEW_QUALITY.
+    """
+    im = Image.open(io.BytesIO(image_bytes))
+    resolution_levels = 0
+    if im.format == 'JPEG2000':
+        try:
+            resolution_levels = jpeg2000.parse(*jpeg2000.codestream(image_bytes)).decomposition_levels
+        except jpeg2000.JPEG2000Error:
+            pass
+    return jpeg(reduced(im, size or config.PREVIEW_SIZE, resolution_levels), quality)
+
+
+def filename_for(dicom_filename) -> str:
+    """ Where the preview of dicom_filename goes by default: next to it, with config.PREVIEW_SUFFIX. """
+    return os.path.splitext(os.fspath(dicom_filename))[0] + config.PREVIEW_SUFFIX
@@ -0,0 +1,194 @@
+""" Storage SCP which receives photographs from modalities and tags them.
+
+Some intraoral cameras and imaging software push DICOM straight to a PACS,
+without the DENT-OIP view codes. StorageReceiver takes their C-STOREs
+instead, picks an image type for each instance with routing rules, sets
+the attributes of its view into the received dataset with apply_view(), and
+stores the result, optionally queuing it into a dicom4ortho.outbox.Outbox
+to forward to the PACS.
+
+A routing rule is a (keyword, pattern, image type) tuple: the first rule
+whose fnmatch pattern matches the value of the DICOM attribute keyword
+wins. The keyword can also be 'CallingAETitle', to route by sending
+modality. Instances matching no rule get default_image_type, or are stored
+unchanged without one.
+
+PixelData is never decoded. Instances left unchanged are written as they
+were received, and tagged ones are answered with the Warning status
+0xB000, Coercion of Data Elements. Each association runs in its own thread,
+so several modalities can send at once. Once an instance is on disk, the
+modality is answered with success even if indexing or queuing it fails:
+that is logged instead.
+
+Received files are named after their StudyInstanceUID and SOPInstanceUID.
+Instances whose UIDs are not made of digits and dots, or would make a
+file outside of output_dir, are refused with 0xC000, Cannot Understand.
+"""
+
+import fnmatch
+import os
+import re
+from typing import Optional
+
+from pydicom import dcmwrite
+from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, AllStoragePresentationContexts, evt
+from pynetdicom.sop_class import Verification  # pylint: disable=no-name-in-module
+
+from dicom4ortho import config, metrics
+from dicom4ortho._generated_codes import VIEWS
+from dicom4ortho.m_orthodontic_photograph import apply_view
+from dicom4ortho.writer import FileWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+CALLING_AE_TITLE = 'CallingAETitle'
+
+STATUS_SUCCESS = 0x0000
+STATUS_COERCED = 0xB000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+# The characters of the UI VR (PS3.5 6.2): the UIDs received become file names
+UID_PATTERN = re.compile(r'^[0-9.]{1,64}$')
+
+
+def image_type_for_dataset(ds, routes=(), default_image_type=None, calling_ae_title=None) -> Optional[str]:
+    """ The image type of ds according to routes, see the module docstring. """
+    for keyword, pattern, image_type in routes:
+        if keyword == CALLING_AE_TITLE:
+            value = calling_ae_title
+        else:
+            value = ds.get(keyword)
+            value = None if value is None or value == '' else str(value)
+        if value is not None and fnmatch.fnmatch(value.strip(), pattern):
+            return image_type
+    return default_image_type
+
+
+def reclassify(ds, image_type):
+    """ Set the DENT-OIP attributes of image_type into ds, in place. """
+    view = VIEWS.get(image_type.replace('-', ''))
+    if view is None:
+        raise ValueError(f"Unknown image type {image_type!r}")
+    if view.view_code is None:
+        raise TypeError(f"View {view.keyword!r} needs a view code, which routes cannot give")
+    apply_view(ds, view)
+
+
+class StorageReceiver(object):
+    """ Receive C-STOREs into output_dir, until shutdown().
+
+    Instances are saved as <output_dir>/<StudyInstanceUID>/<SOPInstanceUID>.dcm.
+
+    routes, default_image_type: see the module docstring.
+    outbox: a dicom4ortho.outbox.Outbox to queue every instance received
+        into, to forward it. Its workers run along the receiver.
+    index: a dicom4ortho.index.ArchiveIndex to record the instances into.
+    fsync, direct_io: see dicom4ortho.writer.FileWriter.
+    ae_title, host, port, max_associations: see config.
+    """
+
+    def __init__(self, output_dir, routes=(), default_image_type=None, outbox=None, index=None, fsync=None, direct_io=None,
+                 ae_title=config.RECEIVE_AE_TITLE, host=config.RECEIVE_HOST, port=config.RECEIVE_PORT,
+                 max_associations=config.RECEIVE_MAX_ASSOCIATIONS):
+        self.output_dir = os.fspath(output_dir)
+        self.routes = list(routes)
+        self.default_image_type = default_image_type
+        self.outbox = outbox
+        self.index = index
+        self.file_writer = FileWriter(fsync=fsync, direct=direct_io)
+        self.host = host
+        self.port = port
+        self.ae = AE(ae_title=ae_title)
+        self.ae.maximum_associations = max_associations
+        self.ae.add_supported_context(Verification)
+        for context in AllStoragePresentationContexts:
+            # Cameras send JPEG, which the default uncompressed transfer syntaxes would refuse
+            self.ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        self._server = None
+
+    def filename_for(self, ds) -> str:
+        """ Where ds is stored. Raises ValueError for UIDs which would not make a file in output_dir. """
+        for keyword in ('StudyInstanceUID', 'SOPInstanceUID'):
+            if not UID_PATTERN.match(str(ds.get(keyword, ''))):
+                raise ValueError(f"Invalid {keyword} {ds.get(keyword)!r}")
+        filename = os.path.join(self.output_dir, str(ds.StudyInstanceUID), f"{ds.SOPInstanceUID}.dcm")
+        output_dir = os.path.realpath(self.output_dir)
+        if os.path.commonpath([output_dir, os.path.realpath(filename)]) != output_dir:
+            raise ValueError(f"{filename} is not in {self.output_dir}")
+        return filename
+
+    def store(self, ds, encoded=None, calling_ae_title=None) -> int:
+        """ Tag and save ds, a dataset with its file_meta. Returns the C-STORE status.
+
+        encoded: ds as a DICOM file, to write as it is if ds is left unchanged.
+        """
+        try:
+            filename = self.filename_for(ds)
+        except ValueError as e:
+            logger.error("Refused an instance from %s: %s", calling_ae_title or 'unknown AE', e)
+            return STATUS_CANNOT_UNDERSTAND
+        image_type = image_type_for_dataset(ds, self.routes, self.default_image_type, calling_ae_title)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if image_type:
+            try:
+                reclassify(ds, image_type)
+            except (TypeError, ValueError) as e:
+                logger.warning("Could not tag %s as %s: %s", ds.SOPInstanceUID, image_type, e)
+                image_type = None
+        if image_type or encoded is None:
+            metrics.count('bytes_out', self.file_writer.write(
+                filename, lambda fp: dcmwrite(fp, ds, write_like_original=False)))
+        else:
+            metrics.count('bytes_out', self.file_writer.write(filename, lambda fp: fp.write(encoded)))
+        logger.info("Received %s from %s%s", ds.SOPInstanceUID, calling_ae_title or 'unknown AE',
+                    f" as {image_type}" if image_type else "")
+        # The instance is safe on disk: the modality need not send it again
+        if self.index is not None:
+            try:
+                self.index.add_file(filename)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Stored %s, but could not index it: %s", filename, e)
+        if self.outbox is not None:
+            try:
+                self.outbox.enqueue(filename)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Stored %s, but could not queue it: %s", filename, e)
+        return STATUS_COERCED if image_type else STATUS_SUCCESS
+
+    def _handle_store(self, event):
+        calling_ae_title = event.assoc.requestor.ae_title.strip()
+        try:
+            ds = event.dataset
+            ds.file_meta = event.file_meta
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Could not decode the dataset from %s: %s", calling_ae_title, e)
+            return STATUS_CANNOT_UNDERSTAND
+        try:
+            with metrics.span('receive'):
+                return self.store(ds, event.encoded_dataset(), calling_ae_title)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Could not store %s from %s: %s", ds.get('SOPInstanceUID'), calling_ae_title, e)
+            return STATUS_OUT_OF_RESOURCES
+
+    def start(self):
+        """ Start listening, in background threads. """
+        self._server = self.ae.start_server(
+            (self.host, self.port), block=False, evt_handlers=[(evt.EVT_C_STORE, self._handle_store)])
+        if self.outbox is not None:
+            self.outbox.start()
+        logger.info("Receiving as %s on %s:%d", self.ae.ae_title, *self.address)
+
+    @property
+    def address(self):
+        """ The (host, port) listened on, once started. """
+        return self._server.server_address
+
+    def shutdown(self):
+        """ Stop listening, once the associations in progress are done. """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        if self.outbox is not None:
+            self.outbox.stop()
@@ -0,0 +1,380 @@
+""" Long running conversion service.
+
+Starting a new process for every photograph means importing pydicom,
+pynetdicom, PIL and numpy and loading the DENT-OIP codes each time, which
+takes much longer than the conversion itself. ``dicom4ortho serve`` keeps a
+pool of worker processes warm and takes conversion jobs over HTTP, either on
+localhost or on a Unix socket. Only the user running the service may
+connect to its Unix socket.
+
+API:
+
+    GET  /health    {"status": "ok", "workers": <N>}
+    POST /convert   a JSON job, answered with a JSON result.
+
+A job is a JSON object with the keys:
+
+    image           : base64 encoded image file (jpeg, png, ...). Required.
+    metadata        : dict of OrthodonticPhotograph arguments, e.g.
+                      {"image_type": "EV01", "patient_id": "1234"}. Only
+                      those of JOB_METADATA are accepted, and
+                      preview_filename is relative to the output directory
+                      too.
+    mwl             : base64 encoded DICOM Modality Worklist item.
+    output_filename : where the server saves the DICOM file, relative to
+                      its output directory. Paths outside of it are refused.
+    send            : dict of OrthodonticController.send() arguments,
+                      e.g. {"send_method": "dimse", "pacs_dimse_hostname": ...}.
+    return_dicom    : true to get the DICOM file back, base64 encoded.
+
+The result has "status" ("ok" or "error"), "sop_instance_uid",
+"study_instance_uid", "series_instance_uid", "cached" and "seconds", plus
+"send_status", "output_filename" and "dicom" when asked for. Errors have
+an "error" message instead.
+
+With a dicom4ortho.cache.ConversionCache, a job for a photograph converted
+before is answered from the cache, with the same DICOM file and UIDs.
+"""
+
+import base64
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import socketserver
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pydicom import dcmread
+
+from dicom4ortho import metrics
+from dicom4ortho.config import SERVE_HOST, SERVE_OUTPUT_DIR, SERVE_PORT
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph, OrthodonticSeries
+from dicom4ortho.writer import FileWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The OrthodonticPhotograph arguments a job may set. Paths are left out but
+# for preview_filename, which ConversionServer.check() puts into output_dir.
+JOB_METADATA = frozenset((
+    'image_type', 'view_code_keyword', 'patient_id', 'patient_firstname', 'patient_lastname',
+    'patient_birthdate', 'patient_sex', 'dental_provider_firstname', 'dental_provider_lastname',
+    'study_description', 'series_description', 'manufacturer', 'treatment_event_type',
+    'days_after_event', 'burned_in_annotation', 'study_instance_uid', 'series_instance_uid',
+    'sop_instance_uid', 'icon', 'icon_size', 'preview', 'preview_filename', 'preview_size',
+    'preview_quality', 'validate',
+))
+
+
+def _warm_up():
+    """ Load what the first conversion would otherwise load. """
+    from PIL import Image
+    Image.init()
+
+
+def _send_status(response):
+    """ Status of a dimse (Dataset) or wado (requests.Response) send. """
+    if response is None:
+        return None
+    if hasattr(response, 'Status'):
+        return int(response.Status)
+    return getattr(response, 'status_code', None)
+
+
+def _run_cached_job(job, send, cached):
+    """ The result of a job whose DICOM file is the cached file. """
+    from dicom4ortho.controller import OrthodonticController
+
+    ds = dcmread(cached, stop_before_pixels=True)
+    result = {
+        'status': 'ok',
+        'cached': True,
+        'sop_instance_uid': ds.SOPInstanceUID,
+        'study_instance_uid': ds.StudyInstanceUID,
+        'series_instance_uid': ds.SeriesInstanceUID,
+    }
+    if job.get('output_filename'):
+        with open(cached, 'rb') as cached_file:
+            FileWriter().write(job['output_filename'], lambda fp: shutil.copyfileobj(cached_file, fp))
+        result['output_filename'] = job['output_filename']
+    if job.get('return_dicom'):
+        with open(cached, 'rb') as cached_file:
+            result['dicom'] = base64.b64encode(cached_file.read()).decode('ascii')
+    if send:
+        if send.get('send_method') == 'wado':
+            send['dicom_files'] = [cached]
+        else:
+            send['dicom_datasets'] = [dcmread(cached)]
+        result['send_status'] = _send_status(OrthodonticController().send(**send))
+    return result
+
+
+def run_job(job, send_defaults=None, cache=None):
+    """ Convert, and possibly save and send, the photograph of one job.
+
+    cache: a dicom4ortho.cache.ConversionCache to look the job up in first,
+    and to add its DICOM file to.
+
+    Module level so that it can run in a worker process. See the module
+    docstring for the keys of job.
+    """
+    from dicom4ortho.controller import OrthodonticController
+
+    start = time.perf_counter()
+    metadata = dict(job.get('metadata') or {})
+    metadata['input_image_filename'] = None
+    metadata['input_image_bytes'] = base64.b64decode(job['image'])
+    if job.get('output_filename'):
+        metadata['output_image_filename'] = job['output_filename']
+    if job.get('mwl'):
+        metadata['dicom_mwl'] = dcmread(
+            io.BytesIO(base64.b64decode(job['mwl'])), force=True)
+    send = dict(send_defaults or {}, **(job.get('send') or {}))
+
+    key = None
+    if cache is not None:
+        key = cache.key(metadata['input_image_bytes'], metadata)
+        cached = cache.get(key)
+        if cached is not None:
+            result = _run_cached_job(job, send, cached)
+            result['seconds'] = time.perf_counter() - start
+            return result
+        metadata.update(cache.uids(key, metadata))
+
+    photo = OrthodonticPhotograph(**metadata)
+    if photo.dicom_mwl is not None:
+        photo.copy_mwl_tags()
+    photo.prepare()
+
+    result = {
+        'status': 'ok',
+        'cached': False,
+        'sop_instance_uid': photo.sop_instance_uid,
+        'study_instance_uid': photo.study_instance_uid,
+        'series_instance_uid': photo.series_instance_uid,
+    }
+    if job.get('output_filename'):
+        photo.save()
+        result['output_filename'] = photo.output_image_filename
+    if job.get('return_dicom'):
+        result['dicom'] = base64.b64encode(photo.to_buffer()).decode('ascii')
+    if cache is not None:
+        cache.put(key, photo._write)
+
+    if send:
+        if send.get('send_method') == 'wado':
+            series = OrthodonticSeries(uid=photo.series_instance_uid)
+            series.add(photo)
+            send['orthodontic_series'] = series
+        else:
+            send['dicom_datasets'] = [photo._ds]
+        result['send_status'] = _send_status(OrthodonticController().send(**send))
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ HTTP front end of a ConversionServer. """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def _reply(self, code, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok', 'workers': self.server.service.workers})
+        else:
+            self._reply(404, {'status': 'error', 'error': f"No such resource {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self._reply(404, {'status': 'error', 'error': f"No such resource {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length))
+            if not isinstance(job, dict) or 'image' not in job:
+                raise ValueError("A job needs at least an 'image'")
+            self.server.service.check(job)
+        except ValueError as e:
+            self._reply(400, {'status': 'error', 'error': str(e)})
+            return
+        try:
+            self._reply(200, self.server.service.submit(job).result())
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception("Job failed")
+            metrics.count('failures')
+            self._reply(500, {'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Only the user running the service may connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects an (address, port) client address.
+        return request, ('local', 0)
+
+
+class ConversionServer(object):
+    """ A warm pool of conversion workers behind an HTTP API.
+
+    Listens on socket_path, a Unix socket, if given, otherwise on
+    host:port. Port 0 picks a free port, see address.
+
+    workers: number of worker processes. Default os.cpu_count().
+
+    send_defaults: send() arguments used for every job, e.g. the PACS to
+    send to, so that jobs do not need to carry them. The 'send' of a job
+    overrides them.
+
+    cache: a dicom4ortho.cache.ConversionCache shared by the workers.
+
+    output_dir: the only directory jobs may save DICOM files into, their
+    output_filename being relative to it. Default is SERVE_OUTPUT_DIR; with
+    None, jobs asking to save a file are refused.
+    """
+
+    def __init__(self, host=SERVE_HOST, port=SERVE_PORT, socket_path=None, workers=None, send_defaults=None,
+                 cache=None, output_dir=SERVE_OUTPUT_DIR):
+        self.workers = workers or os.cpu_count() or 1
+        self.send_defaults = send_defaults or {}
+        self.cache = cache
+        self.output_dir = os.path.realpath(output_dir) if output_dir is not None else None
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_warm_up)
+        # Start every worker now rather than on the first jobs.
+        wait([self._executor.submit(_warm_up) for _ in range(self.workers)])
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._httpd = _UnixHTTPServer(socket_path, _RequestHandler)
+        else:
+            self._httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._httpd.service = self
+        self.socket_path = socket_path
+        logger.info("Serving on %s with %s workers", self.address, self.workers)
+
+    @property
+    def address(self):
+        """ The Unix socket path, or the http://host:port URL, served on. """
+        if self.socket_path is not None:
+            return self.socket_path
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def output_path(self, output_filename) -> str:
+        """ The path in output_dir of the output_filename of a job. Raises ValueError outside of it. """
+        if self.output_dir is None:
+            raise ValueError("This service does not save files: it has no output directory")
+        path = os.path.realpath(os.path.join(self.output_dir, output_filename))
+        if os.path.commonpath([self.output_dir, path]) != self.output_dir or path == self.output_dir:
+            raise ValueError(f"{output_filename} is not in the output directory of the service")
+        return path
+
+    def check(self, job):
+        """ Refuse, with ValueError, metadata not in JOB_METADATA, and put the paths of job into output_dir. """
+        metadata = job.get('metadata') or {}
+        if not isinstance(metadata, dict):
+            raise ValueError("The metadata of a job must be an object")
+        unknown = sorted(set(metadata) - JOB_METADATA)
+        if unknown:
+            raise ValueError(f"Metadata not accepted by this service: {', '.join(unknown)}")
+        if metadata.get('preview_filename'):
+            metadata['preview_filename'] = self.output_path(metadata['preview_filename'])
+        if job.get('output_filename'):
+            job['output_filename'] = self.output_path(job['output_filename'])
+
+    def submit(self, job):
+        """ Queue a job on the pool. Returns a concurrent.futures.Future. """
+        return self._executor.submit(run_job, job, self.send_defaults, self.cache)
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        """ Stop serving, then wait for the running jobs to finish. """
+        self._httpd.shutdown()
+        self.close()
+
+    def close(self):
+        self._httpd.server_close()
+        self._executor.shutdown()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connect(address, timeout=None):
+    """ Connection to a ConversionServer address, a URL or a Unix socket path. """
+    if address.startswith('http://'):
+        return http.client.HTTPConnection(address[len('http://'):].rstrip('/'), timeout=timeout)
+    return _UnixHTTPConnection(address, timeout=timeout)
+
+
+def submit(image_bytes, address=None, metadata=None, mwl_bytes=None, output_filename=None,
+           send=None, return_dicom=False, timeout=None):
+    """ Send a conversion job to a running ConversionServer.
+
+    address is a Unix socket path or an http://host:port URL. Default is
+    http://SERVE_HOST:SERVE_PORT.
+
+    output_filename is relative to the output directory of the server.
+
+    Returns the result dict of the job. Errors of the server come back with
+    status 'error' rather than raising.
+    """
+    job = {
+        'image': base64.b64encode(image_bytes).decode('ascii'),
+        'metadata': metadata or {},
+        'return_dicom': return_dicom,
+    }
+    if mwl_bytes is not None:
+        job['mwl'] = base64.b64encode(mwl_bytes).decode('ascii')
+    if output_filename is not None:
+        job['output_filename'] = output_filename
+    if send:
+        job['send'] = send
+
+    connection = _connect(address or f"http://{SERVE_HOST}:{SERVE_PORT}", timeout=timeout)
+    try:
+        connection.request(
+            'POST', '/convert', body=json.dumps(job).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
@@ -1,12 +1,105 @@
 from typing import Optional
-import uuid
+import hashlib
+import os
+import threading
+import weakref
 from pydicom.dataset import Dataset
-from dicom4ortho.config import DICOM4ORTHO_ROOT_UID, VL_DENTAL_VIEW_CID
+from dicom4ortho.config import DICOM4ORTHO_ROOT_UID, VL_DENTAL_VIEW_CID, UID_MAX_LENGTH, UID_BATCH_SIZE
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# Every UIDAllocator, to reset in forked children.
+_allocators = weakref.WeakSet()
+
+
+def _reset_allocators_after_fork():
+    for allocator in list(_allocators):
+        allocator._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_allocators_after_fork)
+
+
+class UIDAllocator(object):
+    """ Hands out random DICOM UIDs under a fixed root, a batch at a time.
+
+    Each UID is the root followed by a single random integer component using
+    as many decimal digits as the 64 character limit leaves, drawn from
+    os.urandom(). With the dicom4ortho roots that is over 120 bits of
+    entropy per UID, which makes collisions as unlikely as with UUIDs.
+
+    Random bytes for a whole batch are fetched with a single system call and
+    the UIDs built up front, so allocate() is a list pop. A forked child
+    drops the batch it inherited, which its parent and siblings also hold.
+    """
+
+    def __init__(self, root=None, batch_size=UID_BATCH_SIZE):
+        self.root = root or DICOM4ORTHO_ROOT_UID
+        self.batch_size = batch_size
+        self._digits = UID_MAX_LENGTH - len(self.root) - 1
+        if self._digits < 1:
+            raise ValueError(
+                f"UID root {self.root!r} leaves no room for a UID suffix within {UID_MAX_LENGTH} characters.")
+        # The leading digit is kept non-zero: DICOM forbids leading zeros in a component.
+        self._lowest = 10 ** (self._digits - 1) if self._digits > 1 else 0
+        self._span = 10 ** self._digits - self._lowest
+        self._random_bytes = (self._span.bit_length() + 7) // 8 + 8
+        self._batch = []
+        self._lock = threading.Lock()
+        _allocators.add(self)
+
+    def _after_fork(self):
+        self._batch = []
+        # Another thread of the parent may have held it
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        pool = os.urandom(self._random_bytes * self.batch_size)
+        step = self._random_bytes
+        prefix = self.root + '.'
+        self._batch = [
+            prefix + str(self._lowest + int.from_bytes(pool[i:i + step], 'big') % self._span)
+            for i in range(0, len(pool), step)]
+
+    def allocate(self) -> str:
+        """ Return a new random UID. """
+        with self._lock:
+            if not self._batch:
+                self._refill()
+            return self._batch.pop()
+
+    def from_hash(self, *values) -> str:
+        """ Return a UID derived deterministically from values.
+
+        The same values always give the same UID under the same root, so
+        reprocessing the same input reproduces the same UIDs. Values are
+        converted with str(), bytes are hashed as they are.
+        """
+        digest = hashlib.sha256()
+        for value in values:
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            digest.update(len(value).to_bytes(8, 'big'))
+            digest.update(value)
+        number = int.from_bytes(digest.digest(), 'big')
+        return f"{self.root}.{self._lowest + number % self._span}"
+
+
+_uid_allocators = {}
+
+
+def uid_allocator(root=None) -> UIDAllocator:
+    """ Return the process wide UIDAllocator for root. """
+    root = root or DICOM4ORTHO_ROOT_UID
+    allocator = _uid_allocators.get(root)
+    if allocator is None:
+        allocator = _uid_allocators.setdefault(root, UIDAllocator(root))
+    return allocator
+
+
 def generate_dicom_uid(root=None, hash=None):
     """
     A function to generate DICOM UIDs for new objects.
@@ -14,13 +107,21 @@ def generate_dicom_uid(root=None, hash=None):
     If hash is not None, it will use that string to translate it to a DICOM UID. Useful if you want to produce the same UID for the same input file.
 
     hash has to be a 16 byte long bytes object.
+
+    Without hash, UIDs come from the shared UIDAllocator for root.
     """
-    new_uuid = hash or uuid.uuid4().bytes
-    dicom_uid = root or DICOM4ORTHO_ROOT_UID or '2.25'
-    for i in range(len(new_uuid)-len(dicom_uid.split('.'))):
-        dicom_uid += '.' + str(new_uuid[i])
+    if hash is None:
+        dicom_uid = uid_allocator(root).allocate()
+    else:
+        dicom_uid = root or DICOM4ORTHO_ROOT_UID or '2.25'
+        suffix = hash[:len(hash) - len(dicom_uid.split('.'))]
+        if suffix:
+            dicom_uid += '.' + '.'.join(map(str, suffix))
+        if len(dicom_uid) > UID_MAX_LENGTH:
+            raise ValueError(
+                f"Generated UID {dicom_uid!r} exceeds {UID_MAX_LENGTH} characters.")
 
-    logger.debug("Generated new Instance UID {}".format(dicom_uid))
+    logger.debug("Generated new Instance UID %s", dicom_uid)
     return dicom_uid
 
 
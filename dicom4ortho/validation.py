@@ -0,0 +1,452 @@
+""" In-process validation of VL Photographic Image IODs.
+
+Checks a pydicom Dataset, in memory or read from a file, against:
+
+* the modules of the VL Photographic Image IOD (PS3.3 A.32.4) and the
+  Type of their attributes, including the conditions this package relies on;
+* the VR and VM of every element, values and lengths included (PS3.5 6.2);
+* the structure of code sequence items (PS3.3 8.8);
+* TID 3465 in AcquisitionContextSequence;
+* DENT-OIP: the view coded in the image matches its VIEWS definition.
+
+Results are ValidationResult objects, which convert to plain dicts with
+to_dict() for machine-readable output. validate_files() validates many
+files in parallel. A ValidationReport gathers the results of a batch, to
+report the issues of all files at once.
+
+The IOD table, the VMs and the TID 3465 concept names are resolved to tags
+and codes once, at import time.
+"""
+
+import functools
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from pydicom import config as pydicom_config
+from pydicom import dcmread
+from pydicom.datadict import dictionary_VM, tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.uid import VLPhotographicImageStorage
+from pydicom.valuerep import validate_value
+
+from dicom4ortho._generated_codes import CODES, VIEWS
+
+import logging
+logger = logging.getLogger(__name__)
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# Validation modes. FAST only checks the values of the attributes it is given.
+FAST = 'fast'
+FULL = 'full'
+
+# Tolerance between LossyImageCompressionRatio and the ratio of the pixel data.
+COMPRESSION_RATIO_TOLERANCE = 0.1
+
+# Attribute Types, PS3.5 7.4. Conditional types are checked in _check_conditions().
+TYPE_1 = '1'
+TYPE_2 = '2'
+
+# (module, ((keyword, type), ...)) of the VL Photographic Image IOD, PS3.3 A.32.4-1.
+VL_PHOTOGRAPHIC_IMAGE_IOD = (
+    ('Patient', (
+        ('PatientName', TYPE_2),
+        ('PatientID', TYPE_2),
+        ('PatientBirthDate', TYPE_2),
+        ('PatientSex', TYPE_2),
+    )),
+    ('General Study', (
+        ('StudyInstanceUID', TYPE_1),
+        ('StudyDate', TYPE_2),
+        ('StudyTime', TYPE_2),
+        ('ReferringPhysicianName', TYPE_2),
+        ('StudyID', TYPE_2),
+        ('AccessionNumber', TYPE_2),
+    )),
+    ('General Series', (
+        ('Modality', TYPE_1),
+        ('SeriesInstanceUID', TYPE_1),
+        ('SeriesNumber', TYPE_2),
+    )),
+    ('General Equipment', (
+        ('Manufacturer', TYPE_2),
+    )),
+    ('General Image', (
+        ('InstanceNumber', TYPE_2),
+    )),
+    ('Image Pixel', (
+        ('SamplesPerPixel', TYPE_1),
+        ('PhotometricInterpretation', TYPE_1),
+        ('Rows', TYPE_1),
+        ('Columns', TYPE_1),
+        ('BitsAllocated', TYPE_1),
+        ('BitsStored', TYPE_1),
+        ('HighBit', TYPE_1),
+        ('PixelRepresentation', TYPE_1),
+        ('PixelData', TYPE_1),
+    )),
+    ('Acquisition Context', (
+        ('AcquisitionContextSequence', TYPE_2),
+    )),
+    ('VL Image', (
+        ('ImageType', TYPE_1),
+        ('LossyImageCompression', TYPE_2),
+    )),
+    ('SOP Common', (
+        ('SOPClassUID', TYPE_1),
+        ('SOPInstanceUID', TYPE_1),
+    )),
+)
+
+# Sequences whose items are Code Sequence Macro items, besides *CodeSequence.
+CODE_SEQUENCES = frozenset((
+    'AnatomicRegionSequence',
+    'AnatomicRegionModifierSequence',
+    'PrimaryAnatomicStructureSequence',
+    'PrimaryAnatomicStructureModifierSequence',
+    'DeviceSequence',
+))
+CODE_VALUE_KEYWORDS = ('CodeValue', 'LongCodeValue', 'URNCodeValue')
+
+# Concept names allowed in TID 3465, by CODES keyword, and how many items may use each.
+TID_3465_CONCEPT_NAMES = {
+    'OrthognathicFunctionalConditions': None,
+    'FindingByInspection': None,
+    'ObservableEntity': None,
+    'DentalOcclusion': 1,
+    'TemporalEventType': 1,
+    'OffsetFromEvent': 1,
+}
+
+_IOD_TAGS = tuple(
+    (module, tag_for_keyword(keyword), keyword, attribute_type)
+    for module, attributes in VL_PHOTOGRAPHIC_IMAGE_IOD
+    for keyword, attribute_type in attributes)
+_TID_3465_CONCEPT_NAME_CODES = {
+    (CODES[keyword].value, CODES[keyword].scheme): keyword for keyword in TID_3465_CONCEPT_NAMES}
+
+# VRs whose values pydicom can validate.
+_TEXT_VRS = frozenset((
+    'AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'LO', 'LT', 'PN', 'SH', 'ST',
+    'TM', 'UC', 'UI', 'UR', 'UT'))
+
+
+@dataclass(frozen=True)
+class Issue:
+    """ A problem found in a dataset.
+
+    path: where, e.g. AnatomicRegionSequence[0].CodeMeaning
+    rule: which check found it: iod, vr, vm, code, tid3465 or dent-oip.
+    """
+    severity: str
+    path: str
+    message: str
+    rule: str
+
+    def __str__(self):
+        return f"{self.severity.upper()} {self.path}: {self.message} [{self.rule}]"
+
+
+@dataclass
+class ValidationResult:
+    """ The issues found in one dataset. """
+    source: Optional[str] = None
+    issues: List[Issue] = field(default_factory=list)
+
+    @property
+    def errors(self) -> List[Issue]:
+        return [issue for issue in self.issues if issue.severity == ERROR]
+
+    @property
+    def warnings(self) -> List[Issue]:
+        return [issue for issue in self.issues if issue.severity == WARNING]
+
+    @property
+    def is_valid(self) -> bool:
+        """ True when there are no errors. Warnings are allowed. """
+        return not self.errors
+
+    def to_dict(self) -> dict:
+        return {
+            'source': self.source,
+            'valid': self.is_valid,
+            'issues': [asdict(issue) for issue in self.issues],
+        }
+
+
+class ValidationError(Exception):
+    """ Raised when writing a dataset that did not validate. """
+
+    def __init__(self, results):
+        self.results = list(results)
+        issues = [f"{result.source}: {issue}" for result in self.results for issue in result.errors]
+        super().__init__("Invalid DICOM:\n" + "\n".join(issues))
+
+
+class ValidationReport(object):
+    """ The ValidationResults of a batch, to report their issues at once.
+
+    Thread safe, so the workers of a batch can add to the same report.
+    """
+
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+
+    def add(self, result: ValidationResult):
+        if result is None:
+            return
+        with self._lock:
+            self.results.append(result)
+
+    @property
+    def invalid(self) -> List[ValidationResult]:
+        return [result for result in self.results if not result.is_valid]
+
+    def counts(self) -> Counter:
+        """ How many datasets have each (severity, path, message) issue. """
+        return Counter(
+            (issue.severity, issue.path, issue.message)
+            for result in self.results for issue in set(result.issues))
+
+    def raise_for_errors(self):
+        """ Raise a ValidationError with every invalid result, if any. """
+        if self.invalid:
+            raise ValidationError(self.invalid)
+
+    def __str__(self):
+        lines = [f"{len(self.invalid)} of {len(self.results)} datasets invalid"]
+        lines.extend(
+            f"{count} x {severity.upper()} {path}: {message}"
+            for (severity, path, message), count in self.counts().most_common())
+        return "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=None)
+def _vm_bounds_of_tag(tag):
+    return _vm_bounds(dictionary_VM(tag))
+
+
+def _vm_bounds(vm):
+    """ (minimum, maximum) of a dictionary VM like 1, 1-3, 2-n or 2-2n. maximum is None if unbounded. """
+    minimum, _, maximum = vm.partition('-')
+    if not maximum:
+        return int(minimum), int(minimum)
+    if maximum.endswith('n'):
+        return int(minimum), None
+    return int(minimum), int(maximum)
+
+
+def _code_of(item: Dataset):
+    return (item.get('CodeValue'), item.get('CodingSchemeDesignator'))
+
+
+def _is_empty(element) -> bool:
+    return element is None or element.value is None or element.value == '' or (
+        element.VR != 'SQ' and hasattr(element.value, '__len__') and len(element.value) == 0)
+
+
+class _Validator(object):
+
+    def __init__(self, ds: Dataset, result: ValidationResult, tags=None):
+        self.ds = ds
+        self.result = result
+        self.tags = tags
+
+    def issue(self, path, message, rule, severity=ERROR):
+        self.result.issues.append(Issue(severity, path, message, rule))
+
+    def run(self):
+        self._check_iod()
+        self._check_conditions()
+        self._check_elements(self.ds, '')
+        self._check_tid_3465()
+        self._check_dent_oip()
+
+    def _check_iod(self):
+        for module, tag, keyword, attribute_type in _IOD_TAGS:
+            if tag not in self.ds:
+                self.issue(keyword, f"Type {attribute_type} attribute of the {module} module is missing", 'iod')
+            elif attribute_type == TYPE_1 and _is_empty(self.ds[tag]):
+                self.issue(keyword, f"Type 1 attribute of the {module} module is empty", 'iod')
+
+    def _check_conditions(self):
+        ds = self.ds
+        if ds.get('SOPClassUID') not in (None, VLPhotographicImageStorage):
+            self.issue('SOPClassUID', f"{ds.SOPClassUID} is not VL Photographic Image Storage", 'iod')
+        if ds.get('Modality') not in (None, 'XC'):
+            self.issue('Modality', f"Should be XC for VL Photographic Images, not {ds.Modality}", 'iod')
+
+        samples_per_pixel = ds.get('SamplesPerPixel')
+        if samples_per_pixel is not None and samples_per_pixel > 1:
+            if 'PlanarConfiguration' not in ds:
+                self.issue('PlanarConfiguration', "Required when SamplesPerPixel > 1", 'iod')
+        elif 'PlanarConfiguration' in ds:
+            self.issue('PlanarConfiguration', "Shall not be present when SamplesPerPixel is 1", 'iod')
+
+        if ds.get('LossyImageCompression') == '01':
+            for keyword in ('LossyImageCompressionRatio', 'LossyImageCompressionMethod'):
+                if keyword not in ds:
+                    self.issue(keyword, "Recommended when LossyImageCompression is 01", 'iod', WARNING)
+
+        ratio = ds.get('LossyImageCompressionRatio')
+        pixel_data = ds.get('PixelData')
+        if ratio and pixel_data and ds.get('NumberOfFrames', 1) == 1 and 'Rows' in ds and 'Columns' in ds:
+            uncompressed = ds.Rows * ds.Columns * ds.get('SamplesPerPixel', 1) * ds.get('BitsAllocated', 8) // 8
+            actual = uncompressed / len(pixel_data)
+            first_ratio = float(ratio[0] if ds['LossyImageCompressionRatio'].VM > 1 else ratio)
+            if abs(first_ratio / actual - 1) > COMPRESSION_RATIO_TOLERANCE:
+                self.issue('LossyImageCompressionRatio',
+                           f"{first_ratio} does not match the pixel data, about {actual:.2f}", 'iod', WARNING)
+
+        file_meta = getattr(ds, 'file_meta', None)
+        if file_meta is not None and 'MediaStorageSOPInstanceUID' in file_meta:
+            if file_meta.MediaStorageSOPInstanceUID != ds.get('SOPInstanceUID'):
+                self.issue('MediaStorageSOPInstanceUID', "Differs from SOPInstanceUID", 'iod')
+
+    def _check_elements(self, ds: Dataset, prefix):
+        has_character_set = 'SpecificCharacterSet' in self.ds
+        elements = ds
+        if prefix == '' and self.tags is not None:
+            elements = (ds[tag] for tag in sorted(self.tags) if tag in ds)
+        for element in elements:
+            path = f"{prefix}{element.keyword or element.tag}"
+            if element.VR == 'SQ':
+                is_code_sequence = element.keyword.endswith('CodeSequence') or element.keyword in CODE_SEQUENCES
+                for index, item in enumerate(element.value):
+                    item_path = f"{path}[{index}]"
+                    if is_code_sequence:
+                        self._check_code_item(item, item_path)
+                    self._check_elements(item, item_path + '.')
+                continue
+            if element.tag.is_private or _is_empty(element):
+                continue
+            self._check_vm(element, path)
+            if element.VR in _TEXT_VRS:
+                values = element.value if element.VM > 1 else [element.value]
+                for value in values:
+                    value = str(value)
+                    try:
+                        validate_value(element.VR, value, pydicom_config.RAISE)
+                    except ValueError as e:
+                        self.issue(path, str(e), 'vr')
+                    if not has_character_set and not value.isascii():
+                        self.issue(path, "Non ASCII value without SpecificCharacterSet", 'vr')
+
+    def _check_vm(self, element, path):
+        try:
+            minimum, maximum = _vm_bounds_of_tag(element.tag)
+        except (KeyError, ValueError):
+            return
+        if element.VM < minimum or (maximum is not None and element.VM > maximum):
+            self.issue(path, f"VM is {element.VM}, should be {dictionary_VM(element.tag)}", 'vm')
+
+    def _check_code_item(self, item: Dataset, path):
+        values = [keyword for keyword in CODE_VALUE_KEYWORDS if keyword in item]
+        if len(values) != 1:
+            self.issue(path, "Needs exactly one of CodeValue, LongCodeValue or URNCodeValue", 'code')
+        for keyword in ('CodingSchemeDesignator', 'CodeMeaning'):
+            if keyword not in item or _is_empty(item[keyword]):
+                self.issue(f"{path}.{keyword}", "Type 1 attribute of the code is missing", 'code')
+
+    def _check_tid_3465(self):
+        sequence = self.ds.get('AcquisitionContextSequence')
+        if not sequence:
+            return
+        seen = {}
+        for index, item in enumerate(sequence):
+            path = f"AcquisitionContextSequence[{index}]"
+            concept_name_sequence = item.get('ConceptNameCodeSequence')
+            if not concept_name_sequence or len(concept_name_sequence) != 1:
+                self.issue(f"{path}.ConceptNameCodeSequence", "Needs exactly one item", 'tid3465')
+                continue
+            concept_name = _TID_3465_CONCEPT_NAME_CODES.get(_code_of(concept_name_sequence[0]))
+            if concept_name is None:
+                self.issue(f"{path}.ConceptNameCodeSequence",
+                           f"{_code_of(concept_name_sequence[0])} is not a concept name of TID 3465",
+                           'tid3465', WARNING)
+            else:
+                seen[concept_name] = seen.get(concept_name, 0) + 1
+
+            value_type = item.get('ValueType')
+            if value_type == 'CODE':
+                if len(item.get('ConceptCodeSequence') or []) != 1:
+                    self.issue(f"{path}.ConceptCodeSequence", "CODE items need exactly one item", 'tid3465')
+            elif value_type == 'NUMERIC':
+                if 'NumericValue' not in item:
+                    self.issue(f"{path}.NumericValue", "NUMERIC items need a NumericValue", 'tid3465')
+                if len(item.get('MeasurementUnitsCodeSequence') or []) != 1:
+                    self.issue(f"{path}.MeasurementUnitsCodeSequence",
+                               "NUMERIC items need exactly one unit", 'tid3465')
+            else:
+                self.issue(f"{path}.ValueType", f"Unexpected ValueType {value_type!r}", 'tid3465')
+
+        for concept_name, count in seen.items():
+            maximum = TID_3465_CONCEPT_NAMES[concept_name]
+            if maximum is not None and count > maximum:
+                self.issue('AcquisitionContextSequence', f"{concept_name} used {count} times", 'tid3465')
+        if ('TemporalEventType' in seen) != ('OffsetFromEvent' in seen):
+            self.issue('AcquisitionContextSequence',
+                       "TemporalEventType and OffsetFromEvent go together", 'tid3465')
+
+    def _check_dent_oip(self):
+        comments = self.ds.get('ImageComments')
+        keyword = str(comments).split('^')[0] if comments else None
+        view = VIEWS.get(keyword)
+        if view is None:
+            self.issue('ImageComments', f"{keyword!r} is not a DENT-OIP view", 'dent-oip', WARNING)
+            return
+
+        anatomic_region = self.ds.get('AnatomicRegionSequence')
+        if not anatomic_region or len(anatomic_region) != 1:
+            self.issue('AnatomicRegionSequence', "Needs exactly one item", 'dent-oip')
+        elif _code_of(anatomic_region[0]) != (view.anatomic_region.value, view.anatomic_region.scheme):
+            self.issue('AnatomicRegionSequence', f"Does not match view {keyword}", 'dent-oip')
+
+        if self.ds.get('ImageLaterality') != view.image_laterality:
+            self.issue('ImageLaterality', f"Should be {view.image_laterality} for view {keyword}", 'dent-oip')
+
+        if view.patient_orientation is not None:
+            orientation = self.ds.get('PatientOrientation')
+            if not orientation or list(orientation) != list(view.patient_orientation):
+                expected = '\\'.join(view.patient_orientation)
+                self.issue('PatientOrientation', f"Should be {expected} for view {keyword}", 'dent-oip')
+
+        if view.view_code is not None:
+            view_code = self.ds.get('ViewCodeSequence')
+            if not view_code or _code_of(view_code[0]) != (view.view_code.value, view.view_code.scheme):
+                self.issue('ViewCodeSequence', f"Does not match view {keyword}", 'dent-oip')
+
+
+def validate_dataset(ds: Dataset, source=None, tags=None) -> ValidationResult:
+    """ Validate a dataset in memory. source names it in the result.
+
+    tags: only check the values of these top level elements, for the FAST
+    mode. The presence of required attributes, TID 3465 and DENT-OIP are
+    always checked.
+    """
+    result = ValidationResult(source=source)
+    _Validator(ds, result, tags).run()
+    return result
+
+
+def validate_file(filename) -> ValidationResult:
+    """ Read and validate a DICOM file. Unreadable files are an error. """
+    try:
+        ds = dcmread(filename)
+    except Exception as e:  # pylint: disable=broad-except
+        return ValidationResult(str(filename), [Issue(ERROR, '', f"Cannot read: {e}", 'iod')])
+    return validate_dataset(ds, source=str(filename))
+
+
+def validate_files(filenames, jobs=1) -> List[ValidationResult]:
+    """ Validate DICOM files, with jobs worker processes. Results are in the order of filenames. """
+    filenames = [str(filename) for filename in filenames]
+    if jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(validate_file, filenames, chunksize=8))
+    return [validate_file(filename) for filename in filenames]
@@ -0,0 +1,309 @@
+""" Watch a folder and convert the images dropped into it.
+
+Camera tethering software writes photographs into a folder. FolderWatcher
+notices new image files, through inotify on Linux or by scanning the folder
+otherwise, waits until they are completely written, then converts them, and
+optionally sends them, with controller.convert_image_file(), or queues them
+into a dicom4ortho.outbox.Outbox to send.
+
+A file counts as completely written once its size and modification time
+have not changed for settle_seconds. Files ready for conversion wait in a
+queue of at most queue_size entries: when a burst of photographs arrives
+faster than the workers convert them, the watcher stops picking up new
+files until there is room again, instead of piling up work.
+
+When the kernel drops inotify events because too many came at once, the
+whole folder is scanned again, so that no file is missed.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from dicom4ortho import metrics
+from dicom4ortho.config import WATCH_POLL_INTERVAL, WATCH_QUEUE_SIZE, WATCH_SETTLE_SECONDS
+from dicom4ortho.controller import (
+    BatchSummary, convert_image_file, image_file_metadata, is_image_file)
+from dicom4ortho.validation import ValidationError
+
+import logging
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """ Minimal inotify(7) binding, through ctypes.
+
+    Raises OSError when inotify is not available.
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        # Set by read() when the kernel dropped events: the caller must scan again, and reset it.
+        self.overflowed = False
+
+    def add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+        self._directories[wd] = Path(directory)
+
+    def read(self, timeout):
+        """ Wait up to timeout seconds for events.
+
+        Returns a list of (path, is_directory) of the files that were
+        created, written or moved in.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += _INOTIFY_EVENT.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            directory = self._directories.get(wd)
+            if directory is not None and name:
+                events.append((directory / os.fsdecode(name), bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(object):
+    """ Convert the images written into a folder, until stop() is called.
+
+    directory: the folder to watch, including its sub folders.
+    output_dir, image_type_rules, default_image_type, metadata, validate,
+        cache, index: as in OrthodonticController.bulk_convert_images(). Invalid
+        files are logged as soon as they are converted.
+    jobs: number of images converted at the same time, in worker processes
+        when more than 1.
+    send: arguments of OrthodonticController.send() for each converted image.
+    outbox: a dicom4ortho.outbox.Outbox to queue each converted image into,
+        instead of sending it right away. Its workers run along the watcher.
+    queue_size, settle_seconds, poll_interval: see config.
+    use_inotify: set to False to always scan the folder.
+
+    Images already in the folder are converted too, unless their DICOM file
+    exists and is newer.
+    """
+
+    def __init__(self, directory, output_dir=None, image_type_rules=(), default_image_type=None,
+                 metadata=None, jobs=1, send=None, queue_size=WATCH_QUEUE_SIZE,
+                 settle_seconds=WATCH_SETTLE_SECONDS, poll_interval=WATCH_POLL_INTERVAL,
+                 use_inotify=True, validate=None, cache=None, index=None, outbox=None):
+        self.directory = Path(directory)
+        self.output_dir = output_dir
+        self.image_type_rules = image_type_rules
+        self.default_image_type = default_image_type
+        self.metadata = dict(metadata or {})
+        if validate:
+            self.metadata['validate'] = validate
+        if cache is not None:
+            self.metadata['cache'] = cache
+        if index is not None:
+            self.metadata['index'] = index
+        self.jobs = max(1, jobs)
+        self.send = send
+        self.outbox = outbox
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.summary = BatchSummary()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # path -> (size, mtime_ns, time of the last change) of files not yet settled
+        self._pending = {}
+        # path -> mtime_ns of the files already queued
+        self._queued = {}
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except OSError as e:
+                logger.info("Scanning %s every %s s: %s", directory, poll_interval, e)
+
+    def run(self):
+        """ Watch and convert until stop(). Returns a BatchSummary. """
+        start = time.perf_counter()
+        executor = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        workers = [threading.Thread(target=self._work, args=(executor,), daemon=True)
+                   for _ in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+        if self.outbox is not None:
+            self.outbox.start()
+
+        try:
+            if self._inotify is not None:
+                for directory in self._directories():
+                    self._inotify.add_watch(directory)
+            self._scan()
+            while not self._stop.is_set():
+                self._detect()
+                self._enqueue_settled()
+        finally:
+            for _ in workers:
+                self._queue.put(None)
+            for worker in workers:
+                worker.join()
+            if executor is not None:
+                executor.shutdown()
+            if self.outbox is not None:
+                self.outbox.stop()
+            if self._inotify is not None:
+                self._inotify.close()
+        self.summary.seconds = time.perf_counter() - start
+        return self.summary
+
+    def stop(self):
+        """ Stop watching. Files already queued are still converted. """
+        self._stop.set()
+
+    def _directories(self):
+        yield self.directory
+        for path in self.directory.rglob('*'):
+            if path.is_dir():
+                yield path
+
+    def _is_image(self, path):
+        return is_image_file(path)
+
+    def _consider(self, path):
+        if self._is_image(path) and path not in self._pending:
+            self._pending[path] = (None, None, time.monotonic())
+
+    def _scan(self):
+        for path in self.directory.rglob('*'):
+            if not self._is_image(path) or path in self._pending:
+                continue
+            try:
+                mtime_ns = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if self._queued.get(path) != mtime_ns:
+                self._consider(path)
+
+    def _detect(self):
+        """ Wait for new files, at most until pending files need checking. """
+        timeout = self.poll_interval
+        if self._pending:
+            timeout = min(timeout, self.settle_seconds / 2)
+        if self._inotify is None:
+            self._stop.wait(timeout)
+            self._scan()
+            return
+        events = self._inotify.read(timeout)
+        if self._inotify.overflowed:
+            self._inotify.overflowed = False
+            logger.warning("Missed file events, scanning %s again", self.directory)
+            for directory in self._directories():
+                self._inotify.add_watch(directory)
+            self._scan()
+        for path, is_directory in events:
+            if is_directory:
+                self._inotify.add_watch(path)
+                for sub_path in path.rglob('*'):
+                    if sub_path.is_dir():
+                        self._inotify.add_watch(sub_path)
+                    else:
+                        self._consider(sub_path)
+            else:
+                self._consider(path)
+
+    def _enqueue_settled(self):
+        now = time.monotonic()
+        for path, (size, mtime_ns, changed) in list(self._pending.items()):
+            try:
+                stat = path.stat()
+            except OSError:
+                # Deleted or renamed before it settled.
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - changed >= self.settle_seconds:
+                del self._pending[path]
+                if not self._is_converted(path):
+                    # Blocks while the queue is full.
+                    self._queue.put(path)
+                self._queued[path] = mtime_ns
+
+    def _image_metadata(self, path):
+        return image_file_metadata(
+            path, self.directory, self.output_dir, self.image_type_rules,
+            self.default_image_type, self.metadata)
+
+    def _is_converted(self, path):
+        output = Path(self._image_metadata(path)['output_image_filename'])
+        try:
+            return output.stat().st_mtime_ns >= path.stat().st_mtime_ns
+        except OSError:
+            return False
+
+    def _work(self, executor):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            image_metadata = self._image_metadata(path)
+            try:
+                if executor is not None:
+                    result = executor.submit(
+                        convert_image_file, image_metadata, self.send).result()
+                else:
+                    result = convert_image_file(image_metadata, self.send)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Could not convert %s: %s", path, e)
+                metrics.count('failures')
+                with self._lock:
+                    self.summary.failures += 1
+                continue
+            logger.info("Converted %s", path)
+            if self.outbox is not None:
+                try:
+                    self.outbox.enqueue(image_metadata['output_image_filename'])
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Could not queue %s: %s", path, e)
+            validation_result = result[2]
+            if validation_result is not None and not validation_result.is_valid:
+                logger.error("%s", ValidationError([validation_result]))
+            with self._lock:
+                self.summary.add(result)
@@ -0,0 +1,207 @@
+""" Safe and fast writing of DICOM files.
+
+FileWriter writes each file into a temporary file next to it, then renames
+it over the final name, so that a crash never leaves a truncated .dcm file
+for a PACS forwarder to pick up. Writes go through one large buffer, which
+matters on network storage, where each small write is a round trip.
+
+When the data reaches the disk is set by the fsync policy:
+
+    FSYNC_NONE: leave it to the operating system. Fastest.
+    FSYNC_FILE: fsync each file and its directory before save() returns.
+    FSYNC_BATCH: fsync all the files of a batch at once, with sync() or
+        fsync_files(), when the batch is done.
+
+With direct=True, files are opened with O_DIRECT where supported, bypassing
+the page cache, and written from a page aligned buffer in whole blocks.
+"""
+
+import mmap
+import os
+import secrets
+import time
+
+from dicom4ortho import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_BATCH = 'batch'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_BATCH)
+
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block
+# size of the device, which is at most a page.
+DIRECT_IO_ALIGNMENT = mmap.PAGESIZE
+
+
+def fsync_files(filenames):
+    """ fsync files and then, once each, the directories they are in. """
+    directories = set()
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(os.path.abspath(filename)))
+    for directory in directories:
+        _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    """ Persist renames in directory. Not possible on all platforms. """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _AlignedWriter(object):
+    """ Write into a file descriptor in whole blocks, from a page aligned buffer.
+
+    The last block is padded, and the file truncated back to its length on
+    close().
+    """
+
+    def __init__(self, fd, buffer_size):
+        self.fd = fd
+        size = max(DIRECT_IO_ALIGNMENT, buffer_size - buffer_size % DIRECT_IO_ALIGNMENT)
+        # Anonymous maps are page aligned
+        self._buffer = mmap.mmap(-1, size)
+        self._view = memoryview(self._buffer)
+        self._used = 0
+        self.length = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        written = 0
+        while written < len(data):
+            chunk = min(len(data) - written, len(self._view) - self._used)
+            self._view[self._used:self._used + chunk] = data[written:written + chunk]
+            self._used += chunk
+            written += chunk
+            if self._used == len(self._view):
+                self._flush(self._used)
+        self.length += written
+        return written
+
+    def _flush(self, length):
+        view = self._view[:length]
+        while view:
+            view = view[os.write(self.fd, view):]
+        self._used = 0
+
+    def close(self):
+        if self._used:
+            padded = -(-self._used // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+            self._view[self._used:padded] = bytes(padded - self._used)
+            self._flush(padded)
+            os.ftruncate(self.fd, self.length)
+        self._view.release()
+        self._buffer.close()
+
+
+class FileWriter(object):
+    """ Writes files atomically, with large buffers and an fsync policy.
+
+    fsync: one of FSYNC_POLICIES. See the module docstring.
+    buffer_size: bytes written at once.
+    direct: write with O_DIRECT where the platform and file system support
+        it. Falls back to buffered writes otherwise.
+    atomic: write into a temporary file and rename it. If False, write
+        straight into the final file.
+
+    Keeps the number of bytes and the seconds spent writing, to report the
+    write throughput.
+    """
+
+    def __init__(self, fsync=None, buffer_size=None, direct=None, atomic=True):
+        self.fsync = fsync or config.SAVE_FSYNC
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, not {self.fsync!r}")
+        self.buffer_size = buffer_size or config.SAVE_BUFFER_SIZE
+        self.direct = config.SAVE_DIRECT_IO if direct is None else direct
+        self.atomic = atomic
+        self.bytes = 0
+        self.seconds = 0.0
+        self._unsynced = []
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.bytes / 1e6:.1f} MB written in {self.seconds:.2f} s: {self.bytes_per_second / 1e6:.1f} MB/s"
+
+    def _open(self, path):
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        flags |= os.O_EXCL if self.atomic else os.O_TRUNC
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(path, flags | os.O_DIRECT, 0o666), True
+            except OSError as e:
+                logger.debug("O_DIRECT not supported for %s: %s", path, e)
+        return os.open(path, flags, 0o666), False
+
+    def write(self, filename, write) -> int:
+        """ Write a file. Returns its length in bytes.
+
+        write: callable(fp) writing the content of the file into fp, a
+        writable binary stream.
+        """
+        filename = os.fspath(filename)
+        start = time.perf_counter()
+        if self.atomic:
+            directory, name = os.path.split(filename)
+            path = os.path.join(directory, f".{name}.{secrets.token_hex(8)}.tmp")
+        else:
+            path = filename
+        fd, direct = self._open(path)
+        try:
+            if direct:
+                fp = _AlignedWriter(fd, self.buffer_size)
+                try:
+                    write(fp)
+                finally:
+                    fp.close()
+                length = fp.length
+            else:
+                fp = open(fd, 'wb', buffering=self.buffer_size, closefd=False)
+                try:
+                    write(fp)
+                    fp.flush()
+                finally:
+                    fp.close()
+                length = os.fstat(fd).st_size
+            if self.fsync == FSYNC_FILE:
+                os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            if self.atomic:
+                os.unlink(path)
+            raise
+        os.close(fd)
+
+        if self.atomic:
+            os.replace(path, filename)
+        if self.fsync == FSYNC_FILE:
+            _fsync_directory(os.path.dirname(os.path.abspath(filename)))
+        elif self.fsync == FSYNC_BATCH:
+            self._unsynced.append(filename)
+
+        self.bytes += length
+        self.seconds += time.perf_counter() - start
+        return length
+
+    def sync(self):
+        """ fsync the files written since the last sync(), for FSYNC_BATCH. """
+        unsynced, self._unsynced = self._unsynced, []
+        fsync_files(unsynced)
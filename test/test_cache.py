@@ -0,0 +1,95 @@
+'''
+Unit tests for the cache of converted photographs.
+'''
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from pydicom import dcmread
+
+from dicom4ortho.cache import ConversionCache
+from dicom4ortho.controller import OrthodonticController
+from dicom4ortho.server import run_job
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestConversionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ConversionCache(os.path.join(self.tmpdir.name, 'cache'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testKey(self):
+        key = self.cache.key(b'image', {'image_type': 'EV-01', 'patient_id': ' 1 ',
+                                        'output_image_filename': 'a.dcm'})
+        self.assertEqual(key, self.cache.key(b'image', {'image_type': 'ev01', 'patient_id': '1'}))
+        self.assertNotEqual(key, self.cache.key(b'image', {'image_type': 'EV02', 'patient_id': '1'}))
+        self.assertNotEqual(key, self.cache.key(b'other', {'image_type': 'EV01', 'patient_id': '1'}))
+        self.assertEqual(self.cache.sop_instance_uid(key), self.cache.sop_instance_uid(key))
+
+    def testBatchReconversionIsCached(self):
+        outputs = []
+        for run in ('first', 'second'):
+            output_dir = os.path.join(self.tmpdir.name, run)
+            summary = OrthodonticController().bulk_convert_images(
+                [str(RESOURCES / 'EV-*.png')], output_dir=output_dir, cache=self.cache)
+            self.assertEqual(summary.images, 2)
+            outputs.append(sorted(Path(output_dir).iterdir()))
+        for first, second in zip(*outputs):
+            self.assertEqual(first.read_bytes(), second.read_bytes())
+        self.assertEqual(len(list(self.cache._entries())), 2)
+
+    def testServerJobIsCached(self):
+        import base64
+        job = {'image': base64.b64encode((RESOURCES / 'EV-01_EO.RP.LR.CO.png').read_bytes()).decode('ascii'),
+               'metadata': {'image_type': 'EV01'}, 'return_dicom': True}
+        first = run_job(job, cache=self.cache)
+        second = run_job(job, cache=self.cache)
+        self.assertEqual((first['cached'], second['cached']), (False, True))
+        self.assertEqual(first['sop_instance_uid'], second['sop_instance_uid'])
+        self.assertEqual(first['dicom'], second['dicom'])
+
+    def testSameUIDsAfterEviction(self):
+        import base64
+        job = {'image': base64.b64encode((RESOURCES / 'EV-01_EO.RP.LR.CO.png').read_bytes()).decode('ascii'),
+               'metadata': {'image_type': 'EV01'}}
+        uids = ('sop_instance_uid', 'study_instance_uid', 'series_instance_uid')
+        first = run_job(job, cache=self.cache)
+        for entry in list(self.cache._entries()):
+            os.remove(entry.path)
+        second = run_job(job, cache=self.cache)
+        self.assertEqual((first['cached'], second['cached']), (False, False))
+        self.assertEqual([first[uid] for uid in uids], [second[uid] for uid in uids])
+        self.assertEqual(len(set(first[uid] for uid in uids)), 3)
+
+    def testUIDsFromMetadataAndMWL(self):
+        from test.sample_data_generator import make_sample_MWL
+        key = self.cache.key(b'image')
+        self.assertEqual(set(self.cache.uids(key)), {'sop_instance_uid', 'study_instance_uid', 'series_instance_uid'})
+        self.assertEqual(set(self.cache.uids(key, {'study_instance_uid': '1.2', 'series_instance_uid': '1.3'})),
+                         {'sop_instance_uid'})
+        mwl = make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+        self.assertEqual(set(self.cache.uids(key, {'dicom_mwl': mwl})), {'sop_instance_uid', 'series_instance_uid'})
+
+    def testEviction(self):
+        cache = ConversionCache(self.cache.directory, max_bytes=2500)
+        keys = [cache.key(bytes([i])) for i in range(4)]
+        for i, key in enumerate(keys):
+            cache.put(key, lambda fp: fp.write(b'x' * 1000))
+            os.utime(cache.path(key), ns=(i * 10**9, i * 10**9))
+            if i == 1:
+                self.assertIsNotNone(cache.get(keys[0]))
+                os.utime(cache.path(keys[0]), ns=(5 * 10**9, 5 * 10**9))
+        self.assertLessEqual(cache.size(), 2500)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNotNone(cache.get(keys[3]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,11 +4,16 @@ Unit tests for command line interface.
 @author: Toni Magni
 '''
 import io
+import json
 import unittest
 import logging
 import os
+import shutil
 import importlib.resources
+import tempfile
+from pathlib import Path
 from unittest.mock import patch
+from pydicom import dcmread
 import dicom4ortho.__main__
 class Test(unittest.TestCase):
 
@@ -55,3 +60,68 @@ class Test(unittest.TestCase):
         # spot-check a known image type from image_types.csv
         self.assertIn('EV01', output)
         self.assertIn('EO.RP.LR.CO', output)
+
+    def testBatchDirectory(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            testargs = ['', '--output-dir', output_dir, '--jobs', '2',
+                        '--image-type-rule', 'sample_*=IV-01', 'test/resources']
+            return_status = dicom4ortho.__main__.main(testargs)
+            self.assertEqual(return_status, 0)
+            outputs = sorted(p.name for p in Path(output_dir).iterdir())
+            self.assertEqual(outputs, [
+                'EV-01_EO.RP.LR.CO.dcm', 'EV-17_EO.FF.LC.CO.dcm',
+                'IV-25_IO.MX.MO.OV.WM.BC.dcm', 'sample_NikonD90.dcm',
+                'sample_topsOrtho.dcm'])
+            ds = dcmread(Path(output_dir) / 'EV-17_EO.FF.LC.CO.dcm', stop_before_pixels=True)
+            self.assertTrue(ds.ImageComments.startswith('EV17^'))
+            ds = dcmread(Path(output_dir) / 'sample_NikonD90.dcm', stop_before_pixels=True)
+            self.assertTrue(ds.ImageComments.startswith('IV01^'))
+
+    def testBatchGlob(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            testargs = ['', '-d', output_dir, 'test/resources/IV-*.png']
+            return_status = dicom4ortho.__main__.main(testargs)
+            self.assertEqual(return_status, 0)
+            self.assertEqual(
+                [p.name for p in Path(output_dir).iterdir()],
+                ['IV-25_IO.MX.MO.OV.WM.BC.dcm'])
+
+    def testOutputCollision(self):
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            shutil.copy('test/resources/sample_NikonD90.JPG', os.path.join(input_dir, 'photo.jpg'))
+            shutil.copy('test/resources/EV-01_EO.RP.LR.CO.png', os.path.join(input_dir, 'photo.png'))
+            return_status = dicom4ortho.__main__.main(
+                ['', '-d', output_dir, '--image-type', 'EV-01', input_dir])
+            self.assertEqual(return_status, 1)
+            self.assertEqual(list(Path(output_dir).iterdir()), [])
+
+    def testConvertCommand(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            return_status = dicom4ortho.__main__.main(
+                ['', 'convert', '-d', output_dir, 'test/resources/IV-*.png'])
+            self.assertEqual(return_status, 0)
+            self.assertEqual(
+                [p.name for p in Path(output_dir).iterdir()],
+                ['IV-25_IO.MX.MO.OV.WM.BC.dcm'])
+
+    def testSingleFileCache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'output.dcm')
+            cache = os.path.join(directory, 'cache')
+            for _ in range(2):
+                return_status = dicom4ortho.__main__.main(
+                    ['', '--cache', cache, '--index', os.path.join(directory, 'index.sqlite'),
+                     '-o', output, 'test/resources/EV-01_EO.RP.LR.CO.png'])
+                self.assertEqual(return_status, 0)
+                self.assertTrue(os.listdir(cache))
+                ds = dcmread(output, stop_before_pixels=True)
+                self.assertTrue(ds.ImageComments.startswith('EV01^'))
+
+    def testValidate(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            dicom4ortho.__main__.main(['', '-d', output_dir, 'test/resources/EV-*.png'])
+            with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+                return_status = dicom4ortho.__main__.main(['', '--validate', output_dir])
+        results = [json.loads(line) for line in mock_stdout.getvalue().splitlines()]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(return_status, 0, msg=results)
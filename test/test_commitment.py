@@ -0,0 +1,218 @@
+'''
+Unit tests for Storage Commitment, and the outbox purging what the PACS committed to.
+'''
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, VLPhotographicImageStorage
+from pynetdicom import AE, build_role, evt
+from pynetdicom.sop_class import StorageCommitmentPushModel  # pylint: disable=E0611
+
+import dicom4ortho.__main__
+from dicom4ortho.dicom.commitment import (ALL_COMMITTED, SOME_FAILED, STORAGE_COMMITMENT_INSTANCE,
+                                          CommitmentError, StorageCommitment)
+from dicom4ortho.outbox import Outbox
+
+SEND = {'send_method': 'dimse', 'pacs_dimse_hostname': 'pacs', 'pacs_dimse_port': 104,
+        'pacs_dimse_aet': 'PACS'}
+
+
+class CommitmentSCP(object):
+    """ A PACS which commits to everything but the instances in fail, reporting on a new association. """
+
+    def __init__(self):
+        self.fail = set()
+        self.auto_report = True
+        self.requests = []
+        self.listener = None
+        self.ae = AE(ae_title='PACS')
+        self.ae.add_supported_context(StorageCommitmentPushModel)
+        self.ae.add_requested_context(StorageCommitmentPushModel)
+        self.server = self.ae.start_server(('127.0.0.1', 0), block=False,
+                                           evt_handlers=[(evt.EVT_N_ACTION, self.handle_action)])
+        self.port = self.server.server_address[1]
+
+    def handle_action(self, event):
+        request = event.action_information
+        self.requests.append(request)
+        if self.auto_report:
+            threading.Thread(target=self.report, args=(request,)).start()
+        return 0x0000, None
+
+    def report(self, request):
+        ds = Dataset()
+        ds.TransactionUID = request.TransactionUID
+        committed, failed = [], []
+        for item in request.ReferencedSOPSequence:
+            reference = Dataset()
+            reference.ReferencedSOPClassUID = item.ReferencedSOPClassUID
+            reference.ReferencedSOPInstanceUID = item.ReferencedSOPInstanceUID
+            if item.ReferencedSOPInstanceUID in self.fail:
+                reference.FailureReason = 0x0110
+                failed.append(reference)
+            else:
+                committed.append(reference)
+        ds.ReferencedSOPSequence = Sequence(committed)
+        if failed:
+            ds.FailedSOPSequence = Sequence(failed)
+        _, port = self.listener.address
+        assoc = self.ae.associate('127.0.0.1', port, ae_title=self.listener.local_aet,
+                                  ext_neg=[build_role(StorageCommitmentPushModel, scp_role=True)])
+        try:
+            status, _ = assoc.send_n_event_report(
+                ds, SOME_FAILED if failed else ALL_COMMITTED, StorageCommitmentPushModel,
+                STORAGE_COMMITMENT_INSTANCE)
+        finally:
+            assoc.release()
+        return status
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestStorageCommitment(unittest.TestCase):
+
+    def setUp(self):
+        self.scp = CommitmentSCP()
+        self.addCleanup(self.scp.shutdown)
+        self.reports = []
+        self.commitment = StorageCommitment(
+            '127.0.0.1', self.scp.port, 'PACS', listen_host='127.0.0.1', listen_port=0,
+            on_report=lambda *report: self.reports.append(report))
+        self.commitment.start()
+        self.addCleanup(self.commitment.shutdown)
+        self.scp.listener = self.commitment
+
+    def testRequestAndReport(self):
+        references = [(VLPhotographicImageStorage, '1.2.3.1'), (VLPhotographicImageStorage, '1.2.3.2')]
+        transaction_uid = self.commitment.request(references)
+        # One N-ACTION for the whole batch
+        self.assertEqual(len(self.scp.requests), 1)
+        self.assertEqual(len(self.scp.requests[0].ReferencedSOPSequence), 2)
+        self.assertTrue(wait_for(lambda: self.reports))
+        self.assertEqual(self.reports, [(transaction_uid, ['1.2.3.1', '1.2.3.2'], [])])
+
+    def testFailedReport(self):
+        self.scp.fail.add('1.2.3.2')
+        transaction_uid = self.commitment.request(
+            [(VLPhotographicImageStorage, '1.2.3.1'), (VLPhotographicImageStorage, '1.2.3.2')])
+        self.assertTrue(wait_for(lambda: self.reports))
+        self.assertEqual(self.reports, [(transaction_uid, ['1.2.3.1'], [('1.2.3.2', 0x0110)])])
+
+    def testUnreachable(self):
+        self.scp.shutdown()
+        commitment = StorageCommitment('127.0.0.1', self.scp.port, 'PACS', timeout=1)
+        with self.assertRaises(CommitmentError):
+            commitment.request([(VLPhotographicImageStorage, '1.2.3.1')])
+
+
+class TestOutboxCommitment(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scp = CommitmentSCP()
+        self.addCleanup(self.scp.shutdown)
+        self.commitment = StorageCommitment('127.0.0.1', self.scp.port, 'PACS', listen_host='127.0.0.1',
+                                            listen_port=0)
+        self.scp.listener = self.commitment
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox'), send=SEND, fsync='none',
+                             commitment=self.commitment, purge_source=True)
+        self.outbox.start_commitment()
+        patcher = patch('dicom4ortho.controller.dimse.send', return_value=Dataset())
+        patcher.start().return_value.Status = 0x0000
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.outbox.stop()
+        shutil.rmtree(self.directory)
+
+    def dicom_file(self, sop_instance_uid):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = VLPhotographicImageStorage
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.StudyInstanceUID = '1.2.1'
+        filename = os.path.join(self.directory, f'{sop_instance_uid}.dcm')
+        ds.save_as(filename, write_like_original=False)
+        return filename
+
+    def testPurgesOnceCommitted(self):
+        self.scp.auto_report = False
+        filenames = [self.dicom_file(f'1.2.1.{n}') for n in range(3)]
+        for filename in filenames:
+            self.outbox.enqueue(filename)
+        self.outbox.drain()
+        self.assertEqual(len(self.scp.requests), 1)
+        # Sent but not committed yet: everything is kept
+        self.assertEqual(self.outbox.status(), {'pending': 0, 'failing': 0, 'sent': 3, 'committed': 0})
+        self.assertEqual(len(os.listdir(self.outbox.files_directory)), 3)
+        self.assertTrue(all(os.path.exists(filename) for filename in filenames))
+        self.assertEqual(self.outbox.forget_sent(), 0)
+
+        self.scp.report(self.scp.requests[0])
+        self.assertTrue(self.outbox.wait_committed(10))
+        self.assertEqual(self.outbox.status(), {'pending': 0, 'failing': 0, 'sent': 0, 'committed': 3})
+        self.assertEqual(os.listdir(self.outbox.files_directory), [])
+        self.assertFalse(any(os.path.exists(filename) for filename in filenames))
+        self.assertEqual(self.outbox.forget_sent(), 3)
+
+    def testFailedAreSentAgain(self):
+        self.scp.fail.add('1.2.1.1')
+        for n in range(2):
+            self.outbox.enqueue(self.dicom_file(f'1.2.1.{n}'))
+        self.outbox.drain()
+        self.assertTrue(wait_for(lambda: self.outbox.status()['pending']))
+        self.assertEqual(self.outbox.status(), {'pending': 1, 'failing': 1, 'sent': 0, 'committed': 1})
+        self.assertIn('Storage Commitment failed', self.outbox.pending()[0]['last_error'])
+        self.assertTrue(os.path.exists(os.path.join(self.outbox.files_directory, '1.2.1.1.dcm')))
+
+        self.scp.fail.clear()
+        self.outbox.drain()
+        self.assertTrue(self.outbox.wait_committed(10))
+        self.assertEqual(self.outbox.status()['committed'], 2)
+        self.assertEqual(len(self.scp.requests), 2)
+        self.assertEqual(self.scp.requests[1].ReferencedSOPSequence[0].ReferencedSOPInstanceUID, '1.2.1.1')
+
+    def testOverdueRequestsSentAgain(self):
+        self.scp.auto_report = False
+        self.commitment.report_timeout = 0.01
+        self.outbox.enqueue(self.dicom_file('1.2.1.0'))
+        self.outbox.drain_once()
+        self.assertEqual(len(self.scp.requests), 1)
+        time.sleep(0.02)
+        self.assertEqual(self.outbox.drain_once(), 0)
+        self.assertEqual(len(self.scp.requests), 2)
+        self.scp.report(self.scp.requests[1])
+        self.assertTrue(self.outbox.wait_committed(10))
+
+    def testPurgeNeedsCommit(self):
+        send_config = os.path.join(self.directory, 'send.json')
+        with open(send_config, 'w') as f:
+            json.dump(SEND, f)
+        self.assertEqual(dicom4ortho.__main__.main(
+            ['', 'outbox', '--outbox', os.path.join(self.directory, 'outbox'), 'drain', '--send-config',
+             send_config, '--purge']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
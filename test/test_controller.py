@@ -17,6 +17,7 @@ import time
 from pydicom.dataset import Dataset
 from pydicom import dcmread
 from pynetdicom import AE, evt, AllStoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+from test.sample_data_generator import make_sample_MWL
 from dicom4ortho.controller import OrthodonticController
 from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
 from dicom4ortho.config import VL_DENTAL_VIEW_CID
@@ -294,3 +295,46 @@ class TestDIMSESend(unittest.TestCase):
                 os.remove(meta['output_image_filename'])
             except OSError:
                 pass
+
+
+class TestSeriesFromMWL(unittest.TestCase):
+    """ Build a whole OrthodonticSeries from one Modality Worklist. """
+
+    def setUp(self):
+        self.mwl = make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+        with open('test/resources/sample_NikonD90.JPG', 'rb') as image_file:
+            self.image_bytes = image_file.read()
+
+    def _check_series(self, series):
+        self.assertEqual(len(series), 3)
+        for instance_number, photo in enumerate(series, start=1):
+            ds = photo.to_dataset()
+            self.assertEqual(ds.StudyInstanceUID, self.mwl.StudyInstanceUID)
+            self.assertEqual(ds.SeriesInstanceUID, series.UID)
+            self.assertEqual(int(ds.InstanceNumber), instance_number)
+            self.assertEqual(int(ds.SeriesNumber), 1)
+            self.assertEqual(ds.PatientID, self.mwl.PatientID)
+            self.assertEqual(ds.AccessionNumber, self.mwl.AccessionNumber)
+        self.assertEqual(len({photo.sop_instance_uid for photo in series}), 3)
+
+    def test_series_from_mwl(self):
+        series = OrthodonticController().convert_images_plus_mwl_to_orthodontic_series(
+            [self.image_bytes] * 3, self.mwl, image_types=['EV01', 'EV02', 'EV03'])
+        self._check_series(series)
+        self.assertEqual(
+            [photo.type_keyword for photo in series], ['EV01', 'EV02', 'EV03'])
+
+    def test_series_number(self):
+        series = OrthodonticController().convert_images_plus_mwl_to_orthodontic_series(
+            [self.image_bytes] * 2, self.mwl, series_number=3)
+        self.assertEqual([int(photo.to_dataset().SeriesNumber) for photo in series], [3, 3])
+
+    def test_series_image_types_must_match_images(self):
+        with self.assertRaises(ValueError):
+            OrthodonticController().convert_images_plus_mwl_to_orthodontic_series(
+                [self.image_bytes] * 3, self.mwl, image_types=['EV01', 'EV02'])
+
+    def test_series_from_mwl_in_parallel(self):
+        series = OrthodonticController().convert_images_plus_mwl_to_orthodontic_series(
+            [self.image_bytes] * 3, self.mwl, max_workers=3)
+        self._check_series(series)
@@ -0,0 +1,77 @@
+'''
+Unit tests for reading the headers of DICOM files.
+'''
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import dicom4ortho.__main__
+from dicom4ortho import dump
+from dicom4ortho.controller import OrthodonticController
+
+RESOURCES = Path(__file__).parent / 'resources'
+TEST_DCM = RESOURCES / 'test.dcm'
+
+
+class TestDump(unittest.TestCase):
+
+    def testReadHeader(self):
+        ds = dump.read_header(TEST_DCM)
+        self.assertNotIn('PixelData', ds)
+        self.assertEqual(ds.Rows, 517)
+        ds = dump.read_header(TEST_DCM, ['PatientID'])
+        self.assertEqual(ds.PatientID, '99999')
+        self.assertNotIn('Rows', ds)
+
+    def testSummary(self):
+        summary = dump.summary(TEST_DCM)
+        self.assertEqual(summary['filename'], str(TEST_DCM))
+        self.assertEqual(summary['size'], TEST_DCM.stat().st_size)
+        self.assertEqual(summary['transfer_syntax'], '1.2.840.10008.1.2.1')
+        self.assertEqual(summary['PatientName'], 'Doe^John')
+        self.assertEqual((summary['Rows'], summary['Columns']), (517, 409))
+        # Missing attributes are left out
+        self.assertNotIn('NumberOfFrames', summary)
+        self.assertEqual(set(dump.summary(TEST_DCM, ['PatientID', 'ImageType'])) - {'filename', 'size', 'transfer_syntax'},
+                         {'PatientID', 'ImageType'})
+
+    def testSummaryOfUnreadableFile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            broken = Path(directory) / 'broken.dcm'
+            broken.write_bytes(b'not DICOM')
+            self.assertIn('error', dump.summary(broken))
+            self.assertIn('error', dump.summary(Path(directory) / 'missing.dcm'))
+
+    def testSummariesInOrder(self):
+        filenames = [TEST_DCM, RESOURCES / 'missing.dcm', TEST_DCM]
+        for jobs in (1, 2):
+            summaries = list(dump.summaries(filenames, jobs=jobs))
+            self.assertEqual([summary['filename'] for summary in summaries], [str(f) for f in filenames])
+            self.assertEqual(['error' in summary for summary in summaries], [False, True, False])
+
+    def testSummariesOfUnknownKeyword(self):
+        for jobs in (1, 2):
+            with self.assertRaises(ValueError):
+                dump.summaries([TEST_DCM, TEST_DCM], keywords=['NotAKeyword'], jobs=jobs)
+
+    def testPrintDicomFile(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            OrthodonticController().print_dicom_file(str(TEST_DCM))
+        self.assertIn('Doe^John', stdout.getvalue())
+        self.assertNotIn('Pixel Data', stdout.getvalue())
+
+    def testCli(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            status = dicom4ortho.__main__.main(['', 'dump', '-k', 'PatientID,Rows', str(TEST_DCM)])
+        self.assertEqual(status, 0)
+        summary = json.loads(stdout.getvalue())
+        self.assertEqual((summary['PatientID'], summary['Rows']), ('99999', 517))
+        with self.assertRaises(SystemExit):
+            dicom4ortho.__main__.main(['', 'dump', '-k', 'NotAKeyword', str(TEST_DCM)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -110,6 +110,28 @@ class TestGeneratedCodesModule(unittest.TestCase):
         self.assertEqual(ds.CodingSchemeDesignator, "SCT")
         self.assertEqual(ds.CodeMeaning, "Mouth region structure")
 
+    def test_dicom_code_is_interned(self):
+        """Equal DicomCodes must be the same object, also after pickling."""
+        import pickle
+        from dicom4ortho.m_dent_oip import DicomCode
+        code = DicomCode(value="123851003", scheme="SCT", meaning="Mouth region structure")
+        self.assertIs(code, DicomCode("123851003", "SCT", "Mouth region structure"))
+        self.assertIs(code, pickle.loads(pickle.dumps(code)))
+
+    def test_dicom_code_to_dataset_is_independent(self):
+        """Modifying a Dataset from to_dataset() must not leak into the next one."""
+        from dicom4ortho.m_dent_oip import DicomCode
+        code = DicomCode(value="123851003", scheme="SCT", meaning="Mouth region structure")
+        ds = code.to_dataset()
+        ds.CodeMeaning = "Changed"
+        self.assertEqual(code.to_dataset().CodeMeaning, "Mouth region structure")
+
+    def test_dicom_code_non_ascii_meaning(self):
+        """Non-ASCII meanings fall back to regular, charset-aware elements."""
+        from dicom4ortho.m_dent_oip import DicomCode
+        code = DicomCode(value="X1", scheme="99TEST", meaning="45° Right Profile")
+        self.assertEqual(code.to_dataset().CodeMeaning, "45° Right Profile")
+
     def test_views_with_no_patient_orientation(self):
         """IV28 and IV30 must have patient_orientation=None (cannot be determined)."""
         views = self._module.VIEWS
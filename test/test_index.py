@@ -0,0 +1,144 @@
+'''
+Unit tests for the SQLite index of DICOM instances.
+'''
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from pydicom.dataset import Dataset
+
+import dicom4ortho.__main__
+from dicom4ortho.controller import OrthodonticController
+from dicom4ortho.index import ArchiveIndex
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = ArchiveIndex(os.path.join(self.directory, 'index.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def save(self, image_type, patient_id='P1', **metadata):
+        output = os.path.join(self.directory, f'{patient_id}_{image_type}.dcm')
+        photo = OrthodonticPhotograph(
+            input_image_filename=str(RESOURCES / 'sample_NikonD90.JPG'), image_type=image_type,
+            output_image_filename=output, patient_id=patient_id, index=self.index, **metadata)
+        photo.save()
+        return photo, output
+
+    def testSaveRecords(self):
+        photo, output = self.save(
+            'EV01', treatment_event_type='OrthodonticTreatment', days_after_event=30)
+        rows = self.index.query()
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row['sop_instance_uid'], photo.sop_instance_uid)
+        self.assertEqual((row['patient_id'], row['view']), ('P1', 'EV01'))
+        self.assertEqual(row['session_date'], '20221118')
+        self.assertEqual((row['treatment_event'], row['days_after_event']), ('OrthodonticTreatment', 30))
+        self.assertEqual(row['path'], os.path.abspath(output))
+        self.assertEqual(row['size'], os.path.getsize(output))
+        self.assertEqual(row['sha256'], hashlib.sha256(Path(output).read_bytes()).hexdigest())
+
+    def testScan(self):
+        for view in ('EV01', 'EV02'):
+            self.save(view)
+        filenames = [str(path) for path in Path(self.directory).glob('*.dcm')] + [str(RESOURCES / 'test.dcm')]
+        other = ArchiveIndex(os.path.join(self.directory, 'other.sqlite'))
+        self.assertEqual(other.scan(filenames, jobs=2), 3)
+        self.assertEqual(len(other), 3)
+        self.assertIsNone(other.query(patient_id='P1')[0]['sha256'])
+        # Unchanged files are not read again
+        self.assertEqual(other.scan(filenames), 0)
+        self.assertEqual(other.scan(filenames[:1], sha256=True), 0)
+        os.utime(filenames[0], (0, 0))
+        self.assertEqual(other.scan(filenames[:1], sha256=True), 1)
+        self.assertEqual(len([row for row in other.query() if row['sha256']]), 1)
+        other.close()
+
+    def testMissingViews(self):
+        self.save('EV01')
+        self.save('EV02')
+        self.save('EV01', patient_id='P2')
+        self.assertEqual(self.index.missing_views(['EV01', 'EV02']), [
+            {'patient_id': 'P2', 'session_date': '20221118', 'missing': ['EV02']}])
+        self.assertEqual(self.index.missing_views(['EV08', 'EV01'], patient_id='P1'), [
+            {'patient_id': 'P1', 'session_date': '20221118', 'missing': ['EV08']}])
+        self.assertEqual(self.index.missing_views(['EV01'], session_date='20000101'), [])
+
+    def testRecordSent(self):
+        _, output = self.save('EV01')
+        status = Dataset()
+        status.Status = 0x0000
+        with patch('dicom4ortho.controller.dimse.send', return_value=status):
+            OrthodonticController().send(
+                send_method='dimse', dicom_files=[output], index=self.index,
+                pacs_dimse_hostname='pacs', pacs_dimse_port=104, pacs_dimse_aet='PACS')
+        row, = self.index.query(sent=True)
+        self.assertEqual(row['destination'], 'dimse://PACS@pacs:104')
+        self.assertIsNotNone(row['sha256'])
+        self.assertEqual(self.index.query(sent=False), [])
+
+    def testFailedSendNotRecorded(self):
+        _, output = self.save('EV01')
+        status = Dataset()
+        status.Status = 0xA700
+        with patch('dicom4ortho.controller.dimse.send', return_value=status):
+            OrthodonticController().send(
+                send_method='dimse', dicom_files=[output], index=self.index,
+                pacs_dimse_hostname='pacs', pacs_dimse_port=104, pacs_dimse_aet='PACS')
+        self.assertEqual(self.index.query(sent=True), [])
+
+    def testCli(self):
+        self.save('EV01')
+        path = os.path.join(self.directory, 'cli.sqlite')
+        self.assertEqual(dicom4ortho.__main__.main(['', 'index', '--index', path, 'scan', self.directory]), 0)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            status = dicom4ortho.__main__.main(['', 'index', '--index', path, 'missing', 'EV-01,EV-02'])
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(stdout.getvalue())['missing'], ['EV02'])
+
+    def testThreads(self):
+        photo, output = self.save('EV01')
+        self.assertEqual(len(self.index), 1)
+        errors = []
+
+        def record():
+            try:
+                self.index.record_sent('PACS', dicom_files=[output])
+                self.index.add_file(output)
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        threads = [threading.Thread(target=record) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.index.query(sent=True)[0]['sop_instance_uid'], photo.sop_instance_uid)
+
+    def testPickle(self):
+        self.save('EV01')
+        index = pickle.loads(pickle.dumps(self.index))
+        self.assertEqual(len(index), 1)
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+Unit tests for splitting MPO files and encapsulating them as multi-frame images.
+'''
+import io
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from PIL import Image
+from pydicom import dcmread
+from pydicom.encaps import generate_pixel_data_frame
+
+from dicom4ortho import jpeg
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+def make_mpo():
+    """ A stereo pair of 64x48 images and a 32x24 preview. """
+    images = [Image.new('RGB', (64, 48), (255, 0, 0)),
+              Image.new('RGB', (64, 48), (0, 0, 255)),
+              Image.new('RGB', (32, 24), (0, 255, 0))]
+    mpo = io.BytesIO()
+    images[0].save(mpo, format='MPO', save_all=True, append_images=images[1:])
+    return mpo.getvalue()
+
+
+def convert(image_bytes):
+    photo = OrthodonticPhotograph(input_image_bytes=image_bytes, image_type='EV01')
+    photo.prepare()
+    return dcmread(photo.to_byte())
+
+
+class TestJPEG(unittest.TestCase):
+
+    def testFrames(self):
+        frames = jpeg.frames(make_mpo())
+        self.assertEqual([jpeg.dimensions(frame) for frame in frames], [(64, 48), (64, 48), (32, 24)])
+        colours = [Image.open(io.BytesIO(frame)).convert('RGB').getpixel((1, 1)) for frame in frames]
+        self.assertEqual([max(range(3), key=colour.__getitem__) for colour in colours], [0, 2, 1])
+
+    def testPlainJPEGIsOneFrame(self):
+        data = (RESOURCES / 'sample_NikonD90.JPG').read_bytes()
+        frames = jpeg.frames(data)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(bytes(frames[0]), data)
+        with self.assertRaises(jpeg.JPEGError):
+            jpeg.frames(b'not a jpeg')
+
+    def testMalformedJPEGIsKeptWhole(self):
+        data = (RESOURCES / 'sample_NikonD90.JPG').read_bytes()
+        # A stray byte after the first segment, which decoders skip over
+        app_end = 4 + int.from_bytes(data[4:6], 'big')
+        malformed = data[:app_end] + b'\0' + data[app_end:]
+        with self.assertRaises(jpeg.JPEGError):
+            jpeg.frames(malformed)
+        ds = convert(malformed)
+        self.assertEqual(bytes(next(generate_pixel_data_frame(ds.PixelData, 1))).rstrip(b'\0'),
+                         malformed.rstrip(b'\0'))
+
+    def testNoMatchingFrameIsKeptWhole(self):
+        mpo = make_mpo()
+        with patch('dicom4ortho.jpeg.dimensions', return_value=(1, 1)):
+            ds = convert(mpo)
+        self.assertNotIn('NumberOfFrames', ds)
+        self.assertEqual(bytes(next(generate_pixel_data_frame(ds.PixelData, 1))).rstrip(b'\0'),
+                         mpo.rstrip(b'\0'))
+
+    def testMultiFrame(self):
+        mpo = make_mpo()
+        ds = convert(mpo)
+        self.assertEqual(ds.NumberOfFrames, 2)
+        self.assertNotIn('ExtendedOffsetTable', ds)
+        frames = list(generate_pixel_data_frame(ds.PixelData, 2))
+        self.assertEqual([bytes(frame).rstrip(b'\0') for frame in frames],
+                         [bytes(frame).rstrip(b'\0') for frame in jpeg.frames(mpo)[:2]])
+        self.assertEqual(ds.pixel_array.shape, (2, 48, 64, 3))
+
+    def testExtendedOffsetTable(self):
+        with patch('dicom4ortho.config.EXTENDED_OFFSET_TABLE_THRESHOLD', 0):
+            ds = convert(make_mpo())
+        self.assertEqual(len(ds.ExtendedOffsetTable), 16)
+        self.assertEqual(len(ds.ExtendedOffsetTableLengths), 16)
+        self.assertEqual(ds.pixel_array.shape, (2, 48, 64, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
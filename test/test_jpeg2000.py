@@ -0,0 +1,85 @@
+'''
+Unit tests for the encapsulation of JPEG 2000 images as they are.
+'''
+import io
+import unittest
+from pathlib import Path
+
+from PIL import Image
+from pydicom import dcmread
+from pydicom.encaps import defragment_data
+from pydicom.uid import JPEG2000, JPEG2000Lossless
+
+from dicom4ortho import jpeg2000
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+def encode(mode, **params):
+    image_bytes = io.BytesIO()
+    Image.new(mode, (64, 48), color=100 if mode == 'L' else (200, 100, 50, 255)[:len(mode)]).save(
+        image_bytes, format='JPEG2000', **params)
+    return image_bytes.getvalue()
+
+
+def convert(image_bytes):
+    photo = OrthodonticPhotograph(input_image_bytes=image_bytes, image_type='EV01')
+    photo.prepare()
+    return photo.to_dataset()
+
+
+class TestJPEG2000(unittest.TestCase):
+
+    def testParseCodestream(self):
+        data, colour_space = jpeg2000.codestream((RESOURCES / 'sample_topsOrtho.jp2').read_bytes())
+        info = jpeg2000.parse(data, colour_space)
+        self.assertEqual((info.columns, info.rows, info.components), (2048, 1411, 3))
+        self.assertEqual((info.bits_stored, info.signed), (8, False))
+        self.assertFalse(info.reversible)
+        self.assertEqual(info.photometric_interpretation, 'YBR_ICT')
+
+    def testParseJP2(self):
+        data, colour_space = jpeg2000.codestream(encode('L', irreversible=False))
+        self.assertEqual(colour_space, jpeg2000.GREYSCALE)
+        info = jpeg2000.parse(data, colour_space)
+        self.assertEqual((info.columns, info.rows, info.components), (64, 48, 1))
+        self.assertTrue(info.reversible)
+        self.assertEqual(info.photometric_interpretation, 'MONOCHROME2')
+        with self.assertRaises(jpeg2000.JPEG2000Error):
+            jpeg2000.codestream(b'not a jpeg 2000 image')
+
+    def testCodestreamIsKept(self):
+        image_bytes = (RESOURCES / 'sample_topsOrtho.jp2').read_bytes()
+        ds = convert(image_bytes)
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, JPEG2000)
+        self.assertEqual(ds.LossyImageCompression, '01')
+        self.assertEqual(ds.LossyImageCompressionMethod, 'ISO_15444_1')
+        self.assertEqual(defragment_data(ds.PixelData).rstrip(b'\0'), image_bytes.rstrip(b'\0'))
+
+    def testReversibleIsLossless(self):
+        image_bytes = encode('RGB', irreversible=False, mct=1)
+        ds = convert(image_bytes)
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, JPEG2000Lossless)
+        self.assertEqual(ds.LossyImageCompression, '00')
+        self.assertEqual(ds.PhotometricInterpretation, 'YBR_RCT')
+        codestream, _ = jpeg2000.codestream(image_bytes)
+        self.assertEqual(defragment_data(ds.PixelData).rstrip(b'\0'), bytes(codestream).rstrip(b'\0'))
+        self.assertEqual(dcmread(convert_to_file(ds)).pixel_array[0, 0].tolist(), [200, 100, 50])
+
+    def testUnsupportedIsEncodedAgain(self):
+        ds = convert(encode('RGBA', irreversible=False))
+        self.assertEqual(ds.SamplesPerPixel, 3)
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, JPEG2000Lossless)
+        self.assertEqual(ds.LossyImageCompression, '01')
+
+
+def convert_to_file(ds):
+    file_like = io.BytesIO()
+    ds.save_as(file_like, write_like_original=False)
+    file_like.seek(0)
+    return file_like
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+Unit tests for the timing instrumentation.
+'''
+import io
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from dicom4ortho import metrics
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def convert(self, output_image_filename):
+        photo = OrthodonticPhotograph(
+            input_image_filename=str(RESOURCES / 'EV-01_EO.RP.LR.CO.png'),
+            output_image_filename=output_image_filename,
+            image_type='EV01')
+        photo.save()
+
+    def testDisabled(self):
+        self.assertFalse(metrics.enabled())
+        self.assertIs(metrics.span('save'), metrics.span('send'))
+        metrics.count('images')
+
+    def testCollector(self):
+        collector = metrics.Collector()
+        metrics.set_sink(collector)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_image_filename = os.path.join(tmpdir, 'EV-01.dcm')
+            self.convert(output_image_filename)
+            output_size = os.path.getsize(output_image_filename)
+
+        for name in ('read', 'image_format', 'build.set_image', 'build.set_dataset',
+                     'apply_view', 'prepare', 'exif', 'save'):
+            self.assertIn(name, collector.spans)
+        self.assertEqual(collector.counters['images'], 1)
+        self.assertEqual(
+            collector.counters['bytes_in'], os.path.getsize(RESOURCES / 'EV-01_EO.RP.LR.CO.png'))
+        self.assertEqual(collector.counters['bytes_out'], output_size)
+        self.assertIn('build.set_image', str(collector))
+
+    def testPercentile(self):
+        collector = metrics.Collector()
+        for seconds in range(1, 101):
+            collector.span('save', seconds / 1000)
+        self.assertEqual(collector.percentile('save', 50), 0.05)
+        self.assertEqual(collector.percentile('save', 99), 0.099)
+        self.assertEqual(collector.percentile('save', 100), 0.1)
+        self.assertIsNone(collector.percentile('send', 50))
+
+    def testJsonLines(self):
+        stream = io.StringIO()
+        metrics.set_sink(metrics.JsonLinesSink(stream))
+        with metrics.span('send'):
+            pass
+        metrics.count('failures')
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(r['type'], r['name']) for r in records],
+                         [('span', 'send'), ('count', 'failures')])
+        self.assertGreaterEqual(records[0]['seconds'], 0)
+        self.assertEqual(records[1]['value'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
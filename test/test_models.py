@@ -7,7 +7,10 @@ from math import copysign
 from unittest import TestCase
 import logging
 import datetime
+from pydicom.dataset import Dataset
 from dicom4ortho.model import DicomBase
+from dicom4ortho.m_modality_worklist import ModalityWorklistTags
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
 
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(funcName)s: %(message)s', level=logging.INFO)
@@ -151,3 +154,135 @@ class TestTimezoneSetterGetter(TestCase):
                 expected_tz = tz
 
                 self.assertEqual(set_tz.utcoffset(None), expected_tz.utcoffset(None),msg=f"Error while testing {hours}h {minutes}m")
+
+
+class TestInstanceUIDs(TestCase):
+
+    def test_supplied_uids_are_kept(self):
+        dicombase = DicomBase(study_instance_uid='1.2.3', series_instance_uid='1.2.4')
+        self.assertEqual(dicombase.study_instance_uid, '1.2.3')
+        self.assertEqual(dicombase.series_instance_uid, '1.2.4')
+
+    def test_generated_uids_are_distinct(self):
+        dicombase = DicomBase()
+        uids = {dicombase._ds.StudyInstanceUID,
+                dicombase._ds.SeriesInstanceUID,
+                dicombase._ds.SOPInstanceUID}
+        self.assertEqual(len(uids), 3)
+        for uid in uids:
+            self.assertLessEqual(len(uid), 64)
+
+
+class TestModuleStages(TestCase):
+
+    def test_each_stage_runs_once(self):
+        stages = []
+        DicomBase(stage_hook=lambda stage, seconds: stages.append(stage))
+        self.assertEqual(tuple(stages), DicomBase.MODULE_STAGES)
+
+    def test_photograph_stages_extend_base(self):
+        from dicom4ortho.model import PhotographBase
+        stages = []
+        PhotographBase(stage_hook=lambda stage, seconds: stages.append((stage, seconds)))
+        self.assertEqual(tuple(s for s, _ in stages), PhotographBase.MODULE_STAGES)
+        self.assertEqual(len(set(PhotographBase.MODULE_STAGES)), len(stages))
+        self.assertTrue(all(seconds >= 0 for _, seconds in stages))
+
+
+class TestModalityWorklistTags(TestCase):
+
+    def setUp(self):
+        from test.sample_data_generator import make_sample_MWL
+        self.mwl = make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+        self.mwl.RequestedProcedureCodeSequence = [Dataset()]
+        self.mwl.RequestedProcedureCodeSequence[0].CodeValue = 'P1'
+        self.mwl.StudyID = 'S1'
+
+    def test_copy_mwl_tags(self):
+        dicombase = DicomBase(dicom_mwl=self.mwl)
+        dicombase.copy_mwl_tags()
+        ds = dicombase.to_dataset()
+        self.assertEqual(ds.PatientName, self.mwl.PatientName)
+        self.assertEqual(ds.PatientID, self.mwl.PatientID)
+        self.assertEqual(ds.AccessionNumber, self.mwl.AccessionNumber)
+        self.assertEqual(ds.StudyInstanceUID, self.mwl.StudyInstanceUID)
+        self.assertEqual(ds.StudyID, self.mwl.RequestedProcedureID)
+        self.assertEqual(ds.ProcedureCodeSequence[0].CodeValue, 'P1')
+        ras = ds.RequestAttributesSequence[0]
+        self.assertEqual(ras.RequestedProcedureID, self.mwl.RequestedProcedureID)
+        self.assertEqual(ras.ScheduledProtocolCodeSequence[0].CodeValue, 'EV19')
+
+    def test_study_id_is_requested_procedure_id(self):
+        del self.mwl.StudyID
+        for dicombase in (DicomBase(dicom_mwl=self.mwl), OrthodonticPhotograph(dicom_mwl=self.mwl)):
+            self.assertEqual(dicombase.to_dataset().StudyID, self.mwl.RequestedProcedureID)
+            dicombase.copy_mwl_tags()
+            self.assertEqual(dicombase.to_dataset().StudyID, self.mwl.RequestedProcedureID)
+
+    def test_shared_mwl_tags_are_independent(self):
+        mwl_tags = ModalityWorklistTags(self.mwl)
+        first = DicomBase(dicom_mwl=mwl_tags)
+        second = DicomBase(dicom_mwl=mwl_tags)
+        first.copy_mwl_tags()
+        second.copy_mwl_tags()
+        first.patient_id = 'CHANGED'
+        self.assertEqual(second.patient_id, self.mwl.PatientID)
+        first.to_dataset().ProcedureCodeSequence[0].CodeValue = 'CHANGED'
+        self.assertEqual(second.to_dataset().ProcedureCodeSequence[0].CodeValue, 'P1')
+        first.to_dataset().RequestAttributesSequence[0].ScheduledProtocolCodeSequence[0].CodeValue = 'CHANGED'
+        self.assertEqual(second.to_dataset().RequestAttributesSequence[0].ScheduledProtocolCodeSequence[0].CodeValue,
+                         'EV19')
+        self.assertEqual(self.mwl.RequestedProcedureCodeSequence[0].CodeValue, 'P1')
+        self.assertIs(first.dicom_mwl, self.mwl)
+
+
+class TestSerialization(TestCase):
+
+    def setUp(self):
+        from pathlib import Path
+        from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+        resources = Path(__file__).parent / 'resources'
+        self.photos = [
+            OrthodonticPhotograph(input_image_filename=resources / filename, image_type='EV01')
+            for filename in ('sample_NikonD90.JPG', 'EV-01_EO.RP.LR.CO.png', 'sample_topsOrtho.jp2')]
+        for photo in self.photos:
+            photo.prepare()
+
+    def test_same_bytes_as_pydicom(self):
+        import io
+        from pydicom import dcmwrite
+        for photo in self.photos:
+            expected = io.BytesIO()
+            dcmwrite(expected, photo.to_dataset(), write_like_original=False)
+            expected = expected.getvalue()
+            self.assertEqual(photo.encoded_length(), len(expected))
+            self.assertEqual(bytes(photo.to_buffer()), expected)
+            self.assertEqual(photo.to_byte().getvalue(), expected)
+
+    def test_to_buffer_into_preallocated_buffer(self):
+        photo = self.photos[0]
+        length = photo.encoded_length()
+        buffer = bytearray(length + 10)
+        view = photo.to_buffer(memoryview(buffer)[5:])
+        self.assertEqual(len(view), length)
+        self.assertEqual(bytes(buffer[5 + 128:5 + 132]), b'DICM')
+        with self.assertRaises(ValueError):
+            photo.to_buffer(bytearray(length - 1))
+
+    def test_write_to_stream_without_tell(self):
+        import io
+        from pydicom import dcmread
+
+        class Stream(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(bytes(data))
+
+        photo = self.photos[1]
+        stream = Stream()
+        self.assertEqual(photo.write_to(stream), photo.encoded_length())
+        ds = dcmread(io.BytesIO(b''.join(stream.chunks)))
+        # Odd length values are padded to an even length
+        self.assertEqual(ds.PixelData.rstrip(b'\0'), photo.to_dataset().PixelData.rstrip(b'\0'))
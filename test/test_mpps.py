@@ -0,0 +1,167 @@
+'''
+Unit tests for Modality Performed Procedure Step reporting, against a local MPPS SCP.
+'''
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import ModalityPerformedProcedureStep  # pylint: disable=E0611
+
+from dicom4ortho.dicom.mpps import COMPLETED, DISCONTINUED, IN_PROGRESS, MPPSError, MPPSReporter
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class MPPSSCP(object):
+    """ An MPPS SCP which keeps the steps it is sent. """
+
+    def __init__(self):
+        self.steps = {}
+        self.associations = 0
+        ae = AE(ae_title='RIS')
+        ae.add_supported_context(ModalityPerformedProcedureStep)
+        self.server = ae.start_server(('127.0.0.1', 0), block=False, evt_handlers=[
+            (evt.EVT_N_CREATE, self.handle_create), (evt.EVT_N_SET, self.handle_set),
+            (evt.EVT_ACCEPTED, self.handle_accepted)])
+        self.port = self.server.server_address[1]
+
+    def handle_accepted(self, event):
+        self.associations += 1
+
+    def handle_create(self, event):
+        ds = event.attribute_list
+        self.steps[event.request.AffectedSOPInstanceUID] = ds
+        return 0x0000, ds
+
+    def handle_set(self, event):
+        uid = event.request.RequestedSOPInstanceUID
+        if uid not in self.steps:
+            return 0x0112, None
+        self.steps[uid].update(event.modification_list)
+        return 0x0000, self.steps[uid]
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+def mwl_item():
+    ds = Dataset()
+    ds.PatientID = 'P1'
+    ds.PatientName = 'Doe^John'
+    ds.AccessionNumber = 'A1'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.RequestedProcedureID = 'RP1'
+    ds.RequestedProcedureDescription = 'Ortho photographs'
+    step = Dataset()
+    step.ScheduledProcedureStepID = 'SPS1'
+    ds.ScheduledProcedureStepSequence = Sequence([step])
+    return ds
+
+
+class TestMPPS(unittest.TestCase):
+
+    def setUp(self):
+        self.scp = MPPSSCP()
+        self.addCleanup(self.scp.shutdown)
+        self.reporter = MPPSReporter('127.0.0.1', self.scp.port, 'RIS', local_aet='CAMERA1', backoff=0.01)
+        self.addCleanup(self.reporter.close)
+
+    def unreachable(self, attempts):
+        """ Fail to associate the first attempts times. """
+        associate = self.reporter._ae.associate
+        calls = []
+
+        def side_effect(*args, **kwargs):
+            calls.append(args)
+            if len(calls) <= attempts:
+                return MagicMock(is_established=False)
+            return associate(*args, **kwargs)
+        return patch.object(self.reporter._ae, 'associate', side_effect=side_effect)
+
+    def photo(self, series_instance_uid):
+        photo = OrthodonticPhotograph(
+            input_image_filename=str(RESOURCES / 'sample_NikonD90.JPG'), image_type='EV01')
+        photo.prepare()
+        photo.to_dataset().SeriesInstanceUID = series_instance_uid
+        return photo
+
+    def testSession(self):
+        step = self.reporter.start_session(mwl_item())
+        photos = [self.photo('1.2.3.1'), self.photo('1.2.3.1'), self.photo('1.2.3.2')]
+        for photo in photos:
+            step.add(photo)
+        self.reporter.flush()
+        self.assertEqual(step.status, IN_PROGRESS)
+        created = self.scp.steps[step.sop_instance_uid]
+        self.assertEqual(created.PatientID, 'P1')
+        self.assertEqual(created.PerformedStationAETitle, 'CAMERA1')
+        scheduled = created.ScheduledStepAttributesSequence[0]
+        self.assertEqual((scheduled.StudyInstanceUID, scheduled.AccessionNumber,
+                          scheduled.ScheduledProcedureStepID), ('1.2.3', 'A1', 'SPS1'))
+
+        self.reporter.complete(step)
+        self.reporter.flush()
+        self.assertEqual(step.status, COMPLETED)
+        completed = self.scp.steps[step.sop_instance_uid]
+        self.assertEqual(completed.PerformedProcedureStepStatus, COMPLETED)
+        series = {item.SeriesInstanceUID: [image.ReferencedSOPInstanceUID for image in item.ReferencedImageSequence]
+                  for item in completed.PerformedSeriesSequence}
+        self.assertEqual(series, {'1.2.3.1': [photos[0].sop_instance_uid, photos[1].sop_instance_uid],
+                                  '1.2.3.2': [photos[2].sop_instance_uid]})
+        reference = photos[0].to_dataset().ReferencedPerformedProcedureStepSequence[0]
+        self.assertEqual(reference.ReferencedSOPInstanceUID, step.sop_instance_uid)
+        # Both messages went over the same association
+        self.assertEqual(self.scp.associations, 1)
+
+    def testUnscheduledAndDiscontinued(self):
+        step = self.reporter.start_session(PatientID='P2')
+        self.reporter.discontinue(step)
+        self.reporter.flush()
+        self.assertEqual(step.status, DISCONTINUED)
+        created = self.scp.steps[step.sop_instance_uid]
+        self.assertEqual(created.PatientID, 'P2')
+        self.assertTrue(created.ScheduledStepAttributesSequence[0].StudyInstanceUID)
+
+    def testUnreachable(self):
+        self.scp.shutdown()
+        step = self.reporter.start_session(mwl_item())
+        self.reporter.complete(step)
+        self.reporter.flush()
+        self.assertIsNone(step.status)
+        self.assertIn('not created', step.error)
+        self.assertIn('Failed to establish association', step.error)
+        # Once the N-CREATE is given up, completing fails loudly
+        with self.assertRaises(MPPSError):
+            self.reporter.complete(step)
+
+    def testRetried(self):
+        with self.unreachable(3):
+            step = self.reporter.start_session(mwl_item())
+            self.reporter.complete(step)
+            self.reporter.flush()
+        self.assertEqual(step.status, COMPLETED)
+        self.assertIsNone(step.error)
+        self.assertEqual(self.scp.steps[step.sop_instance_uid].PerformedProcedureStepStatus, COMPLETED)
+
+    def testResend(self):
+        self.reporter.retries = 1
+        with self.unreachable(2):
+            step = self.reporter.start_session(mwl_item())
+            self.reporter.complete(step)
+            self.reporter.flush()
+            self.assertIsNone(step.status)
+            self.assertNotIn(step.sop_instance_uid, self.scp.steps)
+            self.reporter.resend(step)
+            self.reporter.flush()
+        self.assertEqual(step.status, COMPLETED)
+        self.assertEqual(self.scp.steps[step.sop_instance_uid].PerformedProcedureStepStatus, COMPLETED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+'''
+Unit tests for the outbox of DICOM files to send.
+'''
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, VLPhotographicImageStorage, generate_uid
+
+import dicom4ortho.__main__
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+from dicom4ortho.outbox import Outbox
+
+RESOURCES = Path(__file__).parent / 'resources'
+SEND = {'send_method': 'dimse', 'pacs_dimse_hostname': 'pacs', 'pacs_dimse_port': 104,
+        'pacs_dimse_aet': 'PACS'}
+
+
+def status(code):
+    ds = Dataset()
+    ds.Status = code
+    return ds
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox'), send=SEND, fsync='none')
+        self.sent = []
+
+    def tearDown(self):
+        self.outbox.stop()
+        shutil.rmtree(self.directory)
+
+    def dicom_file(self, study_instance_uid, sop_instance_uid=None):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = VLPhotographicImageStorage
+        ds.SOPInstanceUID = sop_instance_uid or generate_uid()
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.StudyInstanceUID = study_instance_uid
+        filename = os.path.join(self.directory, f'{ds.SOPInstanceUID}.dcm')
+        ds.save_as(filename, write_like_original=False)
+        return filename
+
+    def record(self, **kwargs):
+        self.sent.append([str(dcmread(f).SOPInstanceUID) for f in kwargs['dicom_files']])
+        return status(0x0000)
+
+    def testEnqueueDeduplicates(self):
+        filename = self.dicom_file('1.2.1', '1.2.1.1')
+        self.assertTrue(self.outbox.enqueue(filename))
+        self.assertFalse(self.outbox.enqueue(filename))
+        os.remove(filename)
+        # The outbox keeps its own copy
+        self.assertTrue(os.path.exists(os.path.join(self.outbox.files_directory, '1.2.1.1.dcm')))
+        self.assertEqual(self.outbox.status(), {'pending': 1, 'failing': 0, 'sent': 0, 'committed': 0})
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.outbox.drain()
+        self.assertEqual(self.sent, [['1.2.1.1']])
+        self.assertEqual(os.listdir(self.outbox.files_directory), [])
+        # Sent instances are not queued again until forgotten
+        self.assertFalse(self.outbox.enqueue(self.dicom_file('1.2.1', '1.2.1.1')))
+        self.assertEqual(self.outbox.forget_sent(), 1)
+        self.assertTrue(self.outbox.enqueue(self.dicom_file('1.2.1', '1.2.1.1')))
+
+    def testBatchesInOrderPerStudy(self):
+        self.outbox.batch_size = 2
+        for n in range(3):
+            self.outbox.enqueue(self.dicom_file('1.2.1', f'1.2.1.{n}'))
+            self.outbox.enqueue(self.dicom_file('1.2.2', f'1.2.2.{n}'))
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.assertEqual(self.outbox.drain(), {'pending': 0, 'failing': 0, 'sent': 6, 'committed': 0})
+        self.assertEqual(self.sent, [['1.2.1.0', '1.2.1.1'], ['1.2.2.0', '1.2.2.1'], ['1.2.1.2'], ['1.2.2.2']])
+
+    def testRetriesWithBackoff(self):
+        self.outbox.enqueue(self.dicom_file('1.2.1', '1.2.1.1'))
+        self.outbox.enqueue(self.dicom_file('1.2.2', '1.2.2.1'))
+        with patch('dicom4ortho.controller.dimse.send', return_value=None):
+            self.outbox.drain()
+        self.assertEqual(self.outbox.status(), {'pending': 2, 'failing': 2, 'sent': 0, 'committed': 0})
+        pending = self.outbox.pending()
+        self.assertEqual([row['attempts'] for row in pending], [1, 1])
+        self.assertTrue(all(row['next_attempt'] > time.time() for row in pending))
+        self.assertIn('no association', pending[0]['last_error'])
+        # Not due yet: nothing is sent
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.outbox.drain()
+        self.assertEqual(self.sent, [])
+
+        # Once one goes through, the others are retried right away
+        with self.outbox.connection:
+            self.outbox.connection.execute(
+                "UPDATE outbox SET next_attempt = 0 WHERE sop_instance_uid = '1.2.1.1'")
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.assertEqual(self.outbox.drain(), {'pending': 0, 'failing': 0, 'sent': 2, 'committed': 0})
+        self.assertEqual(self.sent, [['1.2.1.1'], ['1.2.2.1']])
+
+    def testFailureStatus(self):
+        self.outbox.enqueue(self.dicom_file('1.2.1'))
+        with patch('dicom4ortho.controller.dimse.send', return_value=status(0xA700)):
+            self.outbox.drain()
+        self.assertEqual(self.outbox.status()['failing'], 1)
+
+    def testStowRS(self):
+        self.outbox.send = {'send_method': 'wado', 'pacs_wado_url': 'http://pacs/dicom-web'}
+        self.outbox.enqueue(self.dicom_file('1.2.1'))
+        with patch('dicom4ortho.controller.wado.send') as send:
+            send.return_value.ok = True
+            self.assertEqual(self.outbox.drain()['sent'], 1)
+
+    def testSurvivesRestart(self):
+        self.outbox.enqueue(self.dicom_file('1.2.1', '1.2.1.1'))
+        outbox = Outbox(self.outbox.directory, send=SEND)
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            outbox.drain()
+        self.assertEqual(self.sent, [['1.2.1.1']])
+
+    def testEnqueuePhoto(self):
+        photo = OrthodonticPhotograph(
+            input_image_filename=str(RESOURCES / 'sample_NikonD90.JPG'), image_type='EV01')
+        self.assertTrue(self.outbox.enqueue_photo(photo))
+        self.assertFalse(self.outbox.enqueue_photo(photo))
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.outbox.drain()
+        self.assertEqual(self.sent, [[photo.sop_instance_uid]])
+
+    def testWorkers(self):
+        self.outbox.batch_size = 1
+        lock = threading.Lock()
+        sending = set()
+
+        def send(**kwargs):
+            study = str(dcmread(kwargs['dicom_files'][0]).StudyInstanceUID)
+            with lock:
+                # Never two batches of a study at once
+                self.assertNotIn(study, sending)
+                sending.add(study)
+            time.sleep(0.01)
+            result = self.record(**kwargs)
+            with lock:
+                sending.discard(study)
+            return result
+
+        with patch('dicom4ortho.controller.dimse.send', side_effect=send):
+            self.outbox.start(3)
+            for n in range(5):
+                for study in ('1.2.1', '1.2.2'):
+                    self.outbox.enqueue(self.dicom_file(study, f'{study}.{n}'))
+            deadline = time.time() + 10
+            while self.outbox.status()['pending'] and time.time() < deadline:
+                time.sleep(0.01)
+            self.outbox.stop()
+        self.assertEqual(self.outbox.status()['sent'], 10)
+        for study in ('1.2.1', '1.2.2'):
+            self.assertEqual([uids[0] for uids in self.sent if uids[0].startswith(study + '.')],
+                             [f'{study}.{n}' for n in range(5)])
+
+    def testIndexFailureIsNotASendFailure(self):
+        index = MagicMock()
+        index.record_sent.side_effect = sqlite3.OperationalError('database is locked')
+        self.outbox.index = index
+        self.outbox.enqueue(self.dicom_file('1.2.1', '1.2.1.1'))
+        with patch('dicom4ortho.controller.dimse.send', side_effect=self.record):
+            self.assertEqual(self.outbox.drain()['sent'], 1)
+        index.record_sent.assert_called_once()
+        self.assertEqual(self.sent, [['1.2.1.1']])
+
+    def testMigratesOldOutbox(self):
+        directory = os.path.join(self.directory, 'old')
+        os.makedirs(directory)
+        connection = sqlite3.connect(os.path.join(directory, 'outbox.sqlite'))
+        connection.executescript("""
+            CREATE TABLE outbox (sequence INTEGER PRIMARY KEY AUTOINCREMENT, sop_instance_uid TEXT NOT NULL UNIQUE,
+                study_instance_uid TEXT NOT NULL, path TEXT NOT NULL, state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, enqueued_at REAL NOT NULL,
+                sent_at REAL, last_error TEXT);
+            INSERT INTO outbox (sop_instance_uid, study_instance_uid, path, state, next_attempt, enqueued_at)
+                VALUES ('1.2.1.1', '1.2.1', 'x.dcm', 'pending', 0, 0);
+        """)
+        connection.commit()
+        connection.close()
+        outbox = Outbox(directory, send=SEND, fsync='none')
+        self.assertEqual(outbox.status()['pending'], 1)
+        self.assertIsNone(outbox.pending()[0]['transaction_uid'])
+
+    def testCommandLine(self):
+        filename = self.dicom_file('1.2.1')
+        send_config = os.path.join(self.directory, 'send.json')
+        with open(send_config, 'w') as f:
+            json.dump(SEND, f)
+        outbox = ['outbox', '--outbox', self.outbox.directory]
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(dicom4ortho.__main__.main([''] + outbox + ['enqueue', filename]), 0)
+        self.assertEqual(json.loads(stdout.getvalue()), {'pending': 1, 'failing': 0, 'sent': 0, 'committed': 0})
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                patch('dicom4ortho.controller.dimse.send', return_value=status(0x0000)):
+            self.assertEqual(dicom4ortho.__main__.main(
+                [''] + outbox + ['drain', '--send-config', send_config, '--once']), 0)
+        self.assertEqual(json.loads(stdout.getvalue()), {'pending': 0, 'failing': 0, 'sent': 1, 'committed': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Unit tests for icons and previews made at a reduced size.
+'''
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+from pydicom import dcmread
+
+from dicom4ortho import config, jpeg2000, preview
+from dicom4ortho.controller import expand_input_paths
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestPreview(unittest.TestCase):
+
+    def testJPEGDecodedAtReducedSize(self):
+        im = Image.open(RESOURCES / 'sample_NikonD90.JPG')
+        small = preview.reduced(im, 128)
+        # draft() scaled the JPEG by 1/8 while decoding it
+        self.assertEqual(im.size, (268, 178))
+        self.assertEqual(small.size, (128, 85))
+        self.assertEqual(small.mode, 'RGB')
+
+    def testJPEG2000DecodedAtReducedResolution(self):
+        image_bytes = (RESOURCES / 'sample_topsOrtho.jp2').read_bytes()
+        levels = jpeg2000.parse(*jpeg2000.codestream(image_bytes)).decomposition_levels
+        self.assertGreater(levels, 0)
+        im = Image.open(io.BytesIO(image_bytes))
+        small = preview.reduced(im, 256, levels)
+        self.assertEqual(im.reduce, 2)
+        self.assertEqual(max(small.size), 256)
+
+    def testIcon(self):
+        photo = OrthodonticPhotograph(
+            input_image_filename=str(RESOURCES / 'sample_NikonD90.JPG'), image_type='EV01', icon=True)
+        photo.prepare()
+        ds = dcmread(photo.to_byte())
+        icon = ds.IconImageSequence[0]
+        self.assertEqual((icon.Columns, icon.Rows), (config.ICON_SIZE, 85))
+        self.assertEqual(icon.PhotometricInterpretation, 'RGB')
+        self.assertEqual(len(icon.PixelData.rstrip(b'\0')) // 3 * 3, icon.Rows * icon.Columns * 3)
+        self.assertIsNone(photo.preview_bytes)
+
+    def testGreyscaleIcon(self):
+        image_bytes = io.BytesIO()
+        Image.new('L', (300, 200), 100).save(image_bytes, format='PNG')
+        photo = OrthodonticPhotograph(input_image_bytes=image_bytes.getvalue(), image_type='EV01', icon=True)
+        icon = photo.to_dataset().IconImageSequence[0]
+        self.assertEqual((icon.Columns, icon.Rows, icon.SamplesPerPixel), (128, 85, 1))
+        self.assertEqual(icon.PhotometricInterpretation, 'MONOCHROME2')
+
+    def testPreviewSavedNextToDICOM(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / 'photo.dcm'
+            photo = OrthodonticPhotograph(
+                input_image_filename=str(RESOURCES / 'sample_NikonD90.JPG'), image_type='EV01',
+                output_image_filename=str(output), preview=True, preview_size=200)
+            photo.save()
+            self.assertNotIn('IconImageSequence', photo.to_dataset())
+            preview_path = Path(directory) / f'photo{config.PREVIEW_SUFFIX}'
+            self.assertEqual(Image.open(preview_path).size, (200, 133))
+            self.assertEqual(preview_path.read_bytes(), photo.preview_bytes)
+            # Not converted again as an image
+            self.assertEqual(expand_input_paths([directory]), [])
+
+    def testPreviewFilename(self):
+        with tempfile.TemporaryDirectory() as directory:
+            preview_path = Path(directory) / 'thumbnail.jpg'
+            photo = OrthodonticPhotograph(
+                input_image_filename=str(RESOURCES / 'EV-01_EO.RP.LR.CO.png'), image_type='EV01',
+                output_image_filename=str(Path(directory) / 'photo.dcm'),
+                preview_filename=str(preview_path), icon=True)
+            photo.save()
+            self.assertLessEqual(max(Image.open(preview_path).size), config.PREVIEW_SIZE)
+            self.assertIn('IconImageSequence', dcmread(Path(directory) / 'photo.dcm'))
+
+
+if __name__ == "__main__":
+    unittest.main()
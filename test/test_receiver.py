@@ -0,0 +1,150 @@
+'''
+Unit tests for the Storage SCP receiver.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from pydicom import dcmread
+from pydicom.uid import generate_uid
+
+from dicom4ortho.__main__ import parse_route
+from dicom4ortho.dicom import dimse
+from dicom4ortho.index import ArchiveIndex
+from dicom4ortho.receiver import StorageReceiver, image_type_for_dataset, reclassify
+
+RESOURCES = Path(__file__).parent / 'resources'
+ROUTES = [('CallingAETitle', 'INTRAORAL*', 'IV03'), ('SeriesDescription', '*smile*', 'EV08')]
+
+
+class TestReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.original = dcmread(RESOURCES / 'test.dcm')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def receiver(self, **kwargs):
+        receiver = StorageReceiver(
+            os.path.join(self.directory, 'received'), routes=ROUTES, host='127.0.0.1', port=0, **kwargs)
+        receiver.start()
+        self.addCleanup(receiver.shutdown)
+        return receiver
+
+    def send(self, receiver, filenames, local_aet):
+        host, port = receiver.address
+        return dimse.send(dicom_files=filenames, pacs_dimse_hostname=host, pacs_dimse_port=port,
+                          pacs_dimse_aet='DICOM4ORTHO', local_aet=local_aet)
+
+    def received(self, receiver, ds):
+        return dcmread(receiver.filename_for(ds))
+
+    def testImageTypeForDataset(self):
+        ds = self.original.copy()
+        ds.SeriesDescription = 'Big smile'
+        self.assertEqual(image_type_for_dataset(ds, ROUTES, calling_ae_title='INTRAORAL2'), 'IV03')
+        self.assertEqual(image_type_for_dataset(ds, ROUTES, calling_ae_title='CAMERA'), 'EV08')
+        del ds.SeriesDescription
+        self.assertIsNone(image_type_for_dataset(ds, ROUTES))
+        self.assertEqual(image_type_for_dataset(ds, ROUTES, 'EV01'), 'EV01')
+
+    def testParseRoute(self):
+        self.assertEqual(parse_route('StationName:CAM*=IV-03'), ('StationName', 'CAM*', 'IV03'))
+        self.assertEqual(parse_route('CallingAETitle:X=EV01'), ('CallingAETitle', 'X', 'EV01'))
+        for rule in ('StationName=IV03', 'NotAKeyword:x=IV03', 'StationName:x='):
+            with self.assertRaises(ArgumentTypeError):
+                parse_route(rule)
+
+    def testReclassifies(self):
+        receiver = self.receiver()
+        status = self.send(receiver, [str(RESOURCES / 'test.dcm')], 'INTRAORAL1')
+        self.assertEqual(status.Status, 0xB000)
+        received = self.received(receiver, self.original)
+        self.assertTrue(received.ImageComments.startswith('IV03^'))
+        self.assertEqual(received.SOPInstanceUID, self.original.SOPInstanceUID)
+        self.assertEqual(received.PixelData, self.original.PixelData)
+
+    def testStoresUnrouted(self):
+        receiver = self.receiver()
+        status = self.send(receiver, [str(RESOURCES / 'test.dcm')], 'CAMERA')
+        self.assertEqual(status.Status, 0x0000)
+        received = self.received(receiver, self.original)
+        self.assertEqual(received.get('ImageComments'), self.original.get('ImageComments'))
+        self.assertEqual(received.PixelData, self.original.PixelData)
+
+    def testConcurrentAssociations(self):
+        filenames = []
+        for n in range(8):
+            ds = self.original.copy()
+            ds.SOPInstanceUID = generate_uid()
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            filenames.append(os.path.join(self.directory, f'{n}.dcm'))
+            ds.save_as(filenames[-1])
+        receiver = self.receiver()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            statuses = list(executor.map(
+                lambda filename: self.send(receiver, [filename], 'INTRAORAL1'), filenames))
+        self.assertEqual([status.Status for status in statuses], [0xB000] * 8)
+        for filename in filenames:
+            self.assertTrue(self.received(receiver, dcmread(filename)).ImageComments.startswith('IV03^'))
+
+    def testBookkeepingFailureIsStillStored(self):
+        outbox = MagicMock()
+        outbox.enqueue.side_effect = OSError('disk full')
+        index = MagicMock()
+        index.add_file.side_effect = RuntimeError('locked')
+        receiver = StorageReceiver(os.path.join(self.directory, 'received'), outbox=outbox, index=index)
+        ds = self.original.copy()
+        self.assertEqual(receiver.store(ds), 0x0000)
+        self.assertTrue(os.path.exists(receiver.filename_for(ds)))
+
+    def testRefusesUIDsOutsideOutputDir(self):
+        receiver = StorageReceiver(os.path.join(self.directory, 'received'))
+        for keyword, uid in (('SOPInstanceUID', '../../escaped'), ('StudyInstanceUID', '/tmp'),
+                             ('StudyInstanceUID', '..'), ('SOPInstanceUID', '')):
+            ds = self.original.copy()
+            setattr(ds, keyword, uid)
+            self.assertEqual(receiver.store(ds), 0xC000, msg=uid)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testReclassifyKeepsUIDs(self):
+        ds = self.original.copy()
+        reclassify(ds, 'EV-08')
+        self.assertTrue(ds.ImageComments.startswith('EV08^'))
+        self.assertEqual((ds.SOPInstanceUID, ds.StudyInstanceUID, ds.SeriesInstanceUID),
+                         (self.original.SOPInstanceUID, self.original.StudyInstanceUID,
+                          self.original.SeriesInstanceUID))
+        with self.assertRaises(ValueError):
+            reclassify(ds, 'XX99')
+
+    def testReceiveWithIndex(self):
+        index = ArchiveIndex(os.path.join(self.directory, 'index.sqlite'))
+        self.addCleanup(index.close)
+        receiver = self.receiver(index=index)
+        for n in range(2):
+            ds = self.original.copy()
+            ds.SOPInstanceUID = generate_uid()
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            filename = os.path.join(self.directory, f'{n}.dcm')
+            ds.save_as(filename)
+            # Each association in its own thread
+            self.assertEqual(self.send(receiver, [filename], 'CAMERA').Status, 0x0000)
+        self.assertEqual(len(index), 2)
+
+    def testForwardsThroughOutbox(self):
+        outbox = MagicMock()
+        receiver = StorageReceiver(os.path.join(self.directory, 'received'), outbox=outbox)
+        ds = self.original.copy()
+        self.assertEqual(receiver.store(ds), 0x0000)
+        outbox.enqueue.assert_called_once_with(receiver.filename_for(ds))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+'''
+Unit tests for the conversion service.
+'''
+import io
+import os
+import stat
+import tempfile
+import threading
+import unittest
+import importlib.resources
+from pydicom import dcmread
+from pydicom.filewriter import dcmwrite
+
+from dicom4ortho.server import ConversionServer, submit
+from test.sample_data_generator import make_sample_MWL
+
+
+def read_resource(name):
+    with importlib.resources.path("test.resources", name) as path:
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class TestConversionServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.output_dir = os.path.join(cls.tmpdir.name, 'dicom')
+        os.mkdir(cls.output_dir)
+        cls.server = ConversionServer(
+            socket_path=os.path.join(cls.tmpdir.name, 'd4o.sock'), workers=1, output_dir=cls.output_dir)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.tmpdir.cleanup()
+
+    def testSocketPermissions(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.server.address).st_mode), 0o600)
+
+    def testConvertAndSave(self):
+        result = submit(
+            read_resource('EV-01_EO.RP.LR.CO.png'), address=self.server.address,
+            metadata={'image_type': 'EV01', 'patient_id': '1234'},
+            output_filename='EV-01.dcm')
+        self.assertEqual(result['status'], 'ok', msg=result.get('error'))
+        output_filename = os.path.join(os.path.realpath(self.output_dir), 'EV-01.dcm')
+        self.assertEqual(result['output_filename'], output_filename)
+        ds = dcmread(output_filename)
+        self.assertEqual(ds.SOPInstanceUID, result['sop_instance_uid'])
+        self.assertEqual(ds.PatientID, '1234')
+
+    def testConvertWithMWL(self):
+        mwl = make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+        mwl_bytes = io.BytesIO()
+        dcmwrite(mwl_bytes, mwl)
+        result = submit(
+            read_resource('EV-01_EO.RP.LR.CO.png'), address=self.server.address,
+            mwl_bytes=mwl_bytes.getvalue(), return_dicom=True)
+        self.assertEqual(result['status'], 'ok', msg=result.get('error'))
+        self.assertEqual(result['study_instance_uid'], mwl.StudyInstanceUID)
+        self.assertIn('dicom', result)
+
+    def testOutputOutsideOutputDir(self):
+        for output_filename in (os.path.join(self.tmpdir.name, 'EV-01.dcm'), '../EV-01.dcm', '.'):
+            result = submit(
+                read_resource('EV-01_EO.RP.LR.CO.png'), address=self.server.address,
+                output_filename=output_filename)
+            self.assertEqual(result['status'], 'error')
+            self.assertIn('output directory', result['error'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['d4o.sock', 'dicom'])
+
+    def testMetadataPaths(self):
+        image = read_resource('EV-01_EO.RP.LR.CO.png')
+        for metadata in ({'preview_filename': '/tmp/x.jpg'}, {'output_image_filename': '/tmp/x.dcm'},
+                         {'input_image_filename': '/etc/passwd'}):
+            result = submit(image, address=self.server.address, metadata=metadata, output_filename='x.dcm')
+            self.assertEqual(result['status'], 'error', msg=metadata)
+        self.assertFalse(os.path.exists('/tmp/x.jpg'))
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'x.dcm')))
+
+        result = submit(image, address=self.server.address,
+                        metadata={'image_type': 'EV01', 'preview_filename': 'EV-01.preview.jpg'},
+                        output_filename='EV-01-preview.dcm')
+        self.assertEqual(result['status'], 'ok', msg=result.get('error'))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'EV-01.preview.jpg')))
+
+    def testNoOutputDir(self):
+        server = ConversionServer(port=0, workers=1, output_dir=None)
+        self.addCleanup(server.close)
+        with self.assertRaises(ValueError):
+            server.output_path('EV-01.dcm')
+
+    def testBadImage(self):
+        result = submit(b'not an image', address=self.server.address)
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('error', result)
+
+
+if __name__ == "__main__":
+    unittest.main()
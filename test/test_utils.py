@@ -0,0 +1,48 @@
+'''
+Unit tests for utils.
+'''
+import multiprocessing
+import os
+from unittest import TestCase, skipUnless
+
+from dicom4ortho.config import SOPInstanceUID_ROOT
+from dicom4ortho.utils import UIDAllocator, generate_dicom_uid
+
+
+def _generate_uid(_):
+    return generate_dicom_uid()
+
+
+class TestUIDAllocator(TestCase):
+
+    def test_uids_are_valid_and_unique(self):
+        allocator = UIDAllocator(SOPInstanceUID_ROOT, batch_size=16)
+        uids = [allocator.allocate() for _ in range(100)]
+        self.assertEqual(len(set(uids)), 100)
+        for uid in uids:
+            self.assertTrue(uid.startswith(SOPInstanceUID_ROOT + '.'))
+            self.assertLessEqual(len(uid), 64)
+            self.assertRegex(uid, r'^(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*$')
+
+    def test_from_hash_is_deterministic(self):
+        allocator = UIDAllocator(SOPInstanceUID_ROOT)
+        self.assertEqual(allocator.from_hash('a', b'b'), allocator.from_hash('a', b'b'))
+        self.assertNotEqual(allocator.from_hash('ab'), allocator.from_hash('a', 'b'))
+
+    @skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_forked_children_do_not_reuse_uids(self):
+        generate_dicom_uid()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(4) as pool:
+            uids = pool.map(_generate_uid, range(8))
+        uids.append(generate_dicom_uid())
+        self.assertEqual(len(set(uids)), len(uids))
+
+    def test_root_too_long(self):
+        with self.assertRaises(ValueError):
+            UIDAllocator('1.2.' + '3' * 62)
+
+    def test_generate_dicom_uid_hash_unchanged(self):
+        self.assertEqual(
+            generate_dicom_uid(root='1.2.3', hash=bytes(range(16))),
+            '1.2.3.0.1.2.3.4.5.6.7.8.9.10.11.12')
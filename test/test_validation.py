@@ -0,0 +1,148 @@
+'''
+Unit tests for the in-process validator.
+'''
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from dicom4ortho.controller import OrthodonticController
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+from dicom4ortho.validation import (
+    validate_dataset, validate_files, ValidationError, ValidationReport, ERROR, WARNING, FAST, FULL)
+from test.sample_data_generator import make_sample_MWL
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+def make_photo(image_type='IV01', **kwargs):
+    photo = OrthodonticPhotograph(
+        input_image_filename=RESOURCES / 'sample_NikonD90.JPG',
+        image_type=image_type,
+        patient_id='X1',
+        patient_birthdate='1958-08-29',
+        treatment_event_type='OrthodonticTreatment',
+        days_after_event=212,
+        **kwargs)
+    photo.prepare()
+    return photo
+
+
+class TestValidation(unittest.TestCase):
+
+    def assertIssue(self, result, path, rule, severity=ERROR):
+        self.assertIn((severity, path, rule),
+                      [(i.severity, i.path, i.rule) for i in result.issues],
+                      msg=[str(i) for i in result.issues])
+
+    def testValidPhoto(self):
+        result = validate_dataset(make_photo()._ds)
+        self.assertTrue(result.is_valid, msg=[str(i) for i in result.issues])
+        self.assertEqual(result.warnings, [])
+
+    def testMissingType1(self):
+        ds = make_photo()._ds
+        del ds.SOPInstanceUID
+        result = validate_dataset(ds)
+        self.assertFalse(result.is_valid)
+        self.assertIssue(result, 'SOPInstanceUID', 'iod')
+
+    def testCodeMeaningTooLong(self):
+        ds = make_photo()._ds
+        ds.AnatomicRegionSequence[0].CodeMeaning = 'x' * 70
+        self.assertIssue(validate_dataset(ds), 'AnatomicRegionSequence[0].CodeMeaning', 'vr')
+
+    def testVM(self):
+        ds = make_photo()._ds
+        ds.ImageType = ['ORIGINAL']
+        self.assertIssue(validate_dataset(ds), 'ImageType', 'vm')
+
+    def testCodeItem(self):
+        ds = make_photo()._ds
+        del ds.AnatomicRegionSequence[0].CodingSchemeDesignator
+        self.assertIssue(
+            validate_dataset(ds), 'AnatomicRegionSequence[0].CodingSchemeDesignator', 'code')
+
+    def testTid3465(self):
+        ds = make_photo()._ds
+        del ds.AcquisitionContextSequence[0].ConceptCodeSequence
+        self.assertIssue(
+            validate_dataset(ds), 'AcquisitionContextSequence[0].ConceptCodeSequence', 'tid3465')
+
+    def testDentOip(self):
+        ds = make_photo('IV01')._ds
+        ds.ImageLaterality = 'L' if ds.ImageLaterality != 'L' else 'R'
+        self.assertIssue(validate_dataset(ds), 'ImageLaterality', 'dent-oip')
+        ds.ImageComments = 'Holiday picture'
+        self.assertIssue(validate_dataset(ds), 'ImageComments', 'dent-oip', WARNING)
+
+    def testCompressionRatio(self):
+        ds = make_photo()._ds
+        self.assertGreater(float(ds.LossyImageCompressionRatio), 1)
+        ds.LossyImageCompressionRatio = 1000
+        self.assertIssue(validate_dataset(ds), 'LossyImageCompressionRatio', 'iod', WARNING)
+
+    def testValidateOnWrite(self):
+        photo = make_photo(validate=FULL)
+        photo._ds.AnatomicRegionSequence[0].CodeMeaning = 'x' * 70
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'invalid.dcm')
+            with self.assertRaises(ValidationError):
+                photo.save(filename)
+            self.assertFalse(os.path.exists(filename))
+            with self.assertRaises(ValidationError):
+                photo.to_byte()
+
+    def testValidateOnWriteFast(self):
+        mwl = make_sample_MWL(modality='XC', startdate='20241209', starttime='090000')
+        mwl.InstitutionName = 'x' * 70
+        report = ValidationReport()
+        photo = make_photo(dicom_mwl=mwl, validation_report=report, validate=FAST)
+        photo.copy_mwl_tags()
+        photo.to_byte()
+        self.assertTrue(photo.validation_result.is_valid)
+        photo.validate = FULL
+        photo.to_byte()
+        self.assertIssue(photo.validation_result, 'InstitutionName', 'vr')
+        self.assertEqual(len(report.results), 2)
+        self.assertEqual(len(report.invalid), 1)
+
+    def testReport(self):
+        report = ValidationReport()
+        for _ in range(3):
+            ds = make_photo()._ds
+            ds.ImageType = ['ORIGINAL']
+            report.add(validate_dataset(ds))
+        report.add(validate_dataset(make_photo()._ds))
+        self.assertEqual(len(report.invalid), 3)
+        self.assertIn("3 of 4 datasets invalid", str(report))
+        self.assertEqual(report.counts()[(ERROR, 'ImageType', report.invalid[0].errors[0].message)], 3)
+        with self.assertRaises(ValidationError) as error:
+            report.raise_for_errors()
+        self.assertEqual(len(error.exception.results), 3)
+
+    def testBatchValidateOnWrite(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            summary = OrthodonticController().bulk_convert_images(
+                [str(RESOURCES / 'EV-*.png')], output_dir=tmpdir, validate=FULL)
+        self.assertEqual(summary.images, 2)
+        self.assertEqual(len(summary.validation.results), 2)
+        self.assertEqual(summary.validation.invalid, [], msg=str(summary.validation))
+
+    def testValidateFiles(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = []
+            for image_type in ('IV01', 'EV01'):
+                filename = os.path.join(tmpdir, f'{image_type}.dcm')
+                make_photo(image_type).save(filename)
+                filenames.append(filename)
+            filenames.append(os.path.join(tmpdir, 'missing.dcm'))
+            results = validate_files(filenames, jobs=2)
+        self.assertEqual([r.source for r in results], filenames)
+        self.assertEqual([r.is_valid for r in results], [True, True, False])
+        json.dumps([r.to_dict() for r in results])
+
+
+if __name__ == "__main__":
+    unittest.main()
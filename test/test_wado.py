@@ -0,0 +1,37 @@
+'''
+Unit tests for sending DICOM files with STOW-RS.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from dicom4ortho.dicom import wado
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestWado(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def testUnreadableFileIsLeftOut(self):
+        readable = os.path.join(self.directory, 'readable.dcm')
+        shutil.copy(RESOURCES / 'test.dcm', readable)
+        # Has a size, but cannot be read
+        unreadable = os.path.join(self.directory, 'unreadable.dcm')
+        os.mkdir(unreadable)
+        with patch('dicom4ortho.dicom.wado.requests.post') as post:
+            wado.send(pacs_wado_url='http://pacs/dicom-web/studies',
+                      dicom_files=[unreadable, os.path.join(self.directory, 'missing.dcm'), readable])
+        body = bytes(post.call_args.kwargs['data'])
+        self.assertEqual(body.count(b'Content-Type: application/dicom'), 1)
+        self.assertIn((RESOURCES / 'test.dcm').read_bytes(), body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+'''
+Unit tests for the watch folder mode.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+from pydicom import dcmread
+
+from dicom4ortho.watch import _INOTIFY_EVENT, IN_Q_OVERFLOW, FolderWatcher, Inotify
+
+RESOURCES = Path(__file__).parent / 'resources'
+
+
+class TestFolderWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def watch(self, watcher, expected_images, timeout=30):
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            deadline = time.monotonic() + timeout
+            while watcher.summary.images + watcher.summary.failures < expected_images:
+                self.assertLess(time.monotonic(), deadline, msg="Timed out waiting for conversions")
+                time.sleep(0.05)
+        finally:
+            watcher.stop()
+            thread.join()
+
+    def dropAndConvert(self, use_inotify):
+        shutil.copy(RESOURCES / 'EV-01_EO.RP.LR.CO.png', self.directory)
+        watcher = FolderWatcher(
+            self.directory, settle_seconds=0.2, poll_interval=0.05, use_inotify=use_inotify)
+
+        def drop_later():
+            time.sleep(0.3)
+            (self.directory / 'session').mkdir()
+            time.sleep(0.1)
+            shutil.copy(RESOURCES / 'IV-25_IO.MX.MO.OV.WM.BC.png', self.directory / 'session')
+        threading.Thread(target=drop_later).start()
+
+        self.watch(watcher, expected_images=2)
+        self.assertEqual(watcher.summary.failures, 0)
+        self.assertEqual(
+            dcmread(self.directory / 'EV-01_EO.RP.LR.CO.dcm').ImageComments[:4], 'EV01')
+        self.assertEqual(
+            dcmread(self.directory / 'session' / 'IV-25_IO.MX.MO.OV.WM.BC.dcm').ImageComments[:4], 'IV25')
+
+    def testPolling(self):
+        self.dropAndConvert(use_inotify=False)
+
+    def testInotify(self):
+        self.dropAndConvert(use_inotify=True)
+
+    def testInotifyOverflowEvent(self):
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            self.skipTest(str(e))
+        read_fd, write_fd = os.pipe()
+        os.close(inotify.fd)
+        inotify.fd = read_fd
+        self.addCleanup(inotify.close)
+        os.write(write_fd, _INOTIFY_EVENT.pack(-1, IN_Q_OVERFLOW, 0, 0))
+        os.close(write_fd)
+        self.assertEqual(inotify.read(1), [])
+        self.assertTrue(inotify.overflowed)
+
+    def testRescanAfterOverflow(self):
+        watcher = FolderWatcher(self.directory, settle_seconds=0.2, poll_interval=0.05)
+        if watcher._inotify is None:
+            self.skipTest("inotify is not available")
+        read = watcher._inotify.read
+
+        def overflowing_read(timeout):
+            # The kernel dropped every event
+            if read(timeout):
+                watcher._inotify.overflowed = True
+            return []
+
+        def drop_later():
+            time.sleep(0.3)
+            (self.directory / 'session').mkdir()
+            shutil.copy(RESOURCES / 'IV-25_IO.MX.MO.OV.WM.BC.png', self.directory / 'session')
+        threading.Thread(target=drop_later).start()
+
+        with patch.object(watcher._inotify, 'read', side_effect=overflowing_read):
+            self.watch(watcher, expected_images=1)
+        self.assertEqual(watcher.summary.failures, 0)
+        self.assertTrue((self.directory / 'session' / 'IV-25_IO.MX.MO.OV.WM.BC.dcm').exists())
+
+    def testSkipConverted(self):
+        image = shutil.copy(RESOURCES / 'EV-01_EO.RP.LR.CO.png', self.directory)
+        Path(image).with_suffix('.dcm').write_bytes(b'')
+        shutil.copy(RESOURCES / 'EV-17_EO.FF.LC.CO.png', self.directory)
+        watcher = FolderWatcher(self.directory, settle_seconds=0.1, poll_interval=0.05)
+        self.watch(watcher, expected_images=1)
+        self.assertEqual(watcher.summary.images, 1)
+        self.assertEqual(os.path.getsize(Path(image).with_suffix('.dcm')), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+'''
+Unit tests for the Modality Worklist client and cache, against a local Worklist SCP.
+'''
+import io
+import json
+import time
+import unittest
+from datetime import date, timedelta
+from pathlib import Path
+from unittest.mock import patch
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import ModalityWorklistInformationFind  # pylint: disable=E0611
+
+import dicom4ortho.__main__
+from dicom4ortho.controller import OrthodonticController
+from dicom4ortho.dicom.worklist import WorklistCache, WorklistClient, WorklistError, identifier
+
+RESOURCES = Path(__file__).parent / 'resources'
+TODAY = date.today().strftime('%Y%m%d')
+TOMORROW = (date.today() + timedelta(days=1)).strftime('%Y%m%d')
+
+
+def worklist_item(patient_id, accession_number, scheduled_date, scheduled_time='090000'):
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.PatientName = f'Patient^{patient_id}'
+    ds.AccessionNumber = accession_number
+    ds.StudyInstanceUID = generate_uid()
+    step = Dataset()
+    step.Modality = 'XC'
+    step.ScheduledProcedureStepStartDate = scheduled_date
+    step.ScheduledProcedureStepStartTime = scheduled_time
+    step.ScheduledProcedureStepID = accession_number
+    ds.ScheduledProcedureStepSequence = Sequence([step])
+    return ds
+
+
+class WorklistSCP(object):
+    """ A Worklist SCP matching PatientID, AccessionNumber and the scheduled date exactly. """
+
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+        self.associations = 0
+        ae = AE(ae_title='MWL')
+        ae.add_supported_context(ModalityWorklistInformationFind)
+        self.server = ae.start_server(('127.0.0.1', 0), block=False,
+                                      evt_handlers=[(evt.EVT_C_FIND, self.handle_find),
+                                                    (evt.EVT_ACCEPTED, self.handle_accepted)])
+        self.port = self.server.server_address[1]
+
+    def handle_accepted(self, event):
+        self.associations += 1
+
+    def handle_find(self, event):
+        query = event.identifier
+        self.queries.append(query)
+        step = query.ScheduledProcedureStepSequence[0]
+        for item in self.items:
+            item_step = item.ScheduledProcedureStepSequence[0]
+            if all(not expected or actual == expected for actual, expected in (
+                    (item.PatientID, query.get('PatientID')),
+                    (item.AccessionNumber, query.get('AccessionNumber')),
+                    (item_step.ScheduledProcedureStepStartDate, step.get('ScheduledProcedureStepStartDate')))):
+                yield 0xFF00, item
+        yield 0x0000, None
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+class TestWorklist(unittest.TestCase):
+
+    def setUp(self):
+        self.scp = WorklistSCP([
+            worklist_item('P1', 'A1', TODAY, '100000'),
+            worklist_item('P1', 'A2', TODAY, '090000'),
+            worklist_item('P2', 'A3', TOMORROW),
+        ])
+        self.addCleanup(self.scp.shutdown)
+        self.client = WorklistClient('127.0.0.1', self.scp.port, 'MWL')
+
+    def testFind(self):
+        items = self.client.find(PatientID='P1')
+        self.assertEqual(sorted(item.AccessionNumber for item in items), ['A1', 'A2'])
+        # The return keys come back
+        self.assertEqual(items[0].ScheduledProcedureStepSequence[0].Modality, 'XC')
+
+    def testFindAllOneAssociation(self):
+        results = self.client.find_all(
+            identifier(ScheduledProcedureStepStartDate=scheduled_date) for scheduled_date in (TODAY, TOMORROW))
+        self.assertEqual([len(items) for items in results], [2, 1])
+        self.assertEqual(self.scp.associations, 1)
+
+    def testUnreachable(self):
+        self.scp.shutdown()
+        with self.assertRaises(WorklistError):
+            WorklistClient('127.0.0.1', self.scp.port, 'MWL', timeout=1).find()
+
+    def testCacheLookupsAreLocal(self):
+        cache = WorklistCache(self.client)
+        self.assertEqual(cache.refresh(), 2)
+        self.assertEqual(len(cache), 3)
+        queries = len(self.scp.queries)
+        self.assertEqual([item.AccessionNumber for item in cache.find(patient_id='P1')], ['A2', 'A1'])
+        self.assertEqual([item.PatientID for item in cache.find(accession_number='A3')], ['P2'])
+        self.assertEqual(len(cache.find(scheduled_date=TODAY)), 2)
+        self.assertEqual(cache.find(patient_id='P1', accession_number='A3', query=False), [])
+        self.assertEqual(len(self.scp.queries), queries)
+        # Nothing to refresh yet
+        self.assertEqual(cache.refresh(), 0)
+
+    def testCacheRefreshDropsAndAdds(self):
+        cache = WorklistCache(self.client)
+        cache.refresh()
+        del self.scp.items[0]
+        self.scp.items.append(worklist_item('P3', 'A4', TODAY))
+        cache.refresh(force=True)
+        self.assertEqual(cache.find(accession_number='A1', query=False), [])
+        self.assertEqual(len(cache.find(patient_id='P3', query=False)), 1)
+
+    def testCacheMissQueries(self):
+        cache = WorklistCache(self.client)
+        cache.refresh()
+        self.scp.items.append(worklist_item('P9', 'A9', TODAY))
+        self.assertEqual([item.AccessionNumber for item in cache.find(patient_id='P9')], ['A9'])
+        queries = len(self.scp.queries)
+        self.assertEqual(len(cache.find(patient_id='P9')), 1)
+        self.assertEqual(len(self.scp.queries), queries)
+
+    def testCacheExpires(self):
+        cache = WorklistCache(self.client, ttl=0.01)
+        cache.refresh()
+        time.sleep(0.02)
+        self.assertEqual(cache.find(patient_id='P2', query=False), [])
+        self.assertEqual(len(cache.find(patient_id='P2')), 1)
+
+    def testBackgroundRefresh(self):
+        cache = WorklistCache(self.client)
+        cache.start()
+        deadline = time.time() + 10
+        while not len(cache) and time.time() < deadline:
+            time.sleep(0.01)
+        cache.stop()
+        self.assertEqual(len(cache), 3)
+
+    def testConvertWithCachedItem(self):
+        cache = WorklistCache(self.client)
+        cache.refresh()
+        mwl = cache.find(accession_number='A3')[0]
+        with open(RESOURCES / 'sample_NikonD90.JPG', 'rb') as image:
+            photo = OrthodonticController().convert_image_plus_mwl_to_dicom4orthograph(image.read(), mwl)
+        ds = photo.to_dataset()
+        self.assertEqual((ds.PatientID, ds.AccessionNumber), ('P2', 'A3'))
+
+    def testCommandLine(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(dicom4ortho.__main__.main(
+                ['', 'worklist', '--host', '127.0.0.1', '--port', str(self.scp.port), '--aet', 'MWL',
+                 '--patient-id', 'P2']), 0)
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([(line['PatientID'], line['AccessionNumber']) for line in lines], [('P2', 'A3')])
+
+
+if __name__ == '__main__':
+    unittest.main()
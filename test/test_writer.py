@@ -0,0 +1,67 @@
+'''
+Unit tests for writing files.
+'''
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from dicom4ortho.writer import FileWriter, FSYNC_BATCH, FSYNC_FILE, DIRECT_IO_ALIGNMENT
+
+
+def write_chunks(*chunks):
+    def write(fp):
+        for chunk in chunks:
+            fp.write(chunk)
+    return write
+
+
+class TestFileWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'out.dcm')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testAtomicWrite(self):
+        writer = FileWriter()
+        self.assertEqual(writer.write(self.filename, write_chunks(b'ab', b'cd')), 4)
+        self.assertEqual(Path(self.filename).read_bytes(), b'abcd')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['out.dcm'])
+        self.assertEqual(writer.bytes, 4)
+
+    def testFailedWriteKeepsPreviousFile(self):
+        Path(self.filename).write_bytes(b'previous')
+
+        def write(fp):
+            fp.write(b'partial')
+            raise RuntimeError('crash')
+
+        with self.assertRaises(RuntimeError):
+            FileWriter().write(self.filename, write)
+        self.assertEqual(Path(self.filename).read_bytes(), b'previous')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['out.dcm'])
+
+    def testFsyncPolicies(self):
+        with patch('os.fsync') as fsync:
+            FileWriter(fsync=FSYNC_FILE).write(self.filename, write_chunks(b'x'))
+            self.assertEqual(fsync.call_count, 2)  # file and directory
+        writer = FileWriter(fsync=FSYNC_BATCH)
+        with patch('os.fsync') as fsync:
+            for name in ('a.dcm', 'b.dcm'):
+                writer.write(os.path.join(self.tmpdir.name, name), write_chunks(b'x'))
+            self.assertEqual(fsync.call_count, 0)
+            writer.sync()
+            self.assertEqual(fsync.call_count, 3)  # two files, one directory
+        with self.assertRaises(ValueError):
+            FileWriter(fsync='sometimes')
+
+    def testDirectIO(self):
+        data = os.urandom(3 * DIRECT_IO_ALIGNMENT + 5)
+        writer = FileWriter(direct=True, buffer_size=2 * DIRECT_IO_ALIGNMENT)
+        length = writer.write(self.filename, write_chunks(data[:7], data[7:]))
+        self.assertEqual(length, len(data))
+        self.assertEqual(Path(self.filename).read_bytes(), data)